@@ -7,9 +7,12 @@ import os
 import sys
 import subprocess
 import traceback
+import hashlib
+import json
+import glob
 
 class PyKeyUpKeyDown(object):
-  def __init__(self, debug=False):
+  def __init__(self, debug=False, keymap_cache_dir=None):
     #  All of the following constants are defined in
     #  the Linux kernel: include/uapi/linux/kd.h
     self.KDGKBMODE = 0x4B44  #  Get current keyboard mode
@@ -22,6 +25,15 @@ class PyKeyUpKeyDown(object):
     self.old_attr = None
     self.fd = None
     self.debug = debug
+    self.keymap = {}
+    #  Flat list indexed by keycode, built from self.keymap by set_keymap.
+    self.keymap_table = []
+    #  Parsed keymaps are cached here so that dumpkeys doesn't need to run on every startup.
+    self.keymap_cache_dir = keymap_cache_dir if keymap_cache_dir is not None else os.path.join(os.path.expanduser('~'), '.cache', 'robot_tank')
+    #  Files that define the console keymap.  As long as none of them change, neither does the output of dumpkeys.
+    self.keymap_source_files = ['/etc/default/keyboard', '/etc/vconsole.conf'] + glob.glob('/etc/console-setup/cached*.kmap.gz')
+    #  Start of a 3 byte keycode that was split across reads.
+    self.partial_scancode = bytearray(b'')
   
   def get_keymap_as_string(self):
     try:
@@ -57,6 +69,73 @@ class PyKeyUpKeyDown(object):
     except Exception as e:
       sys.stdout.write("An exception happend when trying to parse the keymap data: " + str(e) + ".\n")
   
+  def set_keymap(self, m):
+    self.keymap = m
+    self.keymap_table = [None] * ((max(m.keys()) + 1) if len(m) else 0)
+    for k in m:
+      self.keymap_table[k] = m[k]
+
+  def get_keymap_source_hash(self):
+    h = hashlib.sha1()
+    found = False
+    for path in sorted(self.keymap_source_files):
+      try:
+        with open(path, 'rb') as f:
+          h.update(path.encode("utf-8"))
+          h.update(f.read())
+          found = True
+      except Exception as e:
+        pass
+    return h.hexdigest() if found else None
+
+  def get_keymap_cache_path(self, key):
+    return os.path.join(self.keymap_cache_dir, "keymap-" + key + ".json")
+
+  def load_cached_keymap(self, key):
+    try:
+      with open(self.get_keymap_cache_path(key)) as f:
+        #  JSON object keys are always strings, so convert the keycodes back.
+        return {int(k): v for k, v in json.load(f).items()}
+    except Exception as e:
+      return None
+
+  def save_cached_keymap(self, key, m):
+    try:
+      os.makedirs(self.keymap_cache_dir, exist_ok=True)
+      tmp_path = self.get_keymap_cache_path(key) + ".tmp"
+      with open(tmp_path, 'w') as f:
+        json.dump(m, f)
+      os.replace(tmp_path, self.get_keymap_cache_path(key))
+    except Exception as e:
+      sys.stdout.write("Unable to save keymap cache: " + str(e) + ".\n")
+
+  def load_keymap(self):
+    #  Returns the keymap from the cache if the console keymap files haven't changed.  Otherwise
+    #  runs dumpkeys and caches the parsed result, keyed on the keymap files or, if there are
+    #  none, on the dumpkeys output (which at least saves parsing it again).
+    key = self.get_keymap_source_hash()
+    if key is not None:
+      m = self.load_cached_keymap(key)
+      if m:
+        if self.debug:
+          sys.stdout.write("Using cached keymap " + self.get_keymap_cache_path(key) + "\n")
+        return m
+    s = self.get_keymap_as_string()
+    if not s:
+      sys.stdout.write("Unable to obtain keycode map, perhaps you need to use 'sudo'?\n")
+      return None
+    if key is None:
+      key = hashlib.sha1(s.encode("utf-8")).hexdigest()
+      m = self.load_cached_keymap(key)
+      if m:
+        return m
+    m = self.parse_keymap_file(s)
+    if m:
+      self.save_cached_keymap(key, m)
+    else:
+      sys.stdout.write("Error while decoding keycode map.\n")
+    return m
+
   def has_a_keyboard(self, f):
     #  Looking inside the linux kernel in include/uapi/linux/kd.h,
     #  it looks like the kernel defines all of
@@ -158,49 +237,69 @@ class PyKeyUpKeyDown(object):
   
   def get_next_key_event(self):
     if self.fd:
-      buf = bytearray(os.read(self.fd, 1))
-      return self.key_process(buf)
+      while True:
+        buf = bytearray(os.read(self.fd, 1))
+        events = self.key_events(buf)
+        if len(events):
+          return events[-1]
     else:
       return None
 
-  def key_process(self, buf):
+  def make_key_event(self, kc, s):
+    return {
+      'keycode': kc,
+      'key': (self.keymap_table[kc] if kc < len(self.keymap_table) else None),
+      'is_up': bool(s)
+    }
+
+  def key_events(self, buf):
+    #  Returns every key event in 'buf', in order.  A 3 byte keycode that is cut off
+    #  at the end of 'buf' is kept and finished by the next call.
+    if len(self.partial_scancode):
+      buf = self.partial_scancode + buf
+      self.partial_scancode = bytearray(b'')
+    events = []
     i_c = 0
     while i_c < len(buf):
       s = (buf[i_c+0] & 0x80)
   
       #  This calculation is implemented in showkey.c of the kdb package.
       #  I think it has a dependency on having at least a 2.6 kernel.
-      if i_c + 2 < len(buf) and (buf[i_c+0] & 0x7f) == 0 and (buf[i_c+1] & 0x80 != 0) and (buf[i_c+2] & 0x80 != 0):
-        kc = (buf[i_c+1] & 0x7f) << 7 | (buf[i_c+2] & 0x7f)
-        i_c += 3
-      else:
-        kc = (buf[i_c] & 0x7f)
-        i_c += 1
+      if (buf[i_c+0] & 0x7f) == 0:
+        if i_c + 2 < len(buf):
+          if (buf[i_c+1] & 0x80 != 0) and (buf[i_c+2] & 0x80 != 0):
+            kc = (buf[i_c+1] & 0x7f) << 7 | (buf[i_c+2] & 0x7f)
+            events.append(self.make_key_event(kc, s))
+            i_c += 3
+            continue
+        elif all((b & 0x80) != 0 for b in buf[i_c+1:]):
+          #  Could still become a 3 byte keycode once the rest arrives.
+          self.partial_scancode = bytearray(buf[i_c:])
+          break
+      kc = (buf[i_c] & 0x7f)
+      events.append(self.make_key_event(kc, s))
+      i_c += 1
 
-    return {
-      'keycode': kc,
-      'key': (self.keymap[kc] if kc in self.keymap else None),
-      'is_up': bool(s)
-    }
+    return events
+
+  def key_process(self, buf):
+    #  Only returns the last event in 'buf', use key_events to get all of them.
+    events = self.key_events(buf)
+    return events[-1] if len(events) else None
   
   def setup_keylisten(self):
-    s = self.get_keymap_as_string()
-    if s:
-      self.keymap = self.parse_keymap_file(s)
-      if self.keymap:
-        if self.debug:
-          for k in self.keymap:
-            sys.stdout.write("Keycode %u maps to key %s\n" % (k, self.keymap[k]))
-        try:
-          self.modeset()
-        except Exception as e:
-          traceback.print_exc()
-          sys.stdout.write("An exception happend when while listening to keycodes: " + str(e) + ".\n")
-          return False
-      else:
-        sys.stdout.write("Error while decoding keycode map.\n")
+    keymap = self.load_keymap()
+    if keymap:
+      self.set_keymap(keymap)
+      if self.debug:
+        for k in self.keymap:
+          sys.stdout.write("Keycode %u maps to key %s\n" % (k, self.keymap[k]))
+      try:
+        self.modeset()
+      except Exception as e:
+        traceback.print_exc()
+        sys.stdout.write("An exception happend when while listening to keycodes: " + str(e) + ".\n")
         return False
     else:
-      sys.stdout.write("Unable to obtain keycode map, perhaps you need to use 'sudo'?\n")
       return False
     return True
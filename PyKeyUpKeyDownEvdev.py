@@ -0,0 +1,137 @@
+import os
+import re
+import sys
+import glob
+import fcntl
+import struct
+import traceback
+from PyKeyUpKeyDown import PyKeyUpKeyDown
+
+class PyKeyUpKeyDownEvdev(PyKeyUpKeyDown):
+  #  Alternative to PyKeyUpKeyDown that reads 'struct input_event' records from a
+  #  /dev/input/event* device instead of putting a VT into K_MEDIUMRAW mode.  This works
+  #  from an X/Wayland session or over SSH as long as the user can read the device, and
+  #  every event carries the kernel's timestamp.  Events are the same dicts as
+  #  PyKeyUpKeyDown produces with an extra 'time' key (seconds, CLOCK_MONOTONIC when the
+  #  kernel supports switching clocks, otherwise CLOCK_REALTIME).
+  def __init__(self, debug=False, device_path=None, grab=False):
+    PyKeyUpKeyDown.__init__(self, debug)
+    #  All of the following constants are defined in
+    #  the Linux kernel: include/uapi/linux/input.h and input-event-codes.h
+    self.EV_KEY = 0x01
+    self.EVIOCGRAB = 0x40044590  #  Exclusive access to the device.
+    self.EVIOCSCLOCKID = 0x400445a0  #  Set the clock used for event timestamps.
+    self.CLOCK_MONOTONIC = 1
+    self.KEY_VALUE_UP = 0
+    self.KEY_VALUE_DOWN = 1
+    #  struct timeval is two longs, followed by __u16 type, __u16 code, __s32 value.
+    self.input_event_struct = struct.Struct("llHHi")
+    self.device_path = device_path
+    self.grab = grab
+    self.grabbed = False
+    #  Part of an event record left over at the end of a read, only happens with pipes.
+    self.partial_event = bytearray(b'')
+
+  def get_default_keymap(self):
+    #  Used when 'dumpkeys' isn't available, for example without root or a console.
+    #  Names match what dumpkeys prints for a US layout.
+    m = {1: 'Escape', 28: 'Return', 57: 'space', 103: 'Up', 105: 'Left', 106: 'Right', 108: 'Down'}
+    for row, first_keycode in [('qwertyuiop', 16), ('asdfghjkl', 30), ('zxcvbnm', 44)]:
+      for i, c in enumerate(row):
+        m[first_keycode + i] = '+' + c
+    for i, name in enumerate(['one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine', 'zero']):
+      m[2 + i] = name
+    return m
+
+  def find_keyboard_device(self):
+    #  Look through /proc/bus/input/devices for the first device with a 'kbd' handler
+    #  that supports key repeat (EV_REP), which rules out power buttons and the like.
+    try:
+      with open('/proc/bus/input/devices') as f:
+        blocks = f.read().split('\n\n')
+    except Exception as e:
+      sys.stdout.write("Unable to read /proc/bus/input/devices: " + str(e) + "\n")
+      return None
+    for block in blocks:
+      handlers = re.search(r"^H: Handlers=(.*)$", block, re.MULTILINE)
+      ev = re.search(r"^B: EV=([0-9a-fA-F]+)$", block, re.MULTILINE)
+      if handlers and ev and 'kbd' in handlers.group(1).split():
+        if int(ev.group(1), 16) & (1 << 20):
+          for h in handlers.group(1).split():
+            if h.startswith('event'):
+              return '/dev/input/' + h
+    return None
+
+  def use_file_descriptor(self, fd):
+    #  Read events from an already open descriptor, like the read end of a pipe replaying a recording.
+    self.fd = fd
+    if not len(self.keymap):
+      self.set_keymap(self.get_default_keymap())
+
+  def setup_keylisten(self):
+    keymap = self.load_keymap()
+    if not keymap:
+      sys.stdout.write("Using the built in keymap.\n")
+      keymap = self.get_default_keymap()
+    self.set_keymap(keymap)
+    path = self.device_path if self.device_path is not None else self.find_keyboard_device()
+    if path is None:
+      sys.stdout.write("No keyboard input device found in /dev/input (" + ", ".join(sorted(glob.glob('/dev/input/event*'))) + ").\n")
+      return False
+    try:
+      self.fd = os.open(path, os.O_RDONLY, 0)
+    except Exception as e:
+      sys.stdout.write("Unable to open " + path + ": " + str(e) + ".  Perhaps you need to be in the 'input' group?\n")
+      return False
+    if self.debug:
+      sys.stdout.write("Reading key events from " + path + "\n")
+    try:
+      fcntl.ioctl(self.fd, self.EVIOCSCLOCKID, struct.pack("i", self.CLOCK_MONOTONIC))
+    except Exception as e:
+      pass  #  Older kernels, timestamps stay on CLOCK_REALTIME.
+    if self.grab:
+      try:
+        fcntl.ioctl(self.fd, self.EVIOCGRAB, 1)
+        self.grabbed = True
+      except Exception as e:
+        traceback.print_exc()
+        sys.stdout.write("Unable to grab " + path + ": " + str(e) + ".\n")
+    return True
+
+  def cleanup(self):
+    if self.fd is not None:
+      if self.grabbed:
+        try:
+          fcntl.ioctl(self.fd, self.EVIOCGRAB, 0)
+        except Exception as e:
+          pass
+        self.grabbed = False
+      os.close(self.fd)
+      self.fd = None
+
+  def get_next_key_event(self):
+    if self.fd:
+      while True:
+        buf = bytearray(os.read(self.fd, self.input_event_struct.size * 64))
+        events = self.key_events(buf)
+        if len(events):
+          return events[-1]
+    else:
+      return None
+
+  def key_events(self, buf):
+    if len(self.partial_event):
+      buf = self.partial_event + buf
+      self.partial_event = bytearray(b'')
+    size = self.input_event_struct.size
+    whole = len(buf) - (len(buf) % size)
+    if whole < len(buf):
+      self.partial_event = bytearray(buf[whole:])
+    events = []
+    for tv_sec, tv_usec, event_type, code, value in self.input_event_struct.iter_unpack(memoryview(buf)[0:whole]):
+      #  Auto repeat (value 2) is skipped, the key is already down.
+      if event_type == self.EV_KEY and (value == self.KEY_VALUE_UP or value == self.KEY_VALUE_DOWN):
+        e = self.make_key_event(code, value == self.KEY_VALUE_UP)
+        e['time'] = tv_sec + tv_usec / 1000000.0
+        events.append(e)
+    return events
@@ -0,0 +1,67 @@
+import asyncio
+import socket
+from RobotTankConnectionManager import RobotTankMessageDecoder
+from RobotTankLog import get_logger
+
+#  asyncio version of the robot tank link.  It uses the same framing and message
+#  encodings as RobotTankConnectionManager, so an asyncio client can talk to a
+#  poll based server and the other way around.  Use it when other work such as
+#  telemetry or watchdogs needs to run in the same event loop.
+
+def new_event_loop():
+  #  uvloop is optional, use it if it's installed.
+  try:
+    import uvloop
+    return uvloop.new_event_loop()
+  except ImportError:
+    return asyncio.new_event_loop()
+
+class RobotTankProtocol(asyncio.Protocol):
+  def __init__(self, on_message, on_connection_lost=None):
+    self.on_message = on_message  #  Called as on_message(protocol, message) for every decoded message.
+    self.on_connection_lost = on_connection_lost
+    self.decoder = RobotTankMessageDecoder()
+    self.transport = None
+
+  def connection_made(self, transport):
+    self.transport = transport
+
+  def data_received(self, data):
+    self.decoder.feed(data)
+    for m in self.decoder.messages():
+      self.on_message(self, m)
+
+  def connection_lost(self, exc):
+    self.transport = None
+    if self.on_connection_lost is not None:
+      self.on_connection_lost(self, exc)
+
+  def send_message(self, message):
+    #  'message' is anything with a serialize() method, like RobotTankMessage or RobotTankBinaryMessage.
+    if self.transport is not None:
+      self.transport.write(message.serialize())
+      return True
+    else:
+      get_logger().warning("Did not send message, not connected")
+      return False
+
+  def close(self):
+    if self.transport is not None:
+      self.transport.close()
+
+async def start_robot_tank_server(address, port, on_message, on_connection_lost=None):
+  loop = asyncio.get_running_loop()
+  return await loop.create_server(lambda: RobotTankProtocol(on_message, on_connection_lost), address, port)
+
+async def open_robot_tank_connection(host, port, on_message, on_connection_lost=None):
+  loop = asyncio.get_running_loop()
+  transport, protocol = await loop.create_connection(lambda: RobotTankProtocol(on_message, on_connection_lost), host, port)
+  return protocol
+
+async def open_loopback_pair(server_on_message, client_on_message):
+  #  In-process harness:  a server and client protocol connected by a socketpair in the running loop.
+  loop = asyncio.get_running_loop()
+  server_sock, client_sock = socket.socketpair()
+  server_transport, server_protocol = await loop.connect_accepted_socket(lambda: RobotTankProtocol(server_on_message), server_sock)
+  client_transport, client_protocol = await loop.create_connection(lambda: RobotTankProtocol(client_on_message), sock=client_sock)
+  return server_protocol, client_protocol
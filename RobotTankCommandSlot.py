@@ -0,0 +1,190 @@
+import os
+import mmap
+import stat
+import time
+import struct
+from RobotTankConnectionManager import ROBOT_TANK_DIRECTIONS
+
+#  Shared memory command slot, so programs running on the robot itself (line followers, obstacle
+#  avoidance) can drive the tank at kHz rates without sockets or JSON.  The slot is a small file,
+#  normally on tmpfs, mapped by the server and by one writer:
+#
+#    magic        8 bytes, ROBOT_TANK_COMMAND_SLOT_MAGIC
+#    sequence     uint32, odd while the writer is in the middle of writing a command
+#    timestamp    uint64, the writer's monotonic clock in microseconds
+#    pressed      uint8, bitmask of the held directions, bit i is ROBOT_TANK_DIRECTIONS[i]
+#    most_recent  uint8, index of the most recently pressed direction, 0xFF for none
+#    throttle     uint8, percent, or 0xFF to leave the throttle as it is
+#    (1 byte padding)
+#    sequence     uint32, the sequence again
+#
+#  all little endian.  It's a seqlock:  the writer makes the sequence odd, writes the command, then
+#  writes the next even sequence at the end and then at the start.  A command read between two
+#  reads of the same even sequence, which also matches the one at the end, wasn't torn.  After each
+#  command the writer writes a byte into the FIFO at '<path>.wake', which wakes the server's event
+#  loop.  Writers that don't, the server can instead poll for on a timer.
+ROBOT_TANK_COMMAND_SLOT_MAGIC = b'RTSLOT01'
+ROBOT_TANK_COMMAND_SLOT_PATH = '/dev/shm/robot_tank_command'
+ROBOT_TANK_COMMAND_SLOT_STRUCT = struct.Struct("<8sIQBBBxI")
+ROBOT_TANK_COMMAND_SLOT_SEQUENCE = struct.Struct("<I")
+ROBOT_TANK_COMMAND_SLOT_BODY = struct.Struct("<QBBB")
+ROBOT_TANK_COMMAND_SLOT_SEQUENCE_OFFSET = 8
+ROBOT_TANK_COMMAND_SLOT_BODY_OFFSET = 12
+ROBOT_TANK_COMMAND_SLOT_END_OFFSET = 24
+ROBOT_TANK_COMMAND_SLOT_NONE = 0xFF
+
+class RobotTankCommand(object):
+  #  One command from the slot.  'pressed' and 'most_recent' are direction names like in
+  #  RobotTankControlDatagram, so the server applies both the same way.  'throttle' is None to
+  #  leave it as it is.  serialize() and decode() are for the journal.
+  payload_struct = struct.Struct("<IQBBB")
+
+  def __init__(self, sequence_number, timestamp_us, pressed, most_recent=None, throttle=None):
+    self.sequence_number = sequence_number
+    self.timestamp_us = timestamp_us
+    self.pressed = pressed
+    self.most_recent = most_recent
+    self.throttle = throttle
+
+  @classmethod
+  def from_fields(cls, sequence_number, timestamp_us, bitmask, most_recent, throttle):
+    pressed = [d for i, d in enumerate(ROBOT_TANK_DIRECTIONS) if bitmask & (1 << i)]
+    most_recent = ROBOT_TANK_DIRECTIONS[most_recent] if most_recent < len(ROBOT_TANK_DIRECTIONS) else None
+    return cls(sequence_number, timestamp_us, pressed, most_recent, None if throttle == ROBOT_TANK_COMMAND_SLOT_NONE else throttle)
+
+  def serialize(self):
+    bitmask = 0
+    for d in self.pressed:
+      bitmask |= 1 << ROBOT_TANK_DIRECTIONS.index(d)
+    return self.payload_struct.pack(
+      self.sequence_number,
+      self.timestamp_us,
+      bitmask,
+      ROBOT_TANK_COMMAND_SLOT_NONE if self.most_recent is None else ROBOT_TANK_DIRECTIONS.index(self.most_recent),
+      ROBOT_TANK_COMMAND_SLOT_NONE if self.throttle is None else self.throttle
+    )
+
+  @classmethod
+  def decode(cls, payload):
+    if len(payload) != cls.payload_struct.size:
+      return None
+    return cls.from_fields(*cls.payload_struct.unpack(payload))
+
+def make_wake_path(path):
+  return path + '.wake'
+
+class RobotTankCommandSlot(object):
+  #  The server's end.  Creates the slot and its wake FIFO if they aren't there yet, and read()
+  #  returns each new command once.  A command already in the slot when the server starts is
+  #  left alone, it could be from long ago.  An existing file is only made into a slot if it is
+  #  empty or all zero bytes and no bigger than a slot, so a wrong path never overwrites anything.
+  def __init__(self, path=ROBOT_TANK_COMMAND_SLOT_PATH):
+    self.path = path
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o660)
+    try:
+      size = os.fstat(fd).st_size
+      header = os.pread(fd, ROBOT_TANK_COMMAND_SLOT_STRUCT.size, 0)
+      is_slot = size >= ROBOT_TANK_COMMAND_SLOT_STRUCT.size and header[0:len(ROBOT_TANK_COMMAND_SLOT_MAGIC)] == ROBOT_TANK_COMMAND_SLOT_MAGIC
+      if not is_slot and (size > ROBOT_TANK_COMMAND_SLOT_STRUCT.size or header.strip(b'\x00')):
+        raise Exception(path + " is not a robot tank command slot.")
+      if size < ROBOT_TANK_COMMAND_SLOT_STRUCT.size:
+        os.ftruncate(fd, ROBOT_TANK_COMMAND_SLOT_STRUCT.size)
+      self.map = mmap.mmap(fd, ROBOT_TANK_COMMAND_SLOT_STRUCT.size)
+    finally:
+      os.close(fd)
+    if not is_slot:
+      ROBOT_TANK_COMMAND_SLOT_STRUCT.pack_into(self.map, 0, ROBOT_TANK_COMMAND_SLOT_MAGIC, 0, 0, 0, ROBOT_TANK_COMMAND_SLOT_NONE, ROBOT_TANK_COMMAND_SLOT_NONE, 0)
+    self.last_sequence_number = ROBOT_TANK_COMMAND_SLOT_SEQUENCE.unpack_from(self.map, ROBOT_TANK_COMMAND_SLOT_SEQUENCE_OFFSET)[0] & ~1
+    wake_path = make_wake_path(path)
+    if not os.path.exists(wake_path):
+      os.mkfifo(wake_path, 0o660)
+    elif not stat.S_ISFIFO(os.stat(wake_path).st_mode):
+      raise Exception(wake_path + " exists and isn't a FIFO.")
+    self.wake_fd = os.open(wake_path, os.O_RDONLY | os.O_NONBLOCK)
+    #  Held open so the FIFO never reports end of file (or POLLHUP) while no writer has it open.
+    self.wake_write_fd = os.open(wake_path, os.O_WRONLY | os.O_NONBLOCK)
+    self.counters = {'commands': 0, 'torn_reads': 0}
+
+  def read(self):
+    #  Returns a RobotTankCommand if there is one that hasn't been read yet, otherwise None.  If
+    #  the writer is in the middle of a write this also returns None, its wakeup follows.
+    sequence_number, timestamp_us, bitmask, most_recent, throttle, end_sequence_number = ROBOT_TANK_COMMAND_SLOT_STRUCT.unpack_from(self.map, 0)[1:]
+    if sequence_number == self.last_sequence_number:
+      return None
+    if sequence_number & 1 or sequence_number != end_sequence_number or sequence_number != ROBOT_TANK_COMMAND_SLOT_SEQUENCE.unpack_from(self.map, ROBOT_TANK_COMMAND_SLOT_SEQUENCE_OFFSET)[0]:
+      self.counters['torn_reads'] += 1
+      return None
+    self.last_sequence_number = sequence_number
+    self.counters['commands'] += 1
+    return RobotTankCommand.from_fields(sequence_number, timestamp_us, bitmask, most_recent, throttle)
+
+  def close(self):
+    os.close(self.wake_fd)
+    os.close(self.wake_write_fd)
+    self.map.close()
+
+class RobotTankCommandSlotWriter(object):
+  #  The controlling program's end.  There must only be one writer at a time.
+  def __init__(self, path=ROBOT_TANK_COMMAND_SLOT_PATH, clock=time.monotonic):
+    self.clock = clock
+    fd = os.open(path, os.O_RDWR)
+    try:
+      self.map = mmap.mmap(fd, ROBOT_TANK_COMMAND_SLOT_STRUCT.size)
+    finally:
+      os.close(fd)
+    if self.map[0:len(ROBOT_TANK_COMMAND_SLOT_MAGIC)] != ROBOT_TANK_COMMAND_SLOT_MAGIC:
+      self.map.close()
+      raise Exception(path + " is not a robot tank command slot.")
+    #  Carry on from the sequence already there, rounded up in case a writer died halfway.
+    self.sequence_number = (ROBOT_TANK_COMMAND_SLOT_SEQUENCE.unpack_from(self.map, ROBOT_TANK_COMMAND_SLOT_SEQUENCE_OFFSET)[0] + 1) & ~1
+    #  Opening the FIFO for writing fails while the server doesn't have it open, so it's retried on each wake.
+    self.wake_path = make_wake_path(path)
+    self.wake_fd = None
+    self.counters = {'commands': 0, 'wakes': 0, 'wakes_pending': 0, 'wake_errors': 0}
+
+  def write(self, pressed, most_recent=None, throttle=None, wake=True):
+    #  'pressed' is a list of direction names, 'most_recent' one of them or None, and 'throttle'
+    #  a whole percent from 0 to 100 or None.  Everything is checked before the slot is touched,
+    #  so a bad command never leaves it in the middle of a write.
+    bitmask = 0
+    for d in pressed:
+      if d not in ROBOT_TANK_DIRECTIONS:
+        raise Exception("Unknown direction " + str(d) + ".")
+      bitmask |= 1 << ROBOT_TANK_DIRECTIONS.index(d)
+    if most_recent is not None and most_recent not in pressed:
+      raise Exception("The most recent direction " + str(most_recent) + " isn't pressed.")
+    if throttle is not None and (not isinstance(throttle, int) or throttle < 0 or throttle > 100):
+      raise Exception("Throttle " + str(throttle) + " isn't a whole percent from 0 to 100.")
+    body = ROBOT_TANK_COMMAND_SLOT_BODY.pack(
+      int(self.clock() * 1000000),
+      bitmask,
+      ROBOT_TANK_COMMAND_SLOT_NONE if most_recent is None else ROBOT_TANK_DIRECTIONS.index(most_recent),
+      ROBOT_TANK_COMMAND_SLOT_NONE if throttle is None else throttle
+    )
+    sequence_number = (self.sequence_number + 1) & 0xFFFFFFFF
+    ROBOT_TANK_COMMAND_SLOT_SEQUENCE.pack_into(self.map, ROBOT_TANK_COMMAND_SLOT_SEQUENCE_OFFSET, sequence_number)
+    self.map[ROBOT_TANK_COMMAND_SLOT_BODY_OFFSET:ROBOT_TANK_COMMAND_SLOT_BODY_OFFSET + len(body)] = body
+    sequence_number = (sequence_number + 1) & 0xFFFFFFFF
+    ROBOT_TANK_COMMAND_SLOT_SEQUENCE.pack_into(self.map, ROBOT_TANK_COMMAND_SLOT_END_OFFSET, sequence_number)
+    ROBOT_TANK_COMMAND_SLOT_SEQUENCE.pack_into(self.map, ROBOT_TANK_COMMAND_SLOT_SEQUENCE_OFFSET, sequence_number)
+    self.sequence_number = sequence_number
+    self.counters['commands'] += 1
+    if wake:
+      self.wake()
+
+  def wake(self):
+    try:
+      if self.wake_fd is None:
+        self.wake_fd = os.open(self.wake_path, os.O_WRONLY | os.O_NONBLOCK)
+      os.write(self.wake_fd, b'\x01')
+      self.counters['wakes'] += 1
+    except BlockingIOError:
+      self.counters['wakes_pending'] += 1  #  The FIFO is full of wakeups the server hasn't read yet.
+    except OSError as e:
+      self.counters['wake_errors'] += 1
+
+  def close(self):
+    if self.wake_fd is not None:
+      os.close(self.wake_fd)
+      self.wake_fd = None
+    self.map.close()
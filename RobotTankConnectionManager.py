@@ -1,12 +1,33 @@
 import socket
 import select
-import sys
 import struct
 import json
 import os
+import time
+import stat
+import errno
+import heapq
+import random
 import traceback
+import collections
+from RobotTankLog import get_logger
+from RobotTankLog import ROBOT_TANK_LOG_DEBUG
 
 ROBOT_TANK_HELLO_MESSAGE = 1
+ROBOT_TANK_KEYBOARD_EVENT_MESSAGE = 2
+ROBOT_TANK_CONTROL_STATE_MESSAGE = 3
+
+#  Bit order used for direction bitmasks.
+ROBOT_TANK_DIRECTIONS = ['forward', 'reverse', 'left', 'right']
+
+#  Wire formats that can be negotiated with a 'hello' message, most preferred first.
+ROBOT_TANK_WIRE_FORMAT_JSON = 'json'
+ROBOT_TANK_WIRE_FORMAT_BINARY = 'binary1'
+ROBOT_TANK_WIRE_FORMATS = [ROBOT_TANK_WIRE_FORMAT_BINARY, ROBOT_TANK_WIRE_FORMAT_JSON]
+
+ROBOT_TANK_BINARY_VERSION = 1
+ROBOT_TANK_BINARY_FLAG_IS_UP = 0x01
+ROBOT_TANK_BINARY_FLAG_STAMPED = 0x02
 
 class RobotTankMessage(object):
   def __init__(self, o):
@@ -17,21 +38,563 @@ class RobotTankMessage(object):
     s_enc = s.encode()
     return struct.pack("I", len(s_enc)) + bytearray(s_enc)
 
+class RobotTankBinaryMessage(object):
+  #  Fixed size alternative to the JSON encoding of keyboard events.  The payload is in network
+  #  byte order:  version, message type, flags, keycode, sequence number.  Frames keep the same
+  #  length prefix as RobotTankMessage so both encodings can share a connection, and the version
+  #  byte can never be confused with the '{' that starts a JSON payload.  With a 'timestamp_us'
+  #  the STAMPED flag is set and the sender's monotonic clock in microseconds is appended.
+  payload_struct = struct.Struct("!BBBHI")
+  stamped_payload_struct = struct.Struct("!BBBHIQ")
+  header = struct.pack("I", payload_struct.size)
+  stamped_header = struct.pack("I", stamped_payload_struct.size)
+
+  def __init__(self, keyboard_event, sequence_number, timestamp_us=None):
+    self.keyboard_event = keyboard_event
+    self.sequence_number = sequence_number
+    self.timestamp_us = timestamp_us
+
+  def serialize(self):
+    flags = ROBOT_TANK_BINARY_FLAG_IS_UP if self.keyboard_event['is_up'] else 0
+    if self.timestamp_us is not None:
+      return self.stamped_header + self.stamped_payload_struct.pack(
+        ROBOT_TANK_BINARY_VERSION,
+        ROBOT_TANK_KEYBOARD_EVENT_MESSAGE,
+        flags | ROBOT_TANK_BINARY_FLAG_STAMPED,
+        self.keyboard_event['keycode'],
+        self.sequence_number & 0xFFFFFFFF,
+        self.timestamp_us
+      )
+    return self.header + self.payload_struct.pack(
+      ROBOT_TANK_BINARY_VERSION,
+      ROBOT_TANK_KEYBOARD_EVENT_MESSAGE,
+      flags,
+      self.keyboard_event['keycode'],
+      self.sequence_number & 0xFFFFFFFF
+    )
+
+  @classmethod
+  def decode(cls, payload):
+    timestamp_us = None
+    if len(payload) == cls.payload_struct.size:
+      version, message_type, flags, keycode, sequence_number = cls.payload_struct.unpack(payload)
+    elif len(payload) == cls.stamped_payload_struct.size:
+      version, message_type, flags, keycode, sequence_number, timestamp_us = cls.stamped_payload_struct.unpack(payload)
+    else:
+      get_logger().warning("Robot tank binary message has wrong size", size=len(payload))
+      return None
+    if message_type == ROBOT_TANK_KEYBOARD_EVENT_MESSAGE:
+      #  The binary format doesn't carry key names, the receiver looks them up using the keymap from the hello message.
+      e = {
+        'keycode': keycode,
+        'key': None,
+        'is_up': bool(flags & ROBOT_TANK_BINARY_FLAG_IS_UP),
+        'seq': sequence_number
+      }
+      if timestamp_us is not None:
+        e['t'] = timestamp_us
+      return {'keyboard_event': e}
+    else:
+      get_logger().warning("Unknown robot tank binary message type", type=message_type)
+      return None
+
+class RobotTankControlDatagram(object):
+  #  Snapshot of every direction the operator is holding, sent over UDP.  Each datagram carries
+  #  the full state rather than a key up/down delta, so any one datagram that arrives is enough
+  #  to bring the server up to date.  Network byte order:  version, message type, session id,
+  #  sequence number, sender timestamp in microseconds, pressed direction bitmask, most recently
+  #  pressed direction (0xFF for none).
+  payload_struct = struct.Struct("!BBIIQBB")
+  NO_DIRECTION = 0xFF
+
+  def __init__(self, session, sequence_number, pressed, most_recent=None, timestamp_us=0):
+    self.session = session
+    self.sequence_number = sequence_number
+    self.pressed = pressed
+    self.most_recent = most_recent
+    self.timestamp_us = timestamp_us
+
+  def serialize(self):
+    bitmask = 0
+    for d in self.pressed:
+      bitmask |= 1 << ROBOT_TANK_DIRECTIONS.index(d)
+    return self.payload_struct.pack(
+      ROBOT_TANK_BINARY_VERSION,
+      ROBOT_TANK_CONTROL_STATE_MESSAGE,
+      self.session & 0xFFFFFFFF,
+      self.sequence_number & 0xFFFFFFFF,
+      self.timestamp_us & 0xFFFFFFFFFFFFFFFF,
+      bitmask,
+      self.NO_DIRECTION if self.most_recent is None else ROBOT_TANK_DIRECTIONS.index(self.most_recent)
+    )
+
+  @classmethod
+  def decode(cls, payload):
+    if len(payload) != cls.payload_struct.size:
+      get_logger().warning("Robot tank control datagram has wrong size", size=len(payload))
+      return None
+    version, message_type, session, sequence_number, timestamp_us, bitmask, most_recent = cls.payload_struct.unpack(payload)
+    if version != ROBOT_TANK_BINARY_VERSION or message_type != ROBOT_TANK_CONTROL_STATE_MESSAGE:
+      get_logger().warning("Unknown robot tank control datagram", version=version, type=message_type)
+      return None
+    pressed = [d for i, d in enumerate(ROBOT_TANK_DIRECTIONS) if bitmask & (1 << i)]
+    most_recent = ROBOT_TANK_DIRECTIONS[most_recent] if most_recent < len(ROBOT_TANK_DIRECTIONS) else None
+    return cls(session, sequence_number, pressed, most_recent, timestamp_us)
+
+class RobotTankSequenceFilter(object):
+  #  Drops datagrams that aren't newer than the newest one already accepted from the same sender.
+  #  A new session id (the sender restarted) resets the sequence.
+  def __init__(self):
+    self.latest = {}
+    self.dropped = 0
+
+  def accept(self, sender, session, sequence_number):
+    if sender in self.latest:
+      last_session, last_sequence_number = self.latest[sender]
+      #  Serial number arithmetic so that wrap around at 2^32 still counts as newer.
+      if last_session == session and not (0 < ((sequence_number - last_sequence_number) & 0xFFFFFFFF) < 0x80000000):
+        self.dropped += 1
+        return False
+    self.latest[sender] = (session, sequence_number)
+    return True
+
+class RobotTankControlSender(object):
+  #  Tracks which directions are held and sends RobotTankControlDatagram snapshots on a UDP
+  #  socket, immediately on every change and then redundantly at 'rate_hz' so that a lost
+  #  datagram is covered by the next one.
+  def __init__(self, connection_manager, fd, rate_hz):
+    self.connection_manager = connection_manager
+    self.fd = fd
+    self.session = random.getrandbits(32)
+    self.sequence_number = 0
+    self.held = []  #  In the order they were pressed.
+    self.timer = connection_manager.call_every(1.0 / rate_hz, self.send_state)
+
+  def update_direction(self, direction, pressed):
+    #  Returns True if the held directions changed, without sending anything.
+    if pressed and direction not in self.held:
+      self.held.append(direction)
+      return True
+    elif not pressed and direction in self.held:
+      self.held.remove(direction)
+      return True
+    return False
+
+  def set_direction(self, direction, pressed):
+    if self.update_direction(direction, pressed):
+      self.send_state()
+
+  def send_state(self):
+    self.sequence_number += 1
+    d = RobotTankControlDatagram(
+      self.session,
+      self.sequence_number,
+      self.held,
+      self.held[-1] if len(self.held) else None,
+      int(self.connection_manager.clock() * 1e6)
+    )
+    self.connection_manager.send_datagram(self.fd, d.serialize())
+
+  def stop(self):
+    self.timer.cancel()
+
+class RobotTankTimer(object):
+  def __init__(self, when, interval, callback):
+    self.when = when
+    self.interval = interval  #  None for one shot timers.
+    self.callback = callback
+    self.cancelled = False
+
+  def cancel(self):
+    self.cancelled = True
+
+class RobotTankBackoff(object):
+  #  Jittered exponential backoff for retrying connects.  Each delay is a random fraction (at
+  #  least 1 - 'jitter') of a step that starts at 'initial_delay' and doubles up to 'max_delay', so
+  #  clients that lost the same server don't all retry at the same moment.
+  def __init__(self, initial_delay=0.05, max_delay=5.0, multiplier=2.0, jitter=0.5, rng=None):
+    self.initial_delay = initial_delay
+    self.max_delay = max_delay
+    self.multiplier = multiplier
+    self.jitter = jitter
+    self.random = rng if rng is not None else random.Random()
+    self.reset()
+
+  def reset(self):
+    self.step = self.initial_delay
+
+  def next_delay(self):
+    delay = self.step * (1.0 - self.jitter * self.random.random())
+    self.step = min(self.max_delay, self.step * self.multiplier)
+    return delay
+
+class RobotTankMessageDecoder(object):
+  #  Incrementally extracts length prefixed RobotTankMessage frames from a stream of bytes.
+  #  Consumed frames are tracked with a read offset rather than by slicing the buffer,
+  #  and the buffer is only compacted once the consumed part of it gets large.
+  def __init__(self, buf=None, compact_threshold=4096):
+    self.buf = bytearray(b'') if buf is None else buf
+    self.offset = 0
+    self.compact_threshold = compact_threshold
+    self.header = struct.Struct("I")
+    #  Called with every frame's payload before it is decoded, for example to journal it.
+    self.payload_hook = None
+
+  def feed(self, by):
+    self.buf += by
+
+  def next_frame(self):
+    #  Returns the payload of the next complete frame, or None if there isn't one yet.
+    available = len(self.buf) - self.offset
+    if available < self.header.size:
+      return None  #  Not enough bytes to even read the size header.
+    message_size = self.header.unpack_from(self.buf, self.offset)[0]
+    if available - self.header.size < message_size:
+      return None  #  Frame is still incomplete.
+    start = self.offset + self.header.size
+    self.offset = start + message_size
+    return self.buf[start:self.offset]
+
+  def decode_payload(self, payload):
+    if len(payload) and payload[0] == ROBOT_TANK_BINARY_VERSION:
+      return RobotTankBinaryMessage.decode(payload)
+    try:
+      return json.loads(payload.decode("utf-8"))
+    except Exception as e:
+      get_logger().warning("Robot tank message decode error", error=e)
+      return None
+
+  def next_message(self):
+    while True:
+      payload = self.next_frame()
+      if payload is None:
+        self.compact()
+        return None
+      if self.payload_hook is not None:
+        self.payload_hook(payload)
+      m = self.decode_payload(payload)
+      if m is not None:
+        return m
+
+  def messages(self):
+    #  Yields every complete message currently in the buffer.
+    while True:
+      payload = self.next_frame()
+      if payload is None:
+        break
+      if self.payload_hook is not None:
+        self.payload_hook(payload)
+      m = self.decode_payload(payload)
+      if m is not None:
+        yield m
+    self.compact()
+
+  def compact(self):
+    if self.offset == len(self.buf):
+      del self.buf[:]
+      self.offset = 0
+    elif self.offset >= self.compact_threshold:
+      del self.buf[0:self.offset]
+      self.offset = 0
+
+  def remove_all(self):
+    tmp = self.buf[self.offset:]
+    del self.buf[:]
+    self.offset = 0
+    return tmp
+
+class RobotTankChunkQueue(object):
+  #  Output queue for one connection.  Queued data is kept as a list of chunks and the part of
+  #  the front chunk that has already been sent is tracked with an offset, so a partial send
+  #  never copies what is left.  Sends go out through memoryviews, several chunks per call with
+  #  sendmsg (or writev for plain file descriptors).
+  def __init__(self, max_chunks_per_send=64):
+    self.chunks = collections.deque()
+    self.offset = 0  #  Bytes of chunks[0] already sent.
+    self.size = 0
+    self.max_chunks_per_send = max_chunks_per_send
+
+  def __len__(self):
+    return self.size
+
+  def append(self, by):
+    if len(by):
+      #  bytes are kept as they are.  Anything mutable is copied once so the caller can reuse it.
+      self.chunks.append(by if isinstance(by, bytes) else bytes(by))
+      self.size += len(by)
+
+  def views(self):
+    v = [memoryview(self.chunks[0])[self.offset:]]
+    for i in range(1, min(len(self.chunks), self.max_chunks_per_send)):
+      v.append(memoryview(self.chunks[i]))
+    return v
+
+  def consume(self, n):
+    self.size -= n
+    while n > 0:
+      remaining = len(self.chunks[0]) - self.offset
+      if n >= remaining:
+        n -= remaining
+        self.chunks.popleft()
+        self.offset = 0
+      else:
+        self.offset += n
+        n = 0
+
+  def send(self, sock, fd=None):
+    #  One send call, returns the number of bytes sent.  Raises BlockingIOError when full.
+    if sock is None:
+      n = os.writev(fd, self.views())
+    elif len(self.chunks) > 1 and hasattr(sock, 'sendmsg'):
+      n = sock.sendmsg(self.views())
+    else:
+      n = sock.send(memoryview(self.chunks[0])[self.offset:])
+    self.consume(n)
+    return n
+
+  def clear(self):
+    self.chunks.clear()
+    self.offset = 0
+    self.size = 0
+
+ROBOT_TANK_CONNECTION_EVENTS = ['read', 'write', 'exception', 'close', 'pause_writing', 'resume_writing', 'connect']
+
+class RobotTankConnection(object):
+  #  One entry in the connection manager's socket_map.  Each event's callbacks are resolved
+  #  from the connection's classes whenever a class callback is registered, so dispatching an
+  #  event is a direct call through a tuple rather than a lookup per class.  Entries can still
+  #  be used like the dicts they replaced (socket_details['socket']), and keys that aren't
+  #  slots, like the server's 'keymap', are kept in 'extra'.
+  __slots__ = (
+    'fd', 'is_listen_socket', 'is_socket', 'is_datagram', 'edge_triggered', 'rearm_quickack',
+    'event_mask', 'out_queue', 'write_paused', 'decoder', 'datagrams', 'socket', 'address', 'port',
+    'last_read', 'last_write', 'read_started', 'classes', 'extra', 'connecting',
+    'read_callbacks', 'write_callbacks', 'exception_callbacks', 'close_callbacks',
+    'pause_writing_callbacks', 'resume_writing_callbacks', 'connect_callbacks'
+  )
+  slot_names = frozenset(__slots__)
+
+  def __init__(self, fd, sock, address, port, classes, event_mask, is_listen_socket=False, is_socket=True, is_datagram=False, edge_triggered=False, rearm_quickack=False, last_read=None, last_write=None, connecting=False):
+    self.fd = fd
+    self.socket = sock
+    self.address = address
+    self.port = port
+    self.classes = classes
+    self.event_mask = event_mask
+    self.is_listen_socket = is_listen_socket
+    self.is_socket = is_socket
+    self.is_datagram = is_datagram
+    self.edge_triggered = edge_triggered
+    self.rearm_quickack = rearm_quickack
+    self.last_read = last_read  #  Times used for the idle and write timeouts, None if they don't apply.
+    self.last_write = last_write
+    self.read_started = None  #  When the first read of the latest wakeup returned data, for latency stamps.
+    self.connecting = connecting  #  True until a non-blocking connect finishes.
+    self.out_queue = RobotTankChunkQueue()
+    self.write_paused = False
+    #  Datagrams are kept whole as (bytes, sender address) rather than appended to a byte stream.
+    self.decoder = None if is_datagram else RobotTankMessageDecoder()
+    self.datagrams = [] if is_datagram else None
+    self.extra = {}
+    for event in ROBOT_TANK_CONNECTION_EVENTS:
+      setattr(self, event + '_callbacks', ())
+
+  def __getitem__(self, key):
+    if key in self.slot_names:
+      return getattr(self, key)
+    return self.extra[key]
+
+  def __setitem__(self, key, value):
+    if key in self.slot_names:
+      setattr(self, key, value)
+    else:
+      self.extra[key] = value
+
+  def __contains__(self, key):
+    return key in self.slot_names or key in self.extra
+
+  def get(self, key, default=None):
+    if key in self.slot_names:
+      return getattr(self, key)
+    return self.extra.get(key, default)
+
+  def resolve_callbacks(self, class_callbacks, event):
+    callbacks = class_callbacks[event]
+    setattr(self, event + '_callbacks', tuple(callbacks[c] for c in self.classes if c in callbacks))
+
+class RobotTankPollSelector(object):
+  #  Level triggered backend built on select.poll().  Used where epoll isn't available.
+  def __init__(self):
+    self.poller = select.poll()
+
+  def register(self, fd, event_mask, edge_triggered=False):
+    self.poller.register(fd, event_mask)
+
+  def modify(self, fd, event_mask, edge_triggered=False):
+    self.poller.modify(fd, event_mask)
+
+  def unregister(self, fd):
+    self.poller.unregister(fd)
+
+  def poll(self, poll_timeout):
+    return self.poller.poll(poll_timeout)
+
+class RobotTankEpollSelector(object):
+  #  Backend built on select.epoll().  The EPOLL* flags have the same values as
+  #  the POLL* flags on Linux, so event masks can be passed straight through.
+  #  Connections can ask to be edge triggered so that a connection that is
+  #  readable or writable is only reported once per change instead of on every call.
+  def __init__(self):
+    self.poller = select.epoll()
+
+  def register(self, fd, event_mask, edge_triggered=False):
+    self.poller.register(fd, event_mask | (select.EPOLLET if edge_triggered else 0))
+
+  def modify(self, fd, event_mask, edge_triggered=False):
+    self.poller.modify(fd, event_mask | (select.EPOLLET if edge_triggered else 0))
+
+  def unregister(self, fd):
+    self.poller.unregister(fd)
+
+  def poll(self, poll_timeout):
+    #  poll() takes milliseconds, epoll takes seconds.
+    return self.poller.poll(-1 if poll_timeout is None or poll_timeout < 0 else poll_timeout / 1000.0)
+
+def make_default_selector():
+  if hasattr(select, 'epoll'):
+    return RobotTankEpollSelector()
+  else:
+    return RobotTankPollSelector()
+
+class RobotTankSocketOptions(object):
+  #  Socket options applied to the TCP sockets registered with the connection manager.
+  #  Defaults favour latency:  key events are tiny and should never wait behind Nagle's
+  #  algorithm or a delayed ACK.  Options the platform doesn't support are skipped.
+  IPTOS_LOWDELAY = 0x10
+
+  def __init__(self, nodelay=True, quickack=True, sndbuf=None, rcvbuf=None, keepalive=True, keepalive_idle=5, keepalive_interval=1, keepalive_count=3, low_delay_tos=True, user_timeout_ms=None):
+    self.nodelay = nodelay
+    self.quickack = quickack and hasattr(socket, 'TCP_QUICKACK')
+    self.sndbuf = sndbuf
+    self.rcvbuf = rcvbuf
+    self.keepalive = keepalive
+    self.keepalive_idle = keepalive_idle
+    self.keepalive_interval = keepalive_interval
+    self.keepalive_count = keepalive_count
+    self.low_delay_tos = low_delay_tos
+    #  TCP_USER_TIMEOUT:  the kernel drops the connection when sent data stays unacknowledged this
+    #  long.  Keepalives aren't sent while there is unacknowledged data, so they don't cover that case.
+    self.user_timeout_ms = user_timeout_ms
+
+  def is_tcp(self, sock):
+    return sock.family in (socket.AF_INET, socket.AF_INET6) and sock.type == socket.SOCK_STREAM
+
+  def set_option(self, sock, level, name, value):
+    try:
+      sock.setsockopt(level, name, value)
+    except Exception as e:
+      get_logger().warning("Unable to set socket option", name=name, value=value, error=e)
+
+  def apply(self, sock):
+    if not self.is_tcp(sock):
+      return
+    if self.nodelay:
+      self.set_option(sock, socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if self.quickack:
+      self.set_option(sock, socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+    if self.sndbuf is not None:
+      self.set_option(sock, socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+    if self.rcvbuf is not None:
+      self.set_option(sock, socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+    if self.keepalive:
+      self.set_option(sock, socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+      if hasattr(socket, 'TCP_KEEPIDLE'):
+        self.set_option(sock, socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepalive_idle)
+      if hasattr(socket, 'TCP_KEEPINTVL'):
+        self.set_option(sock, socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, self.keepalive_interval)
+      if hasattr(socket, 'TCP_KEEPCNT'):
+        self.set_option(sock, socket.IPPROTO_TCP, socket.TCP_KEEPCNT, self.keepalive_count)
+    if self.user_timeout_ms is not None and hasattr(socket, 'TCP_USER_TIMEOUT'):
+      self.set_option(sock, socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, self.user_timeout_ms)
+    if self.low_delay_tos and sock.family == socket.AF_INET:
+      self.set_option(sock, socket.IPPROTO_IP, socket.IP_TOS, self.IPTOS_LOWDELAY)
+
+  def rearm_quickack(self, sock):
+    #  Linux turns quickack mode back off by itself, so it needs to be set again after reading.
+    try:
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+    except Exception as e:
+      pass
+
 class RobotTankConnectionManager(object):
-  def __init__(self, debug=False, sigint_callback=None):
+  def __init__(self, debug=False, sigint_callback=None, recv_size=4096, read_budget=65536, selector=None, socket_options=None, try_send_immediately=True, clock=time.monotonic, idle_timeout=None, write_timeout=None, write_high_water=65536, write_low_water=16384, write_limit=4194304, logger=None):
     self.sigint_callback = sigint_callback
-    self.recv_size = 1
+    #  Everything is logged through a RobotTankLogger rather than printed, so a slow console can't hold up the loop.
+    self.log = logger if logger is not None else get_logger()
+    #  Size of each individual recv/read call.  All reads go into one preallocated
+    #  buffer so that draining a connection doesn't allocate a new bytes object per call.
+    self.recv_size = recv_size
+    self.recv_buffer = bytearray(recv_size)
+    self.recv_view = memoryview(self.recv_buffer)
+    #  Maximum number of bytes read from one connection per readiness event.  Anything
+    #  beyond this is left in the kernel buffer and picked up on the next call to run,
+    #  so that one busy connection can't starve all the others.
+    self.read_budget = read_budget
+    self.socket_options = RobotTankSocketOptions() if socket_options is None else socket_options
+    #  Try to send straight away from add_to_write_buffer when nothing is queued, instead of
+    #  waiting for the next write event.
+    self.try_send_immediately = try_send_immediately
+    #  Backpressure.  When a connection has 'write_high_water' bytes queued its 'pause_writing'
+    #  class callbacks run and 'write_paused' is set in its socket_map entry, and once the queue
+    #  drains to 'write_low_water' its 'resume_writing' callbacks run.  A connection that gets
+    #  more than 'write_limit' bytes behind is closed rather than queueing without bound.
+    self.write_high_water = write_high_water
+    self.write_low_water = write_low_water
+    self.write_limit = write_limit
     self.EXCEPTION_FLAGS = select.POLLHUP | select.POLLERR
     self.READ_FLAGS = select.POLLIN | select.POLLPRI
     self.WRITE_FLAGS = select.POLLOUT
     self.debug = debug
-    self.socket_map = {}
-    self.poller = select.poll()
-    self.class_callbacks = {
-      'read' : {},
-      'write' : {},
-      'exception' : {}
+    self.socket_map = {}  #  fd to RobotTankConnection.
+    self.poller = make_default_selector() if selector is None else selector
+    #  Edge triggered connections that still had data waiting when they ran out of read budget.
+    self.pending_reads = set()
+    #  Timers are kept in a heap of (when, counter, timer), 'clock' returns seconds.
+    self.clock = clock
+    self.timers = []
+    self.timer_counter = 0
+    #  Connections registered with register_socket are closed if nothing has been read from them
+    #  for 'idle_timeout' seconds, or if queued output hasn't moved for 'write_timeout' seconds,
+    #  which is what a peer that vanished without closing (a half-open connection) looks like.
+    #  None turns either check off.  The check runs on a timer only while there are connections.
+    self.idle_timeout = idle_timeout
+    self.write_timeout = write_timeout
+    self.timeout_timer = None
+    #  'close' callbacks run after a connection has been closed and removed from socket_map.
+    self.class_callbacks = dict((event, {}) for event in ROBOT_TANK_CONNECTION_EVENTS)
+    self.unix_socket_paths = []  #  Removed again by cleanup().
+    self.counters = {
+      'wakeups': 0,
+      'spurious_wakeups': 0,
+      'modify_calls': 0,
+      'immediate_sends': 0,
+      'read_syscalls': 0,
+      'bytes_read': 0,
+      'datagrams_read': 0,
+      'datagram_send_errors': 0,
+      'idle_timeouts': 0,
+      'write_timeouts': 0,
+      'write_pauses': 0,
+      'write_limit_closes': 0,
+      'connect_attempts': 0,
+      'connects': 0,
+      'connect_failures': 0,
+      'connect_timeouts': 0
     }
+    #  Debug output is a trace hook, so the event loop doesn't test 'debug' for every event.
+    if debug:
+      self.log.set_level(ROBOT_TANK_LOG_DEBUG)
+      self.set_trace_hook(self.debug_trace_hook)
 
   def sfno(self, s):
     #  Safe fileno function that doesn't casuse exceptions.
@@ -41,201 +604,492 @@ class RobotTankConnectionManager(object):
       return None
 
   def cleanup(self):
-    sys.stdout.write("Shutting down closing all %u sockets.\n" % (len(self.socket_map)))
+    self.log.info("Shutting down, closing all sockets", count=len(self.socket_map))
     for s in self.socket_map:
       try:
-        sys.stdout.write("Closing fd %u.\n" % (s))
-        self.socket_map[s]['socket'].close()
+        self.log.debug("Closing fd", fd=s)
+        self.socket_map[s].socket.close()
       except Exception as e:
         pass
+    for path in self.unix_socket_paths:
+      try:
+        os.unlink(path)
+      except OSError as e:
+        pass
 
     if self.sigint_callback is not None:
       sigint_callback()
     
+  def add_connection(self, connection):
+    for event in ROBOT_TANK_CONNECTION_EVENTS:
+      connection.resolve_callbacks(self.class_callbacks, event)
+    self.socket_map[connection.fd] = connection
+
   def register_file_descriptor(self, fd, classes):
     initial_event_mask = self.READ_FLAGS | self.EXCEPTION_FLAGS
+    os.set_blocking(fd, False)  #  Reads are drained until EAGAIN.
     self.poller.register(fd, initial_event_mask)
-    print("Registered fd " + str(fd))
-    self.socket_map[fd] = {
-      'is_listen_socket': False,
-      'is_socket': False,
-      'event_mask': initial_event_mask,
-      'out_bytes': bytearray(b''),
-      'in_bytes': bytearray(b''),
-      'socket': None,
-      'address': None,
-      'port': None,
-      'classes': classes
-    }
+    self.log.debug("Registered fd", fd=fd)
+    self.add_connection(RobotTankConnection(fd, None, None, None, classes, initial_event_mask, is_socket=False))
 
   def register_listen_socket(self, address, port, classes):
     initial_event_mask = self.READ_FLAGS | self.EXCEPTION_FLAGS
     listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    #  A restarted server can bind again while connections from before are still in TIME_WAIT.
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.socket_options.apply(listen_socket)  #  Buffer sizes need to be set before listen().
     self.poller.register(self.sfno(listen_socket), initial_event_mask)
-    print("Registered fd " + str(self.sfno(listen_socket)))
-    self.socket_map[self.sfno(listen_socket)] = {
-      'is_listen_socket': True,
-      'is_socket': True,
-      'event_mask': initial_event_mask,
-      'out_bytes': bytearray(b''),
-      'in_bytes': bytearray(b''),
-      'socket': listen_socket,
-      'address': address,
-      'port': port,
-      'classes': classes
-    }
+    self.log.debug("Registered fd", fd=self.sfno(listen_socket))
+    self.add_connection(RobotTankConnection(self.sfno(listen_socket), listen_socket, address, port, classes, initial_event_mask, is_listen_socket=True))
     listen_socket.bind((address, port))
     listen_socket.listen(10)  #  Backlog of up to 10 new connections.
+    return self.sfno(listen_socket)
+
+  def register_unix_listen_socket(self, path, classes):
+    #  Like register_listen_socket, for programs on the same machine.  A socket file left behind by
+    #  an earlier run is removed first.
+    initial_event_mask = self.READ_FLAGS | self.EXCEPTION_FLAGS
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+      os.unlink(path)
+    listen_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.poller.register(self.sfno(listen_socket), initial_event_mask)
+    self.log.debug("Registered fd", fd=self.sfno(listen_socket))
+    self.add_connection(RobotTankConnection(self.sfno(listen_socket), listen_socket, path, None, classes, initial_event_mask, is_listen_socket=True))
+    listen_socket.bind(path)
+    listen_socket.listen(10)
+    self.unix_socket_paths.append(path)
+    return self.sfno(listen_socket)
 
   def register_socket(self, sock, address, classes):
-    initial_event_mask = self.READ_FLAGS | self.WRITE_FLAGS | self.EXCEPTION_FLAGS
-    self.poller.register(self.sfno(sock), initial_event_mask)
-    print("Registered fd " + str(self.sfno(sock)))
-    self.socket_map[self.sfno(sock)] = {
-      'is_listen_socket': False,
-      'is_socket': True,
-      'event_mask': initial_event_mask,
-      'out_bytes': bytearray(b''),
-      'in_bytes': bytearray(b''),
-      'socket': sock,
-      'address': address,
-      'port': False,
-      'classes': classes
-    }
+    #  Write interest is only armed while there is something in 'out_queue'.
+    initial_event_mask = self.READ_FLAGS | self.EXCEPTION_FLAGS
+    sock.setblocking(False)  #  Reads and writes are drained until EAGAIN.
+    self.socket_options.apply(sock)
+    self.poller.register(self.sfno(sock), initial_event_mask, edge_triggered=True)
+    self.log.debug("Registered fd", fd=self.sfno(sock))
+    self.add_connection(RobotTankConnection(
+      self.sfno(sock), sock, address, False, classes, initial_event_mask,
+      edge_triggered=True,
+      rearm_quickack=self.socket_options.quickack and self.socket_options.is_tcp(sock),
+      last_read=self.clock(),
+      last_write=self.clock()
+    ))
+    self.start_timeout_timer()
+
+  def start_timeout_timer(self):
+    if (self.idle_timeout is not None or self.write_timeout is not None) and self.timeout_timer is None:
+      interval = min(t for t in [self.idle_timeout, self.write_timeout] if t is not None) / 4.0
+      self.timeout_timer = self.call_every(interval, self.check_timeouts)
+
+  def connect(self, address, port, classes, timeout=None):
+    #  Starts a non-blocking connect and returns the fd straight away, or None if it failed on the
+    #  spot.  Until the connect finishes the socket only waits to become writable.  Then it turns
+    #  into the same kind of connection register_socket makes and 'connect' class callbacks run.  A
+    #  connect that fails, or hasn't finished after 'timeout' seconds, is closed and 'close' class
+    #  callbacks run instead.  With a 'port' of None, 'address' is the path of a Unix domain socket.
+    sock = socket.socket(socket.AF_INET if port is not None else socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    self.socket_options.apply(sock)
+    self.counters['connect_attempts'] += 1
+    error = sock.connect_ex((address, port) if port is not None else address)
+    if error not in (0, errno.EINPROGRESS):
+      self.counters['connect_failures'] += 1
+      self.log.info("Connect failed", address=address, port=port, error=os.strerror(error))
+      sock.close()
+      return None
+    fd = self.sfno(sock)
+    initial_event_mask = self.WRITE_FLAGS | self.EXCEPTION_FLAGS
+    self.poller.register(fd, initial_event_mask)
+    connection = RobotTankConnection(fd, sock, address, port, classes, initial_event_mask, connecting=True)
+    self.add_connection(connection)
+    if timeout is not None:
+      self.call_later(timeout, lambda: self.on_connect_timeout(fd, connection))
+    return fd
+
+  def on_connect_timeout(self, fd, connection):
+    if self.socket_map.get(fd) is connection and connection.connecting:
+      self.counters['connect_timeouts'] += 1
+      self.log.info("Connect timed out", fd=fd, address=connection.address, port=connection.port)
+      self.close_connection(fd)
+
+  def on_connect_ready(self, fd, socket_details):
+    error = socket_details.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if error:
+      self.counters['connect_failures'] += 1
+      self.log.info("Connect failed", fd=fd, address=socket_details.address, port=socket_details.port, error=os.strerror(error))
+      self.close_connection(fd)
+      return
+    self.counters['connects'] += 1
+    socket_details.connecting = False
+    socket_details.edge_triggered = True
+    socket_details.rearm_quickack = self.socket_options.quickack and self.socket_options.is_tcp(socket_details.socket)
+    socket_details.last_read = socket_details.last_write = self.clock()
+    #  Anything queued while connecting keeps write interest armed.
+    self.set_event_mask(fd, socket_details, self.READ_FLAGS | self.EXCEPTION_FLAGS | (self.WRITE_FLAGS if len(socket_details.out_queue) else 0))
+    self.start_timeout_timer()
+    self.do_class_callback_for_event('connect', fd, socket_details)
+
+  def register_udp_socket(self, address, port, classes, remote=None):
+    #  Datagrams are kept whole in 'datagrams', see RobotTankConnection.  'remote' connects the
+    #  socket so send_datagram doesn't need an address.
+    initial_event_mask = self.READ_FLAGS | self.EXCEPTION_FLAGS
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.setblocking(False)
+    if address is not None:
+      udp_socket.bind((address, port))
+    if remote is not None:
+      udp_socket.connect(remote)
+    if self.socket_options.low_delay_tos:
+      self.socket_options.set_option(udp_socket, socket.IPPROTO_IP, socket.IP_TOS, self.socket_options.IPTOS_LOWDELAY)
+    fd = self.sfno(udp_socket)
+    self.poller.register(fd, initial_event_mask)
+    self.log.debug("Registered fd", fd=fd)
+    self.add_connection(RobotTankConnection(fd, udp_socket, address, port, classes, initial_event_mask, is_datagram=True))
+    return fd
+
+  def send_datagram(self, fd, by, address=None):
+    #  Datagrams are never queued, if the socket can't take one right now it's dropped
+    #  just like it could be on the network.
+    if fd in self.socket_map:
+      sock = self.socket_map[fd].socket
+      try:
+        if address is None:
+          sock.send(by)
+        else:
+          sock.sendto(by, address)
+        return True
+      except Exception as e:
+        self.counters['datagram_send_errors'] += 1
+        self.log.debug("Datagram send failed", fd=fd, error=e)
+        return False
+    else:
+      self.log.warning("fd not known", fd=fd, where='send_datagram')
+      return False
+
+  def remove_datagrams(self, fd):
+    if fd in self.socket_map:
+      socket_details = self.socket_map[fd]
+      tmp = socket_details.datagrams
+      socket_details.datagrams = []
+      return tmp
+    else:
+      self.log.warning("fd not known", fd=fd, where='remove_datagrams')
+      return []
+
+  def call_later(self, delay, callback):
+    return self.add_timer(RobotTankTimer(self.clock() + delay, None, callback))
+
+  def call_every(self, interval, callback):
+    return self.add_timer(RobotTankTimer(self.clock() + interval, interval, callback))
+
+  def add_timer(self, timer):
+    self.timer_counter += 1
+    heapq.heappush(self.timers, (timer.when, self.timer_counter, timer))
+    return timer
+
+  def get_poll_timeout(self, poll_timeout):
+    #  Don't sleep past the next timer.  Rounded up so we don't wake up just before it's due.
+    if len(self.timers) == 0:
+      return poll_timeout
+    timer_timeout = max(0, int((self.timers[0][0] - self.clock()) * 1000.0 + 0.999))
+    if poll_timeout is None or poll_timeout < 0:
+      return timer_timeout
+    return min(poll_timeout, timer_timeout)
+
+  def run_timers(self):
+    now = self.clock()
+    while len(self.timers) and self.timers[0][0] <= now:
+      when, counter, timer = heapq.heappop(self.timers)
+      if timer.cancelled:
+        continue
+      if timer.interval is not None:
+        #  Skip missed ticks rather than running them all back to back.
+        timer.when = when + timer.interval if when + timer.interval > now else now + timer.interval
+        self.add_timer(timer)
+      try:
+        timer.callback()
+      except Exception as e:
+        self.log.error("Caught exception in timer callback", error=e, traceback=traceback.format_exc())
+
+  def check_timeouts(self):
+    now = self.clock()
+    connections = 0
+    for fd in list(self.socket_map.keys()):
+      socket_details = self.socket_map[fd]
+      if socket_details.last_read is None:
+        continue  #  Not a connection.
+      connections += 1
+      if self.idle_timeout is not None and now - socket_details.last_read > self.idle_timeout:
+        self.log.info("Closing socket, nothing received", fd=fd, idle_timeout=self.idle_timeout)
+        self.counters['idle_timeouts'] += 1
+        self.close_connection(fd)
+      elif self.write_timeout is not None and len(socket_details.out_queue) and now - socket_details.last_write > self.write_timeout:
+        self.log.info("Closing socket, peer isn't taking data", fd=fd, write_timeout=self.write_timeout)
+        self.counters['write_timeouts'] += 1
+        self.close_connection(fd)
+    if connections == 0:
+      self.timeout_timer.cancel()
+      self.timeout_timer = None
 
   def register_class_callback(self, event, cl, cb):
+    #  Registering the same callback again, like the server does for every new client, is free.
+    if self.class_callbacks[event].get(cl) == cb:
+      return
     self.class_callbacks[event][cl] = cb
+    for socket_details in self.socket_map.values():
+      if cl in socket_details.classes:
+        socket_details.resolve_callbacks(self.class_callbacks, event)
 
   def do_class_callback_for_event(self, event, fd, socket_details):
-    #  Send out callbacks to anything that subscribed to this event
-    for c in socket_details['classes']:
-      if c in self.class_callbacks[event]:
-        self.class_callbacks[event][c](fd, socket_details)
-      else:
-        #print("Error:  No registered callback for class " + str(c) + " on event " + str(event))
-        pass
+    #  Send out callbacks to anything that subscribed to this event.  The hot path in run
+    #  calls the resolved callbacks directly instead.
+    for cb in getattr(socket_details, event + '_callbacks'):
+      cb(fd, socket_details)
+
+  def set_event_mask(self, fd, socket_details, event_mask):
+    socket_details.event_mask = event_mask
+    self.counters['modify_calls'] += 1
+    self.poller.modify(fd, event_mask, edge_triggered=socket_details.edge_triggered)
 
   def add_to_write_buffer(self, fd, by):
     if fd in self.socket_map:
       socket_details = self.socket_map[fd]
-      socket_details['out_bytes'] += by
-      socket_details['event_mask'] |= self.WRITE_FLAGS
-      self.poller.modify(fd, socket_details['event_mask'])
+      out_queue = socket_details.out_queue
+      if self.try_send_immediately and socket_details.is_socket and len(out_queue) == 0 and not socket_details.connecting:
+        try:
+          send_return = socket_details.socket.send(by)
+        except (BlockingIOError, InterruptedError):
+          send_return = 0
+        except Exception as e:
+          self.log.info("Closing socket due to send fail", fd=fd, error=e)
+          self.close_connection(fd)
+          return
+        if send_return == len(by):
+          self.counters['immediate_sends'] += 1
+          return  #  All sent, no need to arm write interest.
+        by = memoryview(by)[send_return:]
+      if len(out_queue) == 0 and socket_details.last_write is not None:
+        socket_details.last_write = self.clock()  #  The write timeout counts from when output starts waiting.
+      out_queue.append(by)
+      if len(out_queue) > self.write_limit:
+        self.log.warning("Closing socket, too much output waiting", fd=fd, write_limit=self.write_limit)
+        self.counters['write_limit_closes'] += 1
+        self.close_connection(fd)
+        return
+      if len(out_queue) >= self.write_high_water and not socket_details.write_paused:
+        socket_details.write_paused = True
+        self.counters['write_pauses'] += 1
+        self.do_class_callback_for_event('pause_writing', fd, socket_details)
+        if fd not in self.socket_map:
+          return  #  Closed by a callback.
+      if not socket_details.event_mask & self.WRITE_FLAGS:
+        self.set_event_mask(fd, socket_details, socket_details.event_mask | self.WRITE_FLAGS)
     else:
-      print("fd " + str(fd) + " not known in add_to_write_buffer.")
+      self.log.warning("fd not known", fd=fd, where='add_to_write_buffer')
 
   def try_remove_message(self, fd):
     if fd in self.socket_map:
-      socket_details = self.socket_map[fd]
-      if (len(socket_details['in_bytes'])) >= 4:
-        message_size = struct.unpack("I", socket_details['in_bytes'][0:4])[0]
-        rest = socket_details['in_bytes'][4:]
-        if (len(rest) == message_size):
-          socket_details['in_bytes'] = socket_details['in_bytes'][(4 + len(rest)):]
-          try:
-            return json.loads(rest.decode("utf-8"))
-          except Exception as e:
-            print("Robot tank message decode error: " + str(e))
-            return None
-      else:
-        #  Not enough bytes to even read the size header.
-        return None
+      return self.socket_map[fd].decoder.next_message()
     else:
-      print("fd " + str(fd) + " not known in try_remove_message.")
+      self.log.warning("fd not known", fd=fd, where='try_remove_message')
       return None
+
+  def iter_messages(self, fd):
+    #  Generator over every complete message that is waiting on this connection.
+    if fd in self.socket_map:
+      return self.socket_map[fd].decoder.messages()
+    else:
+      self.log.warning("fd not known", fd=fd, where='iter_messages')
+      return iter(())
     
   def remove_from_read_buffer(self, fd):
     if fd in self.socket_map:
-      socket_details = self.socket_map[fd]
-      tmp = socket_details['in_bytes']
-      socket_details['in_bytes'] = socket_details['in_bytes'][0:0]
-      return tmp
+      return self.socket_map[fd].decoder.remove_all()
     else:
-      print("fd " + str(fd) + " not known in remove_from_read_buffer.")
+      self.log.warning("fd not known", fd=fd, where='remove_from_read_buffer')
       return bytearray(b'')
 
+  def close_connection(self, fd):
+    if fd in self.socket_map:
+      socket_details = self.socket_map[fd]
+      #  Unregister first, epoll can't unregister an fd that has already been closed.
+      self.poller.unregister(fd)
+      self.pending_reads.discard(fd)
+      #  Plain file descriptors are owned by whoever registered them, so they're only unregistered.
+      if socket_details.socket is not None:
+        socket_details.socket.close()
+      del self.socket_map[fd]
+      self.do_class_callback_for_event('close', fd, socket_details)
+
   def on_generic_exception(self, fd):
     if fd in self.socket_map:
       socket_details = self.socket_map[fd]
-      print("Closing socket " + str(fd) + " due to exception event.")
-      fd = self.sfno(socket_details['socket'])
-      if fd:
-        socket_details['socket'].close()
-        self.poller.unregister(fd)
-        del self.socket_map[fd]
+      if socket_details.is_datagram:
+        #  Usually an ICMP port unreachable from a peer that isn't up yet.  Clear it and carry on.
+        socket_details.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        return
+      self.log.info("Closing socket due to exception event", fd=fd)
+      self.close_connection(fd)
     else:
-      print("Exception on unknown fd " + str(fd) + ".")
+      self.log.warning("Exception event on unknown fd", fd=fd)
 
   def on_generic_write(self, fd):
     if fd in self.socket_map:
       socket_details = self.socket_map[fd]
-      if len(socket_details['out_bytes']) == 0:
-        socket_details['event_mask'] &= ~self.WRITE_FLAGS
-        self.poller.modify(fd, socket_details['event_mask'])
+      out_queue = socket_details.out_queue
+      if len(out_queue) == 0:
+        self.counters['spurious_wakeups'] += 1
       else:
-        if socket_details['is_socket']:  # for file descriptors.
+        #  Keep sending until the queue is empty or the socket is full.  Edge triggered
+        #  sockets won't report being writable again until the socket returns EAGAIN.
+        while len(out_queue):
           try:
-            send_return = socket_details['socket'].send(socket_details['out_bytes'])
-            socket_details['out_bytes'] = socket_details['out_bytes'][send_return:] #  Remove from start of buffer.
+            out_queue.send(socket_details.socket, fd)
+            if socket_details.last_write is not None:
+              socket_details.last_write = self.clock()
+          except (BlockingIOError, InterruptedError):
+            break  #  Socket is non-blocking, try again on the next write event.
           except Exception as e:
-            print("Closing socket " + str(fd) + " due to send fail.")
-            fd = self.sfno(socket_details['socket'])
-            if fd:
-              socket_details['socket'].close()
-              self.poller.unregister(fd)
-              del self.socket_map[fd]
-        else:
-          assert(False) #  TODO Not implemented.
+            self.log.info("Closing socket due to send fail", fd=fd, error=e)
+            self.close_connection(fd)
+            return
+      if socket_details.write_paused and len(out_queue) <= self.write_low_water:
+        socket_details.write_paused = False
+        self.do_class_callback_for_event('resume_writing', fd, socket_details)
+        if fd not in self.socket_map:
+          return
+      if len(out_queue) == 0 and socket_details.event_mask & self.WRITE_FLAGS:
+        self.set_event_mask(fd, socket_details, socket_details.event_mask & ~self.WRITE_FLAGS)
+    else:
+      self.log.warning("Write event on unknown fd", fd=fd)
+
+  def read_into_buffer(self, fd, socket_details, size):
+    self.counters['read_syscalls'] += 1
+    if socket_details.is_socket:
+      return socket_details.socket.recv_into(self.recv_view, size)
     else:
-      print("Write event on unknown fd " + str(fd) + ".")
+      return os.readv(fd, [self.recv_view[0:size]])
+
+  def read_datagrams(self, fd, socket_details):
+    budget = self.read_budget
+    while budget > 0:
+      try:
+        self.counters['read_syscalls'] += 1
+        bytes_read, address = socket_details.socket.recvfrom_into(self.recv_view, self.recv_size)
+      except (BlockingIOError, InterruptedError):
+        break
+      except Exception as e:
+        #  Errors like connection refused on UDP don't mean the socket is done.
+        self.log.debug("Error from recvfrom", fd=fd, error=e)
+        break
+      if budget == self.read_budget:
+        socket_details.read_started = self.clock()
+      socket_details.datagrams.append((bytes(self.recv_view[0:bytes_read]), address))
+      self.counters['datagrams_read'] += 1
+      budget -= max(bytes_read, 1)
 
   def on_generic_read(self, fd):
+    #  Returns True if the peer closed the connection or recv failed.  The connection is left
+    #  open for the caller to close once the read callbacks have had whatever arrived before that.
     if fd in self.socket_map:
       socket_details = self.socket_map[fd]
-      if not socket_details['is_listen_socket']:  #  Listen sockets don't have data waiting to recv.
-        recv_return = bytearray(b"")
-        if socket_details['is_socket']:  # for file descriptors.
+      if socket_details.is_datagram:
+        self.read_datagrams(fd, socket_details)
+      elif not socket_details.is_listen_socket:  #  Listen sockets don't have data waiting to recv.
+        budget = self.read_budget
+        while budget > 0:
+          size = min(self.recv_size, budget)
           try:
-            recv_return = socket_details['socket'].recv(self.recv_size)
+            bytes_read = self.read_into_buffer(fd, socket_details, size)
+          except (BlockingIOError, InterruptedError):
+            if budget == self.read_budget:
+              self.counters['spurious_wakeups'] += 1
+            break  #  Nothing more available right now.
           except Exception as e:
-            print("e from recv was " + str(e))
-        else:
-            recv_return = bytearray(os.read(fd, 1))
-        if len(recv_return) == 0:
-          print("Closing socket " + str(fd) + " due to 0 byte read.")
-          fd = self.sfno(socket_details['socket'])
-          if fd:
-            socket_details['socket'].close()
-            self.poller.unregister(fd)
-            del self.socket_map[fd]
-        else:
-          socket_details['in_bytes'].extend(recv_return)
+            self.log.info("Error from recv", fd=fd, error=e)
+            bytes_read = 0
+          if bytes_read == 0:
+            return True
+          if budget == self.read_budget:
+            socket_details.read_started = self.clock()
+          socket_details.decoder.feed(self.recv_view[0:bytes_read])
+          self.counters['bytes_read'] += bytes_read
+          budget -= bytes_read
+          #  A short read doesn't mean the socket is drained, the peer's FIN or more data can still
+          #  be waiting, so keep reading until EAGAIN or a 0 byte read.
+        if fd in self.socket_map:
+          if budget < self.read_budget and socket_details.last_read is not None:
+            socket_details.last_read = self.clock()
+          if socket_details.rearm_quickack:
+            self.socket_options.rearm_quickack(socket_details.socket)
+          if budget <= 0 and socket_details.edge_triggered:
+            #  There may be more data waiting, but an edge triggered connection won't be reported again.
+            self.pending_reads.add(fd)
     else:
-      print("Write event on unknown fd " + str(fd) + ".")
+      self.log.warning("Read event on unknown fd", fd=fd)
+    return False
+
+  def handle_event(self, fd, flag, socket_details):
+    if socket_details.connecting:
+      self.on_connect_ready(fd, socket_details)
+      return
+    #  Callbacks can close the connection, after which the rest of the event is skipped.
+    socket_map = self.socket_map
+    if flag & self.READ_FLAGS:
+      peer_closed = self.on_generic_read(fd)
+      for cb in socket_details.read_callbacks:
+        cb(fd, socket_details)
+        if fd not in socket_map:
+          return
+      if peer_closed:
+        self.log.info("Closing socket due to 0 byte read", fd=fd)
+        self.close_connection(fd)
+        return
+    if flag & self.WRITE_FLAGS:
+      self.on_generic_write(fd)
+      if fd not in socket_map:
+        return  #  The send failed and the connection was closed.
+      for cb in socket_details.write_callbacks:
+        cb(fd, socket_details)
+        if fd not in socket_map:
+          return
+    if flag & self.EXCEPTION_FLAGS:
+      self.on_generic_exception(fd)
+      for cb in socket_details.exception_callbacks:
+        cb(fd, socket_details)
+
+  def set_trace_hook(self, hook):
+    #  'hook' is called as hook(fd, flag, socket_details) before each event is handled, and
+    #  None removes it.  The hook is installed by wrapping handle_event, so run never checks for it.
+    self.__dict__.pop('handle_event', None)
+    if hook is not None:
+      handle_event = self.handle_event
+      def traced_handle_event(fd, flag, socket_details):
+        hook(fd, flag, socket_details)
+        handle_event(fd, flag, socket_details)
+      self.handle_event = traced_handle_event
+
+  def debug_trace_hook(self, fd, flag, socket_details):
+    self.log.debug("Event", fd=fd, read=bool(flag & self.READ_FLAGS), write=bool(flag & self.WRITE_FLAGS), exception=bool(flag & self.EXCEPTION_FLAGS))
 
   def run(self, poll_timeout):
-    if self.debug:
-      print("Before poller.poll")
     try:
-      events = self.poller.poll(poll_timeout)
+      if len(self.pending_reads):
+        flags = dict(self.poller.poll(0))  #  Don't block while there is still data to read.
+        for fd in self.pending_reads:
+          flags[fd] = flags.get(fd, 0) | select.POLLIN
+        self.pending_reads = set()
+        events = list(flags.items())
+      else:
+        events = self.poller.poll(self.get_poll_timeout(poll_timeout))
+      if len(events):
+        self.counters['wakeups'] += 1
+      socket_map = self.socket_map
+      handle_event = self.handle_event
       for fd, flag in events:
-        socket_details = self.socket_map[fd]
-        if flag & (select.POLLIN | select.POLLPRI):
-          if self.debug:
-            print("read event on fd " + str(fd))
-          self.on_generic_read(fd)
-          self.do_class_callback_for_event('read', fd, socket_details)
-        if flag & (select.POLLOUT):
-          if self.debug:
-            print("write event on fd " + str(fd))
-          self.on_generic_write(fd)
-          self.do_class_callback_for_event('write', fd, socket_details)
-        if flag & (select.POLLHUP | select.POLLERR):
-          if self.debug:
-            print("exception event on fd " + str(fd))
-          self.on_generic_exception(fd)
-          self.do_class_callback_for_event('exception', fd, socket_details)
+        socket_details = socket_map.get(fd)
+        if socket_details is not None:  #  None if it was closed while handling an earlier event in this batch.
+          handle_event(fd, flag, socket_details)
     except Exception as e:
-      print("Caught exception in poll or processing flags: " + str(e))
-    if self.debug:
-      print("After poller.poll")
+      self.log.error("Caught exception in poll or processing flags", error=e, traceback=traceback.format_exc())
+    self.run_timers()
@@ -0,0 +1,100 @@
+import os
+import json
+from RobotTankConnectionManager import ROBOT_TANK_DIRECTIONS
+
+#  Which keys drive which directions, and which pin states each direction (or combination of
+#  held directions) maps to, are read from a JSON file rather than written out in code:
+#
+#    keys        key name (as in the keymap) to direction
+#    keycodes    keycode to direction, for clients that send keycodes without a keymap
+#    pins        pin names, in the order the pin state lists use
+#    pin_states  'stop', a direction, or directions joined with '+' such as 'reverse+left',
+#                to a list of pin values
+ROBOT_TANK_DEFAULT_DIRECTION_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'robot_tank_directions.json')
+
+def load_direction_config(path=None):
+  with open(path if path is not None else ROBOT_TANK_DEFAULT_DIRECTION_CONFIG) as f:
+    return json.load(f)
+
+class RobotTankDirectionResolver(object):
+  #  Held directions are a bitmask (bit i is ROBOT_TANK_DIRECTIONS[i]) plus a stack of the held
+  #  directions in the order they were pressed.  Every (bitmask, most recent direction) pair is
+  #  resolved to a pin state tuple when the config is loaded, so an event is a dict lookup and a
+  #  table index.  A combination listed in the config, like reverse+left, wins while exactly
+  #  those directions are held.  Otherwise the most recently pressed direction wins.
+  def __init__(self, config):
+    self.pin_names = list(config['pins'])
+    self.key_directions = dict((key, ROBOT_TANK_DIRECTIONS.index(d)) for key, d in config['keys'].items())
+    self.keycode_directions = dict((int(kc), ROBOT_TANK_DIRECTIONS.index(d)) for kc, d in config.get('keycodes', {}).items())
+    states = {}
+    for name, values in config['pin_states'].items():
+      if len(values) != len(self.pin_names):
+        raise Exception("Pin states for " + name + " have " + str(len(values)) + " values, expected " + str(len(self.pin_names)) + ".")
+      bitmask = 0
+      for d in name.split('+'):
+        if d != 'stop':
+          bitmask |= 1 << ROBOT_TANK_DIRECTIONS.index(d)
+      states[bitmask] = (name if bitmask else None, tuple(values))
+    for i, d in enumerate(ROBOT_TANK_DIRECTIONS):
+      if (1 << i) not in states:
+        raise Exception("No pin states for direction " + d + ".")
+    if 0 not in states:
+      raise Exception("No pin states for stop.")
+    #  table[bitmask][most recent direction] is (direction name, pin state tuple).
+    self.table = []
+    for bitmask in range(1 << len(ROBOT_TANK_DIRECTIONS)):
+      row = []
+      for most_recent in range(len(ROBOT_TANK_DIRECTIONS)):
+        if bitmask in states:
+          row.append(states[bitmask])
+        elif bitmask & (1 << most_recent):
+          row.append(states[1 << most_recent])
+        else:
+          row.append(states[0])  #  Can't happen, the most recent direction is always held.
+      self.table.append(row)
+    self.stopped = states[0]
+    self.pressed = 0
+    self.recency = []  #  Held direction indices, most recently pressed last.
+
+  def make_keycode_table(self, keymap):
+    #  List indexed by keycode giving the direction index or None, built from a client's keymap.
+    directions = dict(self.keycode_directions)
+    for kc, name in keymap.items():
+      if name in self.key_directions:
+        directions[kc] = self.key_directions[name]
+    table = [None] * (max(list(directions.keys()) + [-1]) + 1)
+    for kc in directions:
+      table[kc] = directions[kc]
+    return table
+
+  def set_direction(self, index, is_pressed):
+    #  Returns True if the set of held directions changed.  Pressing a direction that is already
+    #  held still makes it the most recent one.
+    bit = 1 << index
+    if is_pressed:
+      if self.pressed & bit:
+        if self.recency[-1] != index:
+          self.recency.remove(index)
+          self.recency.append(index)
+        return False
+      self.pressed |= bit
+      self.recency.append(index)
+      return True
+    elif self.pressed & bit:
+      self.pressed &= ~bit
+      self.recency.remove(index)
+      return True
+    return False
+
+  def release_all(self):
+    #  Returns True if anything was held.
+    changed = self.pressed != 0
+    self.pressed = 0
+    self.recency = []
+    return changed
+
+  def resolve(self):
+    #  Returns (direction name or None for stop, pin state tuple in 'pin_names' order).
+    if self.pressed:
+      return self.table[self.pressed][self.recency[-1]]
+    return self.stopped
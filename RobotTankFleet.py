@@ -0,0 +1,109 @@
+import json
+from RobotTankConnectionManager import RobotTankBackoff
+from RobotTankConnectionManager import ROBOT_TANK_WIRE_FORMAT_JSON
+from RobotTankStats import RobotTankLatencyHistogram
+
+#  A client can drive several tanks, each with its own server.  They are listed in a JSON file
+#  like robot_tank_fleet.json:
+#
+#    tanks        tank name to {'host', 'port', 'groups'}, where 'groups' is a list of group names
+#    select_keys  key name (as in the keymap) to the tank or group that input goes to after it's pressed
+#    selected     the tank or group that input goes to at first
+#
+#  Every tank is also in the group 'all'.
+ROBOT_TANK_FLEET_ALL = 'all'
+
+def load_fleet_config(path):
+  with open(path) as f:
+    return json.load(f)
+
+def make_single_tank_fleet_config(host, port):
+  return {'tanks': {host: {'host': host, 'port': port}}, 'selected': host}
+
+class RobotTankFleetTargets(object):
+  #  Resolves tank and group names to the tanks they stand for, in config order.
+  def __init__(self, config):
+    self.tank_names = list(config['tanks'].keys())
+    self.targets = {ROBOT_TANK_FLEET_ALL: list(self.tank_names)}
+    for name in self.tank_names:
+      for group in config['tanks'][name].get('groups', []):
+        self.targets.setdefault(group, []).append(name)
+    for name in self.tank_names:
+      self.targets[name] = [name]  #  A tank named like a group is the tank.
+    self.select_keys = dict(config.get('select_keys', {}))
+    for key, target in self.select_keys.items():
+      if target not in self.targets:
+        raise Exception("Select key " + key + " is for " + str(target) + ", which isn't a tank or group.")
+
+  def resolve(self, target):
+    return self.targets.get(target, [])
+
+class RobotTankServerLink(object):
+  #  One connection in the client's pool.  'state' is its health:
+  #
+  #    connecting    a connect is under way
+  #    up            connected, and heartbeats are being echoed
+  #    stale         connected, but no heartbeat echo for 'stale_after' seconds
+  #    down          not connected, waiting out the backoff before trying again
+  #
+  #  'wire_format' and 'features' are whatever this server agreed to in its hello.
+  def __init__(self, name, host, port, backoff=None):
+    self.name = name
+    self.host = host
+    self.port = port
+    self.backoff = backoff if backoff is not None else RobotTankBackoff()
+    self.fd = None
+    self.state = 'down'
+    self.wire_format = ROBOT_TANK_WIRE_FORMAT_JSON
+    self.features = []
+    self.server_state = None
+    self.reconnect_timer = None
+    self.disconnected_at = None
+    self.last_echo = None
+    self.heartbeat_rtt = None
+    self.counters = {'connects': 0, 'disconnects': 0, 'connect_failures': 0, 'key_snapshots': 0, 'stale': 0}
+    self.reconnect_latency = RobotTankLatencyHistogram()
+
+  def on_connect(self, fd, now):
+    #  Returns how long the connection was lost for in microseconds, None the first time.
+    self.fd = fd
+    self.state = 'up'
+    self.last_echo = now
+    self.counters['connects'] += 1
+    self.backoff.reset()
+    #  It may be a different server, so start over with JSON until it answers the hello.
+    self.wire_format = ROBOT_TANK_WIRE_FORMAT_JSON
+    self.features = []
+    if self.disconnected_at is None:
+      return None
+    reconnect_us = int((now - self.disconnected_at) * 1000000)
+    self.reconnect_latency.record(reconnect_us)
+    self.disconnected_at = None
+    return reconnect_us
+
+  def on_close(self, now):
+    self.fd = None
+    self.state = 'down'
+    self.counters['disconnects'] += 1
+    self.disconnected_at = now
+
+  def on_heartbeat_echo(self, sent_at, now):
+    self.last_echo = now
+    self.heartbeat_rtt = now - sent_at
+    self.state = 'up'
+
+  def check_stale(self, now, stale_after):
+    if self.fd is not None and now - self.last_echo > stale_after:
+      if self.state == 'up':
+        self.counters['stale'] += 1
+      self.state = 'stale'
+
+  def get_health(self):
+    return {
+      'state': self.state,
+      'host': self.host,
+      'port': self.port,
+      'heartbeat_rtt_us': int(self.heartbeat_rtt * 1000000) if self.heartbeat_rtt is not None else None,
+      'counters': dict(self.counters),
+      'reconnect_latency': self.reconnect_latency.summary()
+    }
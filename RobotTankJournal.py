@@ -0,0 +1,116 @@
+import os
+import mmap
+import struct
+import threading
+import collections
+
+#  Append-only binary journal of what the server received and what it did with the pins.  The
+#  file starts with ROBOT_TANK_JOURNAL_MAGIC, followed by records that are a fixed header
+#  (timestamp in microseconds on the server's clock, record type, client id, payload length,
+#  all little endian) and then the payload:
+#
+#    CONNECT   a client connected, no payload
+#    MESSAGE   one frame's payload exactly as the client sent it, JSON or binary
+#    DATAGRAM  one UDP control datagram
+#    PINS      the pin values written, one byte per pin in 'pin_names' order, then the direction label
+#    CLOSE     a client disconnected, no payload
+#    COMMAND   a command read from the shared memory command slot, RobotTankCommand.serialize()
+ROBOT_TANK_JOURNAL_MAGIC = b'RTJOURN1'
+ROBOT_TANK_JOURNAL_CONNECT = 1
+ROBOT_TANK_JOURNAL_MESSAGE = 2
+ROBOT_TANK_JOURNAL_DATAGRAM = 3
+ROBOT_TANK_JOURNAL_PINS = 4
+ROBOT_TANK_JOURNAL_CLOSE = 5
+ROBOT_TANK_JOURNAL_COMMAND = 6
+
+ROBOT_TANK_JOURNAL_RECORD_HEADER = struct.Struct("<QBxHI")
+
+class RobotTankJournalWriter(object):
+  #  Records are packed into an in-memory buffer, which is handed to a background thread to be
+  #  written once it reaches 'flush_size' bytes or flush() is called, so the event loop never
+  #  waits on the disk.
+  def __init__(self, path, flush_size=65536):
+    self.file = open(path, 'ab')
+    if self.file.tell() == 0:
+      self.file.write(ROBOT_TANK_JOURNAL_MAGIC)
+    self.flush_size = flush_size
+    self.buf = bytearray(b'')
+    self.pending = collections.deque()  #  Full buffers waiting for the writer thread.
+    self.condition = threading.Condition()
+    self.closed = False
+    self.counters = {'records': 0, 'bytes': 0, 'flushes': 0, 'write_errors': 0}
+    self.thread = threading.Thread(target=self.writer_loop, name='robot_tank_journal')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def record(self, timestamp_us, record_type, client_id, payload=b''):
+    self.buf += ROBOT_TANK_JOURNAL_RECORD_HEADER.pack(timestamp_us, record_type, client_id & 0xFFFF, len(payload))
+    self.buf += payload
+    self.counters['records'] += 1
+    if len(self.buf) >= self.flush_size:
+      self.flush()
+
+  def flush(self):
+    #  Hands whatever is buffered to the writer thread without waiting for it to be written.
+    if len(self.buf):
+      self.pending.append(self.buf)
+      self.buf = bytearray(b'')
+      with self.condition:
+        self.condition.notify()
+
+  def writer_loop(self):
+    while True:
+      with self.condition:
+        while not len(self.pending) and not self.closed:
+          self.condition.wait()
+        if not len(self.pending):
+          return
+      buf = self.pending.popleft()
+      try:
+        self.file.write(buf)
+        self.file.flush()
+        self.counters['bytes'] += len(buf)
+        self.counters['flushes'] += 1
+      except Exception as e:
+        self.counters['write_errors'] += 1
+
+  def close(self):
+    self.flush()
+    with self.condition:
+      self.closed = True
+      self.condition.notify_all()
+    self.thread.join()
+    self.file.close()
+
+class RobotTankJournalReader(object):
+  #  Memory maps a journal and iterates over its records without copying them.  A record cut
+  #  short at the end of the file, from a crash in the middle of a write, is ignored.
+  def __init__(self, path):
+    self.file = open(path, 'rb')
+    self.size = os.fstat(self.file.fileno()).st_size
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+    if self.size < len(ROBOT_TANK_JOURNAL_MAGIC) or self.map[0:len(ROBOT_TANK_JOURNAL_MAGIC)] != ROBOT_TANK_JOURNAL_MAGIC:
+      self.close()
+      raise Exception(path + " is not a robot tank journal.")
+    self.view = memoryview(self.map)
+
+  def records(self):
+    #  Yields (timestamp in microseconds, record type, client id, payload as a memoryview).
+    offset = len(ROBOT_TANK_JOURNAL_MAGIC)
+    header_size = ROBOT_TANK_JOURNAL_RECORD_HEADER.size
+    unpack_from = ROBOT_TANK_JOURNAL_RECORD_HEADER.unpack_from
+    view = self.view
+    while offset + header_size <= self.size:
+      timestamp_us, record_type, client_id, length = unpack_from(view, offset)
+      start = offset + header_size
+      if start + length > self.size:
+        break
+      offset = start + length
+      yield timestamp_us, record_type, client_id, view[start:offset]
+
+  def close(self):
+    if self.map is not None:
+      self.view = None
+      self.map.close()
+      self.map = None
+    self.file.close()
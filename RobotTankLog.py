@@ -0,0 +1,179 @@
+import sys
+import time
+import atexit
+import threading
+import collections
+
+ROBOT_TANK_LOG_DEBUG = 10
+ROBOT_TANK_LOG_INFO = 20
+ROBOT_TANK_LOG_WARNING = 30
+ROBOT_TANK_LOG_ERROR = 40
+ROBOT_TANK_LOG_LEVEL_NAMES = {
+  ROBOT_TANK_LOG_DEBUG: 'DEBUG',
+  ROBOT_TANK_LOG_INFO: 'INFO',
+  ROBOT_TANK_LOG_WARNING: 'WARN',
+  ROBOT_TANK_LOG_ERROR: 'ERROR'
+}
+
+class RobotTankLogger(object):
+  #  Logging that never blocks the event loop on the console.  A record is a (time, level,
+  #  message, fields) tuple, where 'message' is a fixed string and 'fields' holds the values
+  #  that go with it.  Records at or above 'level' are queued and a background thread formats
+  #  and writes them, so a slow SSH console or a stopped pipe only holds up that thread.  When
+  #  more than 'queue_size' records are waiting new ones are dropped and counted.  Records at
+  #  or above 'ring_level' also go into a ring of the last 'ring_size' records, which dump_ring()
+  #  writes out on demand, so debug records can be kept without being written anywhere.
+  #
+  #  Each message is written at most 'rate_limit_burst' times per 'rate_limit_interval' seconds.
+  #  The rest are counted, and the next one written carries a 'suppressed' field.  The ring isn't
+  #  rate limited.
+  #
+  #  With background=False records are written straight away by the caller, like print().
+  def __init__(self, level=ROBOT_TANK_LOG_INFO, stream=None, queue_size=4096, ring_size=1024, ring_level=ROBOT_TANK_LOG_DEBUG, rate_limit_interval=1.0, rate_limit_burst=5, clock=time.time, background=True, batch_size=32):
+    self.stream = stream  #  None is whatever sys.stdout is at the time of writing.
+    self.queue_size = queue_size
+    self.ring = collections.deque(maxlen=ring_size)
+    self.rate_limit_interval = rate_limit_interval
+    self.rate_limit_burst = rate_limit_burst
+    self.clock = clock
+    self.background = background
+    self.batch_size = batch_size
+    self.rate_limits = {}  #  Message to [window start, records in window, suppressed].
+    self.queue = collections.deque()
+    #  Condition() uses a reentrant lock, so logging from a signal handler can't deadlock with the main thread.
+    self.condition = threading.Condition()
+    self.thread = None
+    self.writing = False
+    self.closed = False
+    self.counters = {'records': 0, 'written': 0, 'dropped': 0, 'suppressed': 0, 'write_errors': 0}
+    self.set_level(level, ring_level)
+
+  def set_level(self, level, ring_level=None):
+    self.level = level
+    if ring_level is not None:
+      self.ring_level = ring_level
+    self.min_level = min(self.level, self.ring_level)
+
+  def is_enabled_for(self, level):
+    return level >= self.min_level
+
+  def debug(self, message, **fields):
+    if ROBOT_TANK_LOG_DEBUG >= self.min_level:
+      self.log(ROBOT_TANK_LOG_DEBUG, message, fields)
+
+  def info(self, message, **fields):
+    if ROBOT_TANK_LOG_INFO >= self.min_level:
+      self.log(ROBOT_TANK_LOG_INFO, message, fields)
+
+  def warning(self, message, **fields):
+    if ROBOT_TANK_LOG_WARNING >= self.min_level:
+      self.log(ROBOT_TANK_LOG_WARNING, message, fields)
+
+  def error(self, message, **fields):
+    if ROBOT_TANK_LOG_ERROR >= self.min_level:
+      self.log(ROBOT_TANK_LOG_ERROR, message, fields)
+
+  def log(self, level, message, fields):
+    now = self.clock()
+    self.counters['records'] += 1
+    if level >= self.ring_level:
+      self.ring.append((now, level, message, fields))
+    if level < self.level:
+      return
+    limit = self.rate_limits.get(message)
+    if limit is None:
+      limit = self.rate_limits[message] = [now, 0, 0]
+    elif now - limit[0] >= self.rate_limit_interval:
+      if limit[2]:
+        fields = dict(fields, suppressed=limit[2])
+      limit[0] = now
+      limit[1] = 0
+      limit[2] = 0
+    if limit[1] >= self.rate_limit_burst:
+      limit[2] += 1
+      self.counters['suppressed'] += 1
+      return
+    limit[1] += 1
+    record = (now, level, message, fields)
+    if not self.background:
+      self.write_records([record])
+    elif len(self.queue) >= self.queue_size:
+      self.counters['dropped'] += 1
+    else:
+      self.queue.append(record)
+      if self.thread is None:
+        self.start()
+      with self.condition:
+        self.condition.notify()
+
+  def format_record(self, record):
+    now, level, message, fields = record
+    line = "%.6f %s %s" % (now, ROBOT_TANK_LOG_LEVEL_NAMES.get(level, str(level)), message)
+    for k in fields:
+      line += " " + k + "=" + str(fields[k])
+    return line + "\n"
+
+  def write_records(self, records):
+    stream = self.stream if self.stream is not None else sys.stdout
+    try:
+      stream.write("".join(self.format_record(record) for record in records))
+      stream.flush()
+      self.counters['written'] += len(records)
+    except Exception as e:
+      self.counters['write_errors'] += 1
+
+  def start(self):
+    self.thread = threading.Thread(target=self.writer_loop, name='robot_tank_log')
+    self.thread.daemon = True
+    self.thread.start()
+    atexit.register(self.flush)
+
+  def writer_loop(self):
+    while True:
+      with self.condition:
+        while not len(self.queue) and not self.closed:
+          self.condition.wait()
+        if not len(self.queue):
+          return
+        self.writing = True
+      #  Small batches, so the event loop never waits long for the GIL while this thread formats
+      #  records.  The write itself releases it.
+      records = []
+      while len(self.queue) and len(records) < self.batch_size:
+        records.append(self.queue.popleft())
+      self.write_records(records)
+      with self.condition:
+        self.writing = False
+        self.condition.notify_all()
+
+  def flush(self, timeout=1.0):
+    #  Waits up to 'timeout' seconds for queued records to be written.  Returns True if they were.
+    deadline = time.monotonic() + timeout
+    with self.condition:
+      while self.thread is not None and (len(self.queue) or self.writing):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          return False
+        self.condition.wait(remaining)
+    return True
+
+  def close(self, timeout=1.0):
+    self.flush(timeout)
+    with self.condition:
+      self.closed = True
+      self.condition.notify_all()
+
+  def dump_ring(self, stream=None):
+    #  Writes the ring synchronously, for example from a signal handler or after a crash.
+    records = list(self.ring)
+    stream = stream if stream is not None else sys.stdout
+    for record in records:
+      stream.write(self.format_record(record))
+    stream.flush()
+    return len(records)
+
+#  Shared by everything in the process unless a logger is passed in.
+robot_tank_logger = RobotTankLogger()
+
+def get_logger():
+  return robot_tank_logger
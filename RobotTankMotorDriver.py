@@ -0,0 +1,223 @@
+from RobotTankLog import get_logger
+
+#  Physical (BOARD) pin number to Broadcom GPIO number for the 40 pin Raspberry Pi header.
+#  The server uses BOARD numbers, gpiod uses Broadcom line offsets.
+BOARD_TO_BCM = {
+  3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27, 15: 22, 16: 23, 18: 24, 19: 10,
+  21: 9, 22: 25, 23: 11, 24: 8, 26: 7, 27: 0, 28: 1, 29: 5, 31: 6, 32: 12, 33: 13, 35: 19,
+  36: 16, 37: 26, 38: 20, 40: 21
+}
+
+class RobotTankRPiGpioBackend(object):
+  #  RPi.GPIO backend.  RPi.GPIO is only imported here so everything else runs without a Pi.
+  def __init__(self):
+    import RPi.GPIO as gpio
+    self.gpio = gpio
+    self.gpio.setwarnings(False)
+    self.gpio.setmode(self.gpio.BOARD)
+    self.pwms = {}
+
+  def setup_outputs(self, pins):
+    for pin in pins:
+      self.gpio.setup(pin, self.gpio.OUT)
+
+  def setup_pwm(self, pin, frequency):
+    self.pwms[pin] = self.gpio.PWM(pin, frequency)
+    self.pwms[pin].start(0)
+
+  def set_duty_cycle(self, pin, duty_cycle):
+    self.pwms[pin].ChangeDutyCycle(duty_cycle)
+
+  def write(self, pins, values):
+    #  RPi.GPIO takes lists of channels and values, so this is one call for any number of pins.
+    self.gpio.output(list(pins), list(values))
+
+  def cleanup(self):
+    for pin in self.pwms:
+      self.pwms[pin].stop()
+    self.gpio.cleanup()
+
+class RobotTankGpiodBackend(object):
+  #  Backend for the GPIO character device (/dev/gpiochipN) through the 'gpiod' module.
+  #  All requested lines are set with a single ioctl, so every pin changes at the same time.
+  #  Works with both the 1.x and 2.x Python bindings.
+  def __init__(self, chip='gpiochip0', consumer='robot_tank'):
+    import gpiod
+    self.gpiod = gpiod
+    self.chip = chip
+    self.consumer = consumer
+    self.offsets = []
+    self.request = None
+
+  def setup_outputs(self, pins):
+    self.offsets = [BOARD_TO_BCM[pin] for pin in pins]
+    self.pin_order = list(pins)
+    if hasattr(self.gpiod, 'request_lines'):
+      self.request = self.gpiod.request_lines(
+        '/dev/' + self.chip,
+        consumer=self.consumer,
+        config={tuple(self.offsets): self.gpiod.LineSettings(direction=self.gpiod.line.Direction.OUTPUT)}
+      )
+    else:
+      self.request = self.gpiod.Chip(self.chip).get_lines(self.offsets)
+      self.request.request(consumer=self.consumer, type=self.gpiod.LINE_REQ_DIR_OUT)
+    self.values = dict((pin, 0) for pin in pins)
+
+  def setup_pwm(self, pin, frequency):
+    get_logger().warning("The gpiod backend has no PWM, the pin will be switched fully on or off", pin=pin)
+
+  def set_duty_cycle(self, pin, duty_cycle):
+    self.write([pin], [1 if duty_cycle > 0 else 0])
+
+  def write(self, pins, values):
+    for pin, value in zip(pins, values):
+      self.values[pin] = value
+    if hasattr(self.gpiod, 'request_lines'):
+      Value = self.gpiod.line.Value
+      self.request.set_values(dict((BOARD_TO_BCM[pin], Value.ACTIVE if self.values[pin] else Value.INACTIVE) for pin in self.pin_order))
+    else:
+      self.request.set_values([self.values[pin] for pin in self.pin_order])
+
+  def cleanup(self):
+    if self.request is not None:
+      self.request.release()
+      self.request = None
+
+class RobotTankFakeGpioBackend(object):
+  #  In memory backend for running and testing without any GPIO hardware.
+  def __init__(self):
+    self.pin_values = {}
+    self.calls = 0
+    self.writes = []  #  (pins, values) for every write, in order.
+    self.duty_cycles = {}
+
+  def setup_outputs(self, pins):
+    self.calls += len(pins)
+    for pin in pins:
+      self.pin_values[pin] = 0
+
+  def setup_pwm(self, pin, frequency):
+    self.calls += 1
+    self.duty_cycles[pin] = 0
+
+  def set_duty_cycle(self, pin, duty_cycle):
+    self.calls += 1
+    self.duty_cycles[pin] = duty_cycle
+
+  def write(self, pins, values):
+    self.calls += 1
+    self.writes.append((tuple(pins), tuple(values)))
+    for pin, value in zip(pins, values):
+      self.pin_values[pin] = value
+
+  def cleanup(self):
+    self.calls += 1
+
+def make_gpio_backend(name):
+  if name == 'rpi':
+    return RobotTankRPiGpioBackend()
+  elif name == 'gpiod':
+    return RobotTankGpiodBackend()
+  elif name == 'fake':
+    return RobotTankFakeGpioBackend()
+  else:
+    raise Exception("Unknown GPIO backend " + str(name) + ".")
+
+class RobotTankMotorDriver(object):
+  #  Drives the H-bridge.  Pins are set up once, a shadow copy of every pin's value is kept,
+  #  and each update only writes the pins that actually changed, in one backend call.
+  #  With a 'pwm_frequency' the enable pins are driven with PWM to control speed, otherwise they're tied high.
+  def __init__(self, backend, pins, enable_pins, pwm_frequency=None):
+    self.backend = backend
+    self.pins = pins  #  Name to BOARD pin number, for example {'right_sw_1': 15}.
+    self.enable_pins = enable_pins
+    self.pwm_frequency = pwm_frequency
+    self.counters = {'updates': 0, 'writes': 0, 'pins_written': 0, 'duty_cycle_changes': 0}
+    self.backend.setup_outputs(list(enable_pins) + list(pins.values()))
+    if pwm_frequency is None:
+      self.backend.write(list(enable_pins) + list(pins.values()), [1] * len(enable_pins) + [0] * len(pins))
+    else:
+      self.backend.write(list(pins.values()), [0] * len(pins))
+      for pin in enable_pins:
+        self.backend.setup_pwm(pin, pwm_frequency)
+    self.pin_names = list(pins)
+    self.pin_numbers = [pins[name] for name in self.pin_names]
+    self.shadow = [0] * len(self.pin_names)  #  In 'pin_names' order.
+    self.duty_cycle = 0 if pwm_frequency is not None else 100
+
+  def set_speed(self, duty_cycle):
+    #  Duty cycle in percent for both enable pins.  Does nothing without PWM.
+    if self.pwm_frequency is None or duty_cycle == self.duty_cycle:
+      return
+    self.duty_cycle = duty_cycle
+    self.counters['duty_cycle_changes'] += 1
+    for pin in self.enable_pins:
+      self.backend.set_duty_cycle(pin, duty_cycle)
+
+  def set_pin_states(self, pin_states):
+    #  'pin_states' maps pin names to 0 or 1.  Returns the number of pins written.
+    return self.set_pin_values([pin_states.get(name, self.shadow[i]) for i, name in enumerate(self.pin_names)])
+
+  def set_pin_values(self, values):
+    #  'values' has one 0 or 1 per pin, in 'pin_names' order.  Returns the number of pins written.
+    self.counters['updates'] += 1
+    changed_pins = []
+    changed_values = []
+    shadow = self.shadow
+    for i, value in enumerate(values):
+      if shadow[i] != value:
+        shadow[i] = value
+        changed_pins.append(self.pin_numbers[i])
+        changed_values.append(value)
+    if len(changed_pins):
+      self.backend.write(changed_pins, changed_values)
+      self.counters['writes'] += 1
+      self.counters['pins_written'] += len(changed_pins)
+    return len(changed_pins)
+
+  def stop(self):
+    return self.set_pin_values([0] * len(self.pin_names))
+
+  def cleanup(self):
+    self.stop()
+    if self.pwm_frequency is None:
+      self.backend.write(list(self.enable_pins), [0] * len(self.enable_pins))
+    else:
+      self.set_speed(0)
+    self.backend.cleanup()
+
+class RobotTankSpeedRamp(object):
+  #  Moves the motor driver's duty cycle towards a target by at most 'ramp_rate' percent per
+  #  second, one step per timer tick, instead of switching straight to full power.  The timer
+  #  runs in the connection manager's loop and is only active while there is ramping to do.
+  def __init__(self, connection_manager, motor_driver, tick_hz=50, ramp_rate=250.0):
+    self.connection_manager = connection_manager
+    self.motor_driver = motor_driver
+    self.tick_interval = 1.0 / tick_hz
+    self.step = ramp_rate / tick_hz
+    self.current = 0.0
+    self.target = 0.0
+    self.timer = None
+
+  def set_target(self, duty_cycle):
+    self.target = float(max(0, min(100, duty_cycle)))
+    if self.target != self.current and self.timer is None:
+      self.timer = self.connection_manager.call_every(self.tick_interval, self.tick)
+
+  def jump_to(self, duty_cycle):
+    #  Skip the ramp, used for stopping.
+    self.current = self.target = float(duty_cycle)
+    self.motor_driver.set_speed(self.current)
+    if self.timer is not None:
+      self.timer.cancel()
+      self.timer = None
+
+  def tick(self):
+    if self.current < self.target:
+      self.current = min(self.target, self.current + self.step)
+    else:
+      self.current = max(self.target, self.current - self.step)
+    self.motor_driver.set_speed(self.current)
+    if self.current == self.target:
+      self.timer.cancel()
+      self.timer = None
@@ -0,0 +1,138 @@
+import os
+import gc
+import time
+import resource
+from RobotTankStats import RobotTankLatencyHistogram
+from RobotTankLog import get_logger
+
+#  Opt-in real-time profile for the server process, so it isn't held up behind other processes,
+#  page faults or a full garbage collection when a stop command arrives.  Each part is tried on
+#  its own and skipped with a warning if it isn't allowed, so an unprivileged server still runs,
+#  just without it.  'applied' says what took effect.
+#
+#    fifo_priority  SCHED_FIFO priority (1-99) for the main thread, None to leave the scheduler alone
+#    cpus           CPUs to pin the process to, None for all of them
+#    lock_memory    mlockall() current and future memory, so nothing gets paged out
+#    gc_freeze      after startup, move every object so far into the permanent generation, so
+#                   later collections don't go through them again
+#    gc_threshold   (gen0, gen1, gen2) thresholds for gc.set_threshold(), None to leave them
+#
+#  Linux keeps 5% of each second for other tasks by default (sched_rt_runtime_us), so a SCHED_FIFO
+#  server stuck in a loop can't lock up the machine.
+ROBOT_TANK_MCL_CURRENT = 1
+ROBOT_TANK_MCL_FUTURE = 2
+
+class RobotTankRealtimeProfile(object):
+  def __init__(self, fifo_priority=None, cpus=None, lock_memory=False, gc_freeze=False, gc_threshold=None):
+    self.fifo_priority = fifo_priority
+    self.cpus = cpus
+    self.lock_memory = lock_memory
+    self.gc_freeze = gc_freeze
+    self.gc_threshold = gc_threshold
+    self.applied = {'sched_fifo': False, 'cpus': None, 'lock_memory': False, 'gc_frozen': 0, 'gc_threshold': None}
+    self.log = get_logger()
+
+  def apply(self):
+    #  Called once the server is set up, just before its loop starts.  Returns 'applied'.
+    #  New threads inherit the scheduler of the thread that starts them, and the log writer thread
+    #  is only started by the first record, so it's started here while the policy is still normal.
+    if self.log.background and self.log.thread is None:
+      self.log.start()
+    if self.cpus is not None:
+      self.set_affinity()
+    if self.fifo_priority is not None:
+      self.set_fifo_priority()
+    if self.lock_memory:
+      self.lock_all_memory()
+    if self.gc_threshold is not None:
+      gc.set_threshold(*self.gc_threshold)
+      self.applied['gc_threshold'] = gc.get_threshold()
+    if self.gc_freeze:
+      gc.collect()
+      gc.freeze()
+      self.applied['gc_frozen'] = gc.get_freeze_count()
+    self.log.info("Real-time profile applied", **self.applied)
+    return self.applied
+
+  def set_affinity(self):
+    try:
+      os.sched_setaffinity(0, self.cpus)
+      self.applied['cpus'] = sorted(os.sched_getaffinity(0))
+    except (AttributeError, OSError) as e:
+      self.log.warning("Unable to set CPU affinity", cpus=self.cpus, error=e)
+
+  def set_fifo_priority(self):
+    #  Only the calling thread.  The journal and log writer threads are already running by now,
+    #  so they stay at normal priority.
+    try:
+      os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.fifo_priority))
+      self.applied['sched_fifo'] = True
+    except (AttributeError, OSError) as e:
+      self.log.warning("Unable to set SCHED_FIFO priority", priority=self.fifo_priority, error=e)
+
+  def lock_all_memory(self):
+    #  Without CAP_IPC_LOCK the locked total is capped at RLIMIT_MEMLOCK, and with MCL_FUTURE
+    #  allocations past it would fail later on, so only lock when the limit can't be hit.
+    limit = resource.getrlimit(resource.RLIMIT_MEMLOCK)[0]
+    if os.geteuid() != 0 and limit != resource.RLIM_INFINITY:
+      self.log.warning("Not locking memory, the memory lock limit is too low", limit=limit)
+      return
+    try:
+      import ctypes
+      import ctypes.util
+      libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+      if libc.mlockall(ROBOT_TANK_MCL_CURRENT | ROBOT_TANK_MCL_FUTURE) != 0:
+        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+      self.applied['lock_memory'] = True
+    except (ImportError, AttributeError, OSError) as e:
+      self.log.warning("Unable to lock memory", error=e)
+
+class RobotTankJitterMonitor(object):
+  #  Measures how late the event loop gets to things.  A timer runs every 'interval' seconds and
+  #  records how long after it was due it actually ran, which is time spent waiting to be
+  #  scheduled, in other callbacks or in garbage collection.  poll() only sleeps in whole
+  #  milliseconds and rounds up, so up to 1ms of lateness is expected even on an idle machine.
+  #  Garbage collection pauses are recorded separately, with the number of collections per generation.
+  def __init__(self, connection_manager, interval=0.001):
+    self.connection_manager = connection_manager
+    self.clock = connection_manager.clock
+    self.interval = interval
+    self.lateness = RobotTankLatencyHistogram()
+    self.gc_pauses = RobotTankLatencyHistogram()
+    self.counters = {'ticks': 0, 'missed_ticks': 0, 'gc_collections': [0, 0, 0]}
+    self.gc_started = None
+    self.due = self.clock() + interval
+    self.timer = connection_manager.call_every(interval, self.tick)
+    gc.callbacks.append(self.on_gc)
+
+  def tick(self):
+    now = self.clock()
+    self.lateness.record(int((now - self.due) * 1000000))
+    self.counters['ticks'] += 1
+    #  Same as the connection manager's timers, missed ticks are skipped.
+    if self.due + self.interval > now:
+      self.due += self.interval
+    else:
+      self.counters['missed_ticks'] += int((now - self.due) / self.interval)
+      self.due = now + self.interval
+
+  def on_gc(self, phase, info):
+    if phase == 'start':
+      self.gc_started = time.perf_counter()
+    elif self.gc_started is not None:
+      self.gc_pauses.record(int((time.perf_counter() - self.gc_started) * 1000000))
+      self.counters['gc_collections'][info['generation']] += 1
+      self.gc_started = None
+
+  def summary(self):
+    return {
+      'interval_us': int(self.interval * 1000000),
+      'lateness': self.lateness.summary(),
+      'gc_pauses': self.gc_pauses.summary(),
+      'counters': {'ticks': self.counters['ticks'], 'missed_ticks': self.counters['missed_ticks'], 'gc_collections': list(self.counters['gc_collections'])}
+    }
+
+  def stop(self):
+    self.timer.cancel()
+    if self.on_gc in gc.callbacks:
+      gc.callbacks.remove(self.on_gc)
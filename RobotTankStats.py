@@ -0,0 +1,102 @@
+import collections
+
+class RobotTankLatencyHistogram(object):
+  #  Log-linear histogram of latencies in microseconds, laid out like HdrHistogram.  Values
+  #  below 2^sub_bucket_bits each get their own bucket, and above that every power of two is
+  #  split into 2^sub_bucket_bits buckets, so the error is under 1/2^sub_bucket_bits (6% with
+  #  the default) at any magnitude.  Recording is a handful of integer operations and the
+  #  counts are one fixed list, so it can stay on all the time.
+  def __init__(self, sub_bucket_bits=4, max_value_us=3600000000):
+    self.sub_bucket_bits = sub_bucket_bits
+    self.sub_buckets = 1 << sub_bucket_bits
+    self.max_value_us = max_value_us
+    self.counts = [0] * (self.bucket_index(max_value_us) + 1)
+    self.reset()
+
+  def reset(self):
+    for i in range(len(self.counts)):
+      self.counts[i] = 0
+    self.count = 0
+    self.total = 0
+    self.max = 0
+    self.negative = 0  #  Values below zero, from clock offset error.  Recorded as zero.
+
+  def bucket_index(self, value):
+    if value < self.sub_buckets:
+      return value
+    shift = value.bit_length() - self.sub_bucket_bits - 1
+    return ((shift + 1) << self.sub_bucket_bits) + (value >> shift) - self.sub_buckets
+
+  def bucket_range(self, index):
+    #  Returns (lowest value, width) of a bucket.
+    if index < self.sub_buckets:
+      return index, 1
+    shift = (index >> self.sub_bucket_bits) - 1
+    return (self.sub_buckets + (index & (self.sub_buckets - 1))) << shift, 1 << shift
+
+  def record(self, value):
+    #  'value' is a whole number of microseconds.  bucket_index() is inlined, this is called per event.
+    if value < 0:
+      self.negative += 1
+      value = 0
+    elif value > self.max_value_us:
+      value = self.max_value_us
+    if value < self.sub_buckets:
+      self.counts[value] += 1
+    else:
+      shift = value.bit_length() - self.sub_bucket_bits - 1
+      self.counts[((shift + 1) << self.sub_bucket_bits) + (value >> shift) - self.sub_buckets] += 1
+    self.count += 1
+    self.total += value
+    if value > self.max:
+      self.max = value
+
+  def percentile(self, p):
+    #  Middle of the bucket holding the p'th percentile value.
+    if self.count == 0:
+      return 0
+    rank = max(1, int(self.count * p / 100.0 + 0.5))
+    seen = 0
+    for i, c in enumerate(self.counts):
+      seen += c
+      if seen >= rank:
+        low, width = self.bucket_range(i)
+        return min(self.max, low + width // 2)
+    return self.max
+
+  def summary(self):
+    return {
+      'count': self.count,
+      'mean_us': self.total // self.count if self.count else 0,
+      'p50_us': self.percentile(50),
+      'p99_us': self.percentile(99),
+      'p999_us': self.percentile(99.9),
+      'max_us': self.max
+    }
+
+class RobotTankClockOffset(object):
+  #  NTP style estimate of how far a peer's clock is ahead of ours, from ping/pong exchanges:
+  #  t0 we send the ping, t1 the peer receives it, t2 the peer replies, t3 we get the reply
+  #  (microseconds, t1 and t2 on the peer's clock).  Of the last 'window' exchanges the one with
+  #  the shortest round trip is the least delayed by queueing, so its offset is used.
+  def __init__(self, window=16):
+    self.samples = collections.deque(maxlen=window)  #  (round trip, offset)
+    self.offset = None
+    self.round_trip = None
+
+  def add(self, t0, t1, t2, t3):
+    round_trip = (t3 - t0) - (t2 - t1)
+    self.samples.append((round_trip, ((t1 - t0) + (t2 - t3)) // 2))
+    self.round_trip, self.offset = min(self.samples)
+
+  def to_local(self, peer_time):
+    return peer_time - self.offset
+
+#  Stages of a key press on its way to the pins, all in microseconds:
+#    network  client stamp to the server reading it (needs a clock offset estimate)
+#    decode   read to the message being decoded
+#    resolve  decoded to the new pin states being resolved
+#    gpio     resolved to the pins being written
+#    server   read to the pins being written
+#    total    client stamp to the pins being written
+ROBOT_TANK_LATENCY_STAGES = ['network', 'decode', 'resolve', 'gpio', 'server', 'total']
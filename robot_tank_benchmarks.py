@@ -0,0 +1,1812 @@
+import sys
+import time
+import socket
+import select
+import asyncio
+import threading
+import random
+import os
+import struct
+import shutil
+import tempfile
+import tracemalloc
+import io
+import contextlib
+import signal
+from RobotTankConnectionManager import RobotTankConnectionManager
+from RobotTankConnectionManager import RobotTankMessage
+from RobotTankConnectionManager import RobotTankMessageDecoder
+from RobotTankConnectionManager import RobotTankBinaryMessage
+from RobotTankConnectionManager import RobotTankPollSelector
+from RobotTankConnectionManager import RobotTankEpollSelector
+from RobotTankConnectionManager import RobotTankSocketOptions
+from RobotTankConnectionManager import RobotTankControlDatagram
+from RobotTankConnectionManager import RobotTankSequenceFilter
+from RobotTankConnectionManager import RobotTankControlSender
+from RobotTankConnectionManager import RobotTankConnection
+from RobotTankConnectionManager import RobotTankBackoff
+from robot_tank_udp_proxy import RobotTankLossyUdpProxy
+from PyKeyUpKeyDown import PyKeyUpKeyDown
+from PyKeyUpKeyDownEvdev import PyKeyUpKeyDownEvdev
+from RobotTankMotorDriver import RobotTankMotorDriver
+from RobotTankMotorDriver import RobotTankFakeGpioBackend
+from RobotTankDirections import RobotTankDirectionResolver
+from RobotTankDirections import load_direction_config
+from robot_tank_server import RobotTankServer
+from RobotTankStats import RobotTankLatencyHistogram
+from RobotTankStats import RobotTankClockOffset
+from RobotTankStats import ROBOT_TANK_LATENCY_STAGES
+from RobotTankLog import RobotTankLogger
+from RobotTankLog import get_logger
+from RobotTankLog import ROBOT_TANK_LOG_DEBUG
+from RobotTankLog import ROBOT_TANK_LOG_WARNING
+from RobotTankLog import ROBOT_TANK_LOG_ERROR
+import RobotTankAsyncio
+from robot_tank_simulator import RobotTankSimulation
+from robot_tank_simulator import RobotTankScriptedKeyboard
+from robot_tank_client import RobotTankClient
+import json
+from robot_tank_replay import RobotTankJournalReplay
+from RobotTankJournal import RobotTankJournalWriter
+from RobotTankJournal import ROBOT_TANK_JOURNAL_MESSAGE
+from RobotTankCommandSlot import RobotTankCommandSlotWriter
+from RobotTankRealtime import RobotTankRealtimeProfile
+
+#  Benchmarks for the robot tank control path.  These only need a Linux box, no Pi.
+#  Run all of them with:
+#
+#    python3 robot_tank_benchmarks.py
+#
+#  or a single one by name, for example:
+#
+#    python3 robot_tank_benchmarks.py reads
+
+def example_keyboard_event(i):
+  return {'keyboard_event': {'keycode': 17, 'key': '+w', 'is_up': bool(i % 2)}}
+
+def report(name, results):
+  sys.stdout.write("%-40s" % (name))
+  for k in results:
+    v = results[k]
+    if isinstance(v, float):
+      sys.stdout.write(" %s=%.3f" % (k, v))
+    else:
+      sys.stdout.write(" %s=%s" % (k, str(v)))
+  sys.stdout.write("\n")
+
+def latency_summary(samples):
+  #  Latency samples are in seconds, reported in microseconds.
+  s = sorted(samples)
+  return {
+    'p50_us': s[len(s) // 2] * 1e6,
+    'p99_us': s[min(len(s) - 1, (len(s) * 99) // 100)] * 1e6,
+    'max_us': s[-1] * 1e6
+  }
+
+def bench_reads_with_manager(manager_args, num_messages, burst_size):
+  writer, reader = socket.socketpair()
+  manager = RobotTankConnectionManager(**manager_args)
+  manager.register_socket(reader, 'socketpair', ['bench'])
+  frame = RobotTankMessage(example_keyboard_event(0)).serialize()
+  burst = bytes(frame) * burst_size
+  received = [0]
+
+  def on_read(fd, socket_details):
+    received[0] += len(manager.remove_from_read_buffer(fd))
+
+  manager.register_class_callback('read', 'bench', on_read)
+  start = time.perf_counter()
+  sent = 0
+  while sent < num_messages:
+    writer.sendall(burst)
+    sent += burst_size
+    while received[0] < sent * len(frame):
+      manager.run(1000)
+  elapsed = time.perf_counter() - start
+  writer.close()
+  manager.close_connection(reader.fileno())
+  return {
+    'msgs_per_sec': sent / elapsed,
+    'syscalls_per_msg': manager.counters['read_syscalls'] / float(sent),
+    'wakeups_per_msg': manager.counters['wakeups'] / float(sent)
+  }
+
+def frame_then_close(selector):
+  #  The peer sends one frame and closes before the manager gets to it, so the frame and the FIN
+  #  arrive in one wakeup.  Edge triggered sockets must still see the close.  Over TCP, because a
+  #  closed socketpair also reports POLLHUP, which would close it anyway.
+  listener = socket.create_server(('127.0.0.1', 0))
+  writer = socket.create_connection(listener.getsockname())
+  reader = listener.accept()[0]
+  listener.close()
+  manager = RobotTankConnectionManager(selector=selector)
+  manager.register_socket(reader, 'socketpair', ['bench'])
+  fd = reader.fileno()
+  received = []
+  closed = []
+  manager.register_class_callback('read', 'bench', lambda fd, socket_details: received.extend(manager.iter_messages(fd)))
+  manager.register_class_callback('close', 'bench', lambda fd, socket_details: closed.append(fd))
+  writer.sendall(RobotTankMessage(example_keyboard_event(0)).serialize())
+  writer.close()
+  for i in range(10):
+    manager.run(100)
+  return {'messages': len(received), 'closed': closed == [fd], 'unregistered': fd not in manager.socket_map}
+
+def bench_reads():
+  #  Before: one byte per wakeup, which is how the connection manager used to read.
+  report("reads before (1 byte per wakeup)", bench_reads_with_manager({'recv_size': 1, 'read_budget': 1}, 2000, 32))
+  report("reads after (drain per wakeup)", bench_reads_with_manager({}, 200000, 32))
+  report("reads frame then close, poll", frame_then_close(RobotTankPollSelector()))
+  report("reads frame then close, epoll", frame_then_close(RobotTankEpollSelector()))
+
+def bench_decode_chunks(chunks, num_messages):
+  decoder = RobotTankMessageDecoder()
+  decoded = 0
+  start = time.perf_counter()
+  for chunk in chunks:
+    decoder.feed(chunk)
+    for m in decoder.messages():
+      decoded += 1
+  elapsed = time.perf_counter() - start
+  assert(decoded == num_messages)
+  return {'msgs_per_sec': decoded / elapsed, 'leftover_bytes': len(decoder.buf)}
+
+def bench_decode():
+  num_messages = 100000
+  frames = [bytes(RobotTankMessage(example_keyboard_event(i)).serialize()) for i in range(num_messages)]
+  stream = b''.join(frames)
+  #  One frame per chunk, the best case for the old exact-size-only decoder.
+  report("decode one frame per read", bench_decode_chunks(frames, num_messages))
+  #  Many frames coalesced into each chunk, like TCP does under load.
+  chunk_size = 64 * 1024
+  coalesced = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+  report("decode coalesced frames (64KiB reads)", bench_decode_chunks(coalesced, num_messages))
+  #  Frames split across chunks at odd boundaries.
+  split = [stream[i:i + 7] for i in range(0, len(stream), 7)]
+  report("decode split frames (7 byte reads)", bench_decode_chunks(split, num_messages))
+
+def ns_per_op(f, iterations):
+  start = time.perf_counter()
+  for i in range(iterations):
+    f(i)
+  return (time.perf_counter() - start) * 1e9 / iterations
+
+def bench_serialize_format(name, encode, iterations):
+  decoder = RobotTankMessageDecoder()
+  frame = bytes(encode(0))
+  payload = frame[4:]
+  assert(decoder.decode_payload(payload)['keyboard_event']['keycode'] == 17)
+  report(name, {
+    'bytes_on_wire': len(frame),
+    'encode_ns_per_op': ns_per_op(encode, iterations),
+    'decode_ns_per_op': ns_per_op(lambda i: decoder.decode_payload(payload), iterations)
+  })
+
+def bench_serialize():
+  iterations = 200000
+  bench_serialize_format("serialize json", lambda i: RobotTankMessage(example_keyboard_event(i)).serialize(), iterations)
+  bench_serialize_format("serialize binary1", lambda i: RobotTankBinaryMessage(example_keyboard_event(i)['keyboard_event'], i).serialize(), iterations)
+
+def bench_idle_connections(selector, num_idle, num_active, rounds):
+  manager = RobotTankConnectionManager(selector=selector)
+  pairs = []
+  for i in range(num_idle + num_active):
+    pairs.append(socket.socketpair())
+    manager.register_socket(pairs[-1][1], 'socketpair', ['idle' if i < num_idle else 'active'])
+  active = [p for p in pairs[num_idle:]]
+  frame = bytes(RobotTankMessage(example_keyboard_event(0)).serialize())
+
+  def on_active_read(fd, socket_details):
+    #  Echo every message back so that write interest gets armed and disarmed.
+    for m in manager.iter_messages(fd):
+      manager.add_to_write_buffer(fd, frame)
+
+  manager.register_class_callback('read', 'active', on_active_read)
+  for k in manager.counters:
+    manager.counters[k] = 0
+  start = time.process_time()
+  for r in range(rounds):
+    for writer, reader in active:
+      writer.sendall(frame)
+    for writer, reader in active:
+      received = 0
+      while received < len(frame):
+        manager.run(0)
+        try:
+          received += len(writer.recv(len(frame) - received, socket.MSG_DONTWAIT))
+        except BlockingIOError:
+          pass
+  elapsed = time.process_time() - start
+  num_messages = float(rounds * num_active)
+  for writer, reader in pairs:
+    writer.close()
+    manager.close_connection(reader.fileno())
+  return {
+    'cpu_us_per_msg': elapsed * 1e6 / num_messages,
+    'wakeups_per_msg': manager.counters['wakeups'] / num_messages,
+    'spurious_per_msg': manager.counters['spurious_wakeups'] / num_messages,
+    'modify_per_msg': manager.counters['modify_calls'] / num_messages
+  }
+
+def bench_idle():
+  #  CPU per message should stay flat for epoll as the number of idle connections grows.
+  for num_idle in [0, 100, 500, 1000]:
+    report("idle poll   %4u idle + 4 active" % (num_idle), bench_idle_connections(RobotTankPollSelector(), num_idle, 4, 1000))
+    report("idle epoll  %4u idle + 4 active" % (num_idle), bench_idle_connections(RobotTankEpollSelector(), num_idle, 4, 1000))
+
+def bench_latency_poll_loop(num_events):
+  writer, reader = socket.socketpair()
+  manager = RobotTankConnectionManager()
+  manager.register_socket(reader, 'socketpair', ['bench'])
+  samples = []
+
+  def on_read(fd, socket_details):
+    for m in manager.iter_messages(fd):
+      samples.append(time.perf_counter() - m['t'])
+
+  manager.register_class_callback('read', 'bench', on_read)
+  for i in range(num_events):
+    writer.sendall(RobotTankMessage({'keyboard_event': example_keyboard_event(i)['keyboard_event'], 't': time.perf_counter()}).serialize())
+    while len(samples) <= i:
+      manager.run(1000)
+  writer.close()
+  manager.close_connection(reader.fileno())
+  return samples
+
+async def bench_latency_asyncio_loop(num_events):
+  samples = []
+  received = asyncio.Event()
+
+  def on_server_message(protocol, m):
+    samples.append(time.perf_counter() - m['t'])
+    received.set()
+
+  server, client = await RobotTankAsyncio.open_loopback_pair(on_server_message, lambda protocol, m: None)
+  for i in range(num_events):
+    received.clear()
+    client.send_message(RobotTankMessage({'keyboard_event': example_keyboard_event(i)['keyboard_event'], 't': time.perf_counter()}))
+    await received.wait()
+  client.close()
+  server.close()
+  return samples
+
+def bench_latency():
+  #  Time from a key event being sent to its handler running on the other end of a socketpair.
+  num_events = 20000
+  report("latency poll loop", latency_summary(bench_latency_poll_loop(num_events)))
+  loop = RobotTankAsyncio.new_event_loop()
+  try:
+    report("latency asyncio (%s)" % (type(loop).__module__), latency_summary(loop.run_until_complete(bench_latency_asyncio_loop(num_events))))
+  finally:
+    loop.close()
+
+class EchoServerThread(object):
+  #  Loopback TCP server that sends every message straight back, run by its own connection manager.
+  def __init__(self, manager_args):
+    self.manager = RobotTankConnectionManager(**manager_args)
+    listen_fd = self.manager.register_listen_socket('127.0.0.1', 0, ['listen'])
+    self.port = self.manager.socket_map[listen_fd]['socket'].getsockname()[1]
+    self.manager.register_class_callback('read', 'listen', self.on_connect)
+    self.manager.register_class_callback('read', 'echo', self.on_read)
+    self.done = False
+    self.thread = threading.Thread(target=self.run)
+    self.thread.start()
+
+  def on_connect(self, fd, socket_details):
+    conn, addr = socket_details['socket'].accept()
+    self.manager.register_socket(conn, addr, ['echo'])
+
+  def on_read(self, fd, socket_details):
+    for m in self.manager.iter_messages(fd):
+      self.manager.add_to_write_buffer(fd, RobotTankMessage(m).serialize())
+
+  def run(self):
+    while not self.done:
+      self.manager.run(10)
+
+  def stop(self):
+    self.done = True
+    self.thread.join()
+    for fd in list(self.manager.socket_map.keys()):
+      self.manager.close_connection(fd)
+
+def bench_rtt_with_options(manager_args, rounds):
+  server = EchoServerThread(manager_args)
+  manager = RobotTankConnectionManager(**manager_args)
+  sock = socket.create_connection(('127.0.0.1', server.port))
+  manager.register_socket(sock, '127.0.0.1', ['client'])
+  fd = sock.fileno()
+  received = [0]
+
+  def on_read(fd, socket_details):
+    for m in manager.iter_messages(fd):
+      received[0] += 1
+
+  manager.register_class_callback('read', 'client', on_read)
+  samples = []
+  for i in range(rounds):
+    #  A key up quickly followed by a key down, as two separate small writes.
+    start = time.perf_counter()
+    manager.add_to_write_buffer(fd, RobotTankMessage(example_keyboard_event(0)).serialize())
+    manager.run(0)
+    manager.add_to_write_buffer(fd, RobotTankMessage(example_keyboard_event(1)).serialize())
+    while received[0] < 2 * (i + 1):
+      manager.run(1000)
+    samples.append(time.perf_counter() - start)
+  manager.close_connection(fd)
+  server.stop()
+  return samples
+
+def bench_rtt():
+  rounds = 300
+  configurations = [
+    ("rtt all options off", {'socket_options': RobotTankSocketOptions(nodelay=False, quickack=False, keepalive=False, low_delay_tos=False), 'try_send_immediately': False}),
+    ("rtt nodelay", {'socket_options': RobotTankSocketOptions(nodelay=True, quickack=False, keepalive=False, low_delay_tos=False), 'try_send_immediately': False}),
+    ("rtt nodelay+quickack", {'socket_options': RobotTankSocketOptions(nodelay=True, quickack=True, keepalive=False, low_delay_tos=False), 'try_send_immediately': False}),
+    ("rtt immediate send only", {'socket_options': RobotTankSocketOptions(nodelay=False, quickack=False, keepalive=False, low_delay_tos=False), 'try_send_immediately': True}),
+    ("rtt defaults (everything on)", {})
+  ]
+  for name, manager_args in configurations:
+    report(name, latency_summary(bench_rtt_with_options(manager_args, rounds)))
+
+def bench_udp_with_loss(loss, reorder, cycles, hold_time, rate_hz):
+  manager = RobotTankConnectionManager()
+  server_fd = manager.register_udp_socket('127.0.0.1', 0, ['server'])
+  server_port = manager.socket_map[server_fd]['socket'].getsockname()[1]
+  proxy = RobotTankLossyUdpProxy(manager, '127.0.0.1', 0, ('127.0.0.1', server_port), loss=loss, reorder=reorder, seed=1234)
+  client_fd = manager.register_udp_socket(None, None, ['client'], remote=('127.0.0.1', proxy.get_listen_port()))
+  sender = RobotTankControlSender(manager, client_fd, rate_hz)
+  sequence_filter = RobotTankSequenceFilter()
+  server_state = {'pressed': False}
+  changes = {'at': None, 'pressed': None}
+  control_samples = []
+  stop_samples = []
+
+  def on_server_read(fd, socket_details):
+    for data, address in manager.remove_datagrams(fd):
+      d = RobotTankControlDatagram.decode(data)
+      if d is not None and sequence_filter.accept(address, d.session, d.sequence_number):
+        pressed = 'forward' in d.pressed
+        if pressed != server_state['pressed']:
+          server_state['pressed'] = pressed
+          if changes['at'] is not None and pressed == changes['pressed']:
+            (control_samples if pressed else stop_samples).append(manager.clock() - changes['at'])
+            changes['at'] = None
+
+  def toggle(pressed):
+    changes['at'] = manager.clock()
+    changes['pressed'] = pressed
+    sender.set_direction('forward', pressed)
+
+  manager.register_class_callback('read', 'server', on_server_read)
+  for i in range(cycles):
+    manager.call_later(2 * i * hold_time, lambda: toggle(True))
+    manager.call_later((2 * i + 1) * hold_time, lambda: toggle(False))
+  end = manager.clock() + 2 * cycles * hold_time + 0.2
+  while manager.clock() < end:
+    manager.run(10)
+  sender.stop()
+  for fd in list(manager.socket_map.keys()):
+    manager.close_connection(fd)
+  results = {'loss': loss, 'stale_dropped': sequence_filter.dropped}
+  for k, v in latency_summary(control_samples).items():
+    results['control_' + k] = v
+  for k, v in latency_summary(stop_samples).items():
+    results['stop_' + k] = v
+  return results
+
+def udp_sessions_check():
+  #  Two clients announce UDP sessions in their hellos and the first one claims control.  Only
+  #  snapshots for the controller's session may move the tank.
+  server = RobotTankServer(False, gpio_backend='fake', listen_address='127.0.0.1', listen_port=0, udp_port=0, ping_interval=None, idle_timeout=None, deadman_timeout_ms=None)
+  udp_address = server.connection_manager.socket_map[server.control_datagram_fd]['socket'].getsockname()
+  sockets = []
+  for session in [1, 2]:
+    server_sock, client_sock = socket.socketpair()
+    server.add_keyboard_client(server_sock, 'bench')
+    client_sock.send(RobotTankMessage({'hello': {'version': 1, 'wire_formats': ['json'], 'udp_session': session}}).serialize())
+    sockets.append(client_sock)
+  sockets[0].send(RobotTankMessage({'control': 'claim'}).serialize())
+  server.connection_manager.run(0)
+  sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  results = {}
+  for sequence_number, (name, session, pressed) in enumerate([('spectator_moved', 2, ['forward']), ('unknown_moved', 3, ['forward']), ('controller_moved', 1, ['forward'])]):
+    sender.sendto(RobotTankControlDatagram(session, sequence_number + 1, pressed, pressed[-1]).serialize(), udp_address)
+    #  Each datagram is either rejected or moves the tank.
+    deadline = time.monotonic() + 1.0
+    while server.counters['udp_rejected'] + int(any(server.current_pin_values)) <= sequence_number and time.monotonic() < deadline:
+      server.connection_manager.run(10)
+    results[name] = any(server.current_pin_values)
+  results['udp_rejected'] = server.counters['udp_rejected']
+  sender.close()
+  for sock in sockets:
+    sock.close()
+  server.connection_manager.run(0)
+  server.connection_manager.cleanup()
+  return results
+
+def bench_udp():
+  #  Control and stop latency over a lossy, reordering proxy.  Snapshots go out on every
+  #  change and then at 50Hz, so a lost datagram costs at most one 20ms period.
+  for loss in [0.0, 0.05, 0.10, 0.20]:
+    report("udp loss %2u%%" % (int(loss * 100)), bench_udp_with_loss(loss, 0.1, 40, 0.05, 50))
+  sessions = udp_sessions_check()
+  report("udp sessions", sessions)
+  if sessions['spectator_moved'] or sessions['unknown_moved'] or not sessions['controller_moved']:
+    raise Exception("UDP snapshots weren't limited to the controller's session.")
+
+def random_mediumraw_stream(r, num_keys):
+  #  Mix of 1 byte keycodes and 3 byte extended keycodes, up and down, plus some extended keycodes
+  #  cut short after their first byte.  Those come out as keycode 0 followed by the next key.
+  #  Returns the stream and the (keycode, is_up) events it encodes.
+  stream = bytearray(b'')
+  expected = []
+  for i in range(num_keys):
+    up = 0x80 if r.random() < 0.5 else 0
+    choice = r.random()
+    if choice < 0.7:
+      kc = r.randint(1, 127)
+      stream.append(up | kc)
+      expected.append((kc, bool(up)))
+    elif choice < 0.95:
+      kc = r.randint(128, 16383)
+      stream += bytes([up, 0x80 | (kc >> 7), 0x80 | (kc & 0x7f)])
+      expected.append((kc, bool(up)))
+    else:
+      kc = r.randint(1, 127)
+      stream += bytes([up, kc])
+      expected += [(0, bool(up)), (kc, False)]
+  return stream, expected
+
+def bench_keys():
+  #  Fuzz:  decoding a stream in one go, and split at random read boundaries, must both give
+  #  exactly the events it was generated from.
+  r = random.Random(42)
+  for trial in range(200):
+    stream, expected = random_mediumraw_stream(r, 500)
+    assert([(e['keycode'], e['is_up']) for e in PyKeyUpKeyDown().key_events(stream)] == expected)
+    listener = PyKeyUpKeyDown()
+    events = []
+    i = 0
+    while i < len(stream):
+      n = r.randint(1, 8)
+      events += listener.key_events(stream[i:i + n])
+      i += n
+    assert([(e['keycode'], e['is_up']) for e in events] == expected)
+  report("keys fuzz", {'trials': 200, 'result': 'ok'})
+  #  Throughput for big reads.
+  listener = PyKeyUpKeyDown()
+  stream = random_mediumraw_stream(r, 100000)[0]
+  start = time.perf_counter()
+  num_events = 0
+  for i in range(0, len(stream), 64):
+    num_events += len(listener.key_events(stream[i:i + 64]))
+  elapsed = time.perf_counter() - start
+  report("keys decode 64 byte reads", {'events_per_sec': num_events / elapsed})
+
+def make_evdev_recording(r, num_keys):
+  #  Looks like 'cat /dev/input/eventN > file':  each key press is EV_MSC, EV_KEY and EV_SYN records.
+  input_event = struct.Struct("llHHi")
+  recording = bytearray(b'')
+  expected = []
+  t = 1000.0
+  for i in range(num_keys):
+    code = r.choice([17, 30, 31, 32])
+    value = r.choice([0, 1, 2])
+    t += 0.001
+    sec, usec = int(t), int((t - int(t)) * 1000000)
+    recording += input_event.pack(sec, usec, 4, 4, code)
+    recording += input_event.pack(sec, usec, 1, code, value)
+    recording += input_event.pack(sec, usec, 0, 0, 0)
+    if value != 2:
+      expected.append((code, value == 0, sec + usec / 1000000.0))
+  return recording, expected
+
+def bench_evdev():
+  #  Replay a recording through a pipe into the connection manager, the way the client reads the keyboard.
+  r = random.Random(7)
+  recording, expected = make_evdev_recording(r, 50000)
+  read_fd, write_fd = os.pipe()
+  listener = PyKeyUpKeyDownEvdev()
+  listener.use_file_descriptor(read_fd)
+  manager = RobotTankConnectionManager()
+  manager.register_file_descriptor(read_fd, ['keyboard_type'])
+  events = []
+
+  def on_keyboard_type(fd, socket_details):
+    events.extend(listener.key_events(manager.remove_from_read_buffer(fd)))
+
+  manager.register_class_callback('read', 'keyboard_type', on_keyboard_type)
+  start = time.perf_counter()
+  i = 0
+  while i < len(recording):
+    #  Odd sized writes so that records get split across reads.
+    n = r.randint(1, 2000)
+    os.write(write_fd, recording[i:i + n])
+    i += n
+    manager.run(0)
+  while manager.counters['bytes_read'] < len(recording):
+    manager.run(0)
+  elapsed = time.perf_counter() - start
+  assert([(e['keycode'], e['is_up'], e['time']) for e in events] == expected)
+  report("evdev replay through pipe", {
+    'events_per_sec': len(events) / elapsed,
+    'reads_per_event': manager.counters['read_syscalls'] / float(len(events))
+  })
+  manager.close_connection(read_fd)
+  os.close(read_fd)
+  os.close(write_fd)
+
+class ScriptedDumpkeysKeyListener(PyKeyUpKeyDown):
+  #  Uses the real dumpkeys when it can, otherwise a canned copy of typical dumpkeys output.
+  def get_keymap_as_string(self):
+    if shutil.which('dumpkeys') is not None:
+      s = PyKeyUpKeyDown.get_keymap_as_string(self)
+      if s:
+        return s
+    lines = ["keymaps 0-127", "strings as usual"]
+    for kc in range(1, 256):
+      lines.append("keycode %3u = +%s %s %s" % (kc, chr(ord('a') + kc % 26), "Shift_" + str(kc), "Control_" + str(kc)))
+      lines.append("\tshift\tkeycode %3u = +%s" % (kc, chr(ord('A') + kc % 26)))
+    return "\n".join(lines) + "\n"
+
+def bench_keymap():
+  cache_dir = tempfile.mkdtemp()
+  source_file = os.path.join(cache_dir, 'keyboard')
+  with open(source_file, 'w') as f:
+    f.write('XKBLAYOUT="us"\n')
+  try:
+    for name in ["keymap startup cold cache", "keymap startup warm cache"]:
+      listener = ScriptedDumpkeysKeyListener(keymap_cache_dir=cache_dir)
+      listener.keymap_source_files = [source_file]
+      start = time.perf_counter()
+      listener.set_keymap(listener.load_keymap())
+      report(name, {'ms': (time.perf_counter() - start) * 1000.0, 'keys': len(listener.keymap)})
+  finally:
+    shutil.rmtree(cache_dir)
+  #  Per event key name lookup.
+  iterations = 500000
+  keycodes = [r % 300 for r in range(iterations)]
+  start = time.perf_counter()
+  for kc in keycodes:
+    listener.keymap[kc] if kc in listener.keymap else None
+  dict_ns = (time.perf_counter() - start) * 1e9 / iterations
+  table = listener.keymap_table
+  start = time.perf_counter()
+  for kc in keycodes:
+    table[kc] if kc < len(table) else None
+  table_ns = (time.perf_counter() - start) * 1e9 / iterations
+  report("keymap lookup", {'dict_ns_per_op': dict_ns, 'table_ns_per_op': table_ns})
+
+EXAMPLE_PIN_STATES = [
+  {'right_sw_1': 0, 'right_sw_2': 0, 'left_sw_1': 0, 'left_sw_2': 0},
+  {'right_sw_1': 1, 'right_sw_2': 0, 'left_sw_1': 1, 'left_sw_2': 0},
+  {'right_sw_1': 0, 'right_sw_2': 1, 'left_sw_1': 0, 'left_sw_2': 1},
+  {'right_sw_1': 1, 'right_sw_2': 0, 'left_sw_1': 0, 'left_sw_2': 0},
+  {'right_sw_1': 0, 'right_sw_2': 0, 'left_sw_1': 1, 'left_sw_2': 0}
+]
+EXAMPLE_PINS = {'right_sw_1': 15, 'right_sw_2': 13, 'left_sw_1': 18, 'left_sw_2': 16}
+
+class CountingGpioModule(object):
+  #  Stands in for the RPi.GPIO module and counts calls.
+  BOARD = 10
+  OUT = 0
+
+  def __init__(self):
+    self.calls = 0
+
+  def setmode(self, mode):
+    self.calls += 1
+
+  def setup(self, pin, mode):
+    self.calls += 1
+
+  def output(self, pin, value):
+    self.calls += 1
+
+def bench_gpio():
+  r = random.Random(3)
+  changes = [r.choice(EXAMPLE_PIN_STATES) for i in range(100000)]
+  #  Before:  every change re-initialized every pin and then wrote all four pins one at a time.
+  gpio = CountingGpioModule()
+  start = time.perf_counter()
+  for pin_states in changes:
+    gpio.setmode(gpio.BOARD)
+    for pin in [11, 22]:
+      gpio.setup(pin, gpio.OUT)
+      gpio.output(pin, 1)
+    for name in EXAMPLE_PINS:
+      gpio.setup(EXAMPLE_PINS[name], gpio.OUT)
+    for name in EXAMPLE_PINS:
+      gpio.output(EXAMPLE_PINS[name], pin_states[name])
+  elapsed = time.perf_counter() - start
+  report("gpio before (re-init + 4 writes)", {'calls_per_change': gpio.calls / float(len(changes)), 'us_per_change': elapsed * 1e6 / len(changes)})
+  #  After:  pins set up once, only changed pins written, in one call.
+  backend = RobotTankFakeGpioBackend()
+  driver = RobotTankMotorDriver(backend, EXAMPLE_PINS, [11, 22])
+  calls_after_setup = backend.calls
+  #  The server passes pin state tuples in the driver's pin order, see RobotTankDirectionResolver.
+  values = [tuple(pin_states[name] for name in driver.pin_names) for pin_states in changes]
+  start = time.perf_counter()
+  for pin_values in values:
+    driver.set_pin_values(pin_values)
+  elapsed = time.perf_counter() - start
+  report("gpio motor driver", {
+    'calls_per_change': (backend.calls - calls_after_setup) / float(len(changes)),
+    'pins_per_change': driver.counters['pins_written'] / float(len(changes)),
+    'us_per_change': elapsed * 1e6 / len(changes)
+  })
+
+class PriorityScanDirections(object):
+  #  The server's old direction handling:  an if/elif chain per key, a priority counter on
+  #  every direction, a scan for the highest priority and an if/elif ladder to pin states.
+  def __init__(self):
+    self.directions = {
+      'forward' : {'pressed': False, 'priority': 0},
+      'reverse' : {'pressed': False, 'priority': 0},
+      'right' : {'pressed': False, 'priority': 0},
+      'left' : {'pressed': False, 'priority': 0}
+    }
+
+  def direction_update(self, direction, new_state):
+    if new_state:
+      for d in self.directions:
+        self.directions[d]['priority'] += 1
+      self.directions[direction]['priority'] = 0
+    if self.directions[direction]['pressed'] != new_state:
+      self.directions[direction]['pressed'] = new_state
+
+  def on_keyboard_event(self, e):
+    if e['key'] == '+w' and e['is_up']:
+      self.direction_update('forward', False)
+    elif e['key'] == '+w' and not e['is_up']:
+      self.direction_update('forward', True)
+    if e['key'] == '+s' and e['is_up']:
+      self.direction_update('reverse', False)
+    elif e['key'] == '+s' and not e['is_up']:
+      self.direction_update('reverse', True)
+    if e['key'] == '+a' and e['is_up']:
+      self.direction_update('left', False)
+    elif e['key'] == '+a' and not e['is_up']:
+      self.direction_update('left', True)
+    if e['key'] == '+d' and e['is_up']:
+      self.direction_update('right', False)
+    elif e['key'] == '+d' and not e['is_up']:
+      self.direction_update('right', True)
+
+  def pin_states(self):
+    lowest_number = 999
+    the_direction = None
+    for d in self.directions:
+      if self.directions[d]['pressed'] and self.directions[d]['priority'] < lowest_number:
+        lowest_number = self.directions[d]['priority']
+        the_direction = d
+    if the_direction is None:
+      return the_direction, {'right_sw_1': 0, 'right_sw_2': 0, 'left_sw_1': 0, 'left_sw_2': 0}
+    elif the_direction == 'forward':
+      return the_direction, {'right_sw_1': 1, 'right_sw_2': 0, 'left_sw_1': 1, 'left_sw_2': 0}
+    elif the_direction == 'reverse':
+      return the_direction, {'right_sw_1': 0, 'right_sw_2': 1, 'left_sw_1': 0, 'left_sw_2': 1}
+    elif the_direction == 'right':
+      return the_direction, {'right_sw_1': 1, 'right_sw_2': 0, 'left_sw_1': 0, 'left_sw_2': 0}
+    elif the_direction == 'left':
+      return the_direction, {'right_sw_1': 0, 'right_sw_2': 0, 'left_sw_1': 1, 'left_sw_2': 0}
+
+def bench_directions():
+  r = random.Random(4)
+  keys = ['+w', '+s', '+a', '+d', '+q']
+  events = [{'key': r.choice(keys), 'is_up': r.random() < 0.5} for i in range(200000)]
+  old = PriorityScanDirections()
+  start = time.perf_counter()
+  for e in events:
+    old.on_keyboard_event(e)
+    old.pin_states()
+  elapsed = time.perf_counter() - start
+  report("directions priority scan", {'ns_per_event': elapsed * 1e9 / len(events)})
+  resolver = RobotTankDirectionResolver(load_direction_config())
+  key_directions = resolver.key_directions
+  start = time.perf_counter()
+  for e in events:
+    index = key_directions.get(e['key'])
+    if index is not None:
+      resolver.set_direction(index, not e['is_up'])
+    resolver.resolve()
+  elapsed = time.perf_counter() - start
+  report("directions resolver table", {'ns_per_event': elapsed * 1e9 / len(events)})
+  #  Check the two agree whenever the held directions aren't a combination from the config.
+  old = PriorityScanDirections()
+  resolver = RobotTankDirectionResolver(load_direction_config())
+  mismatches = 0
+  combinations = 0
+  for e in events:
+    old.on_keyboard_event(e)
+    index = resolver.key_directions.get(e['key'])
+    if index is not None:
+      resolver.set_direction(index, not e['is_up'])
+    direction, pin_values = resolver.resolve()
+    if direction is not None and '+' in direction:
+      combinations += 1
+      continue
+    old_direction, old_pin_states = old.pin_states()
+    if old_direction != direction or tuple(old_pin_states[name] for name in resolver.pin_names) != pin_values:
+      mismatches += 1
+  report("directions check", {'combinations': combinations, 'mismatches': mismatches})
+  if mismatches:
+    raise Exception("Direction resolver disagrees with the priority scan.")
+
+class FakeClock(object):
+  #  Stands in for time.monotonic so timers can be driven without waiting.
+  def __init__(self, now=1000.0):
+    self.now = now
+
+  def __call__(self):
+    return self.now
+
+  def advance(self, seconds):
+    self.now += seconds
+
+def send_to_server(server, client_sock, o):
+  client_sock.send(RobotTankMessage(o).serialize())
+  server.connection_manager.run(0)
+
+def bench_deadman():
+  #  Fake clock:  the motors must keep going while heartbeats arrive and stop once they don't.
+  clock = FakeClock()
+  server = RobotTankServer(False, gpio_backend='fake', deadman_timeout_ms=300, idle_timeout=2.0, clock=clock)
+  pin_values = server.motor_driver.shadow  #  Direction pins only, the enable pins stay high.
+  server_sock, client_sock = socket.socketpair()
+  server.add_keyboard_client(server_sock, 'fake')
+  send_to_server(server, client_sock, {'keyboard_event': {'keycode': 17, 'key': '+w', 'is_up': False}})
+  moving_at_start = any(pin_values)
+  for i in range(5):
+    clock.advance(0.25)
+    send_to_server(server, client_sock, {'heartbeat': i})
+  last_input = clock()
+  moving_with_heartbeats = any(pin_values)
+  while any(pin_values) and clock() - last_input < 1.0:
+    clock.advance(0.001)
+    server.connection_manager.run(0)
+  stopped_after = clock() - last_input
+  #  Idle timeout:  the silent connection is closed, the client sees end of file.
+  clock.advance(2.5)
+  server.connection_manager.run(0)
+  server.connection_manager.run(0)
+  client_sock.setblocking(False)
+  try:
+    while len(client_sock.recv(4096)):
+      pass
+    closed = True
+  except BlockingIOError:
+    closed = False
+  client_sock.close()
+  #  Disconnecting while a key is held stops the motors straight away.
+  server_sock, client_sock = socket.socketpair()
+  server.add_keyboard_client(server_sock, 'fake')
+  send_to_server(server, client_sock, {'keyboard_event': {'keycode': 17, 'key': '+w', 'is_up': False}})
+  client_sock.close()
+  server.connection_manager.run(0)
+  report("deadman fake clock", {
+    'deadman_ms': 300,
+    'stopped_after_ms': stopped_after * 1000.0,
+    'deadman_stops': server.counters['deadman_stops'],
+    'idle_timeouts': server.connection_manager.counters['idle_timeouts'],
+    'disconnect_stops': server.counters['disconnect_stops']
+  })
+  if not (moving_at_start and moving_with_heartbeats) or any(pin_values) or stopped_after > 0.302:
+    raise Exception("Deadman didn't stop the motors on time.")
+  if not closed or server.counters['disconnect_stops'] != 1:
+    raise Exception("Idle or disconnected client wasn't handled.")
+  server.connection_manager.cleanup()
+  #  Real clock:  how far past the deadline the motors actually stop.
+  server = RobotTankServer(False, gpio_backend='fake', deadman_timeout_ms=100)
+  pin_values = server.motor_driver.shadow
+  server_sock, client_sock = socket.socketpair()
+  server.add_keyboard_client(server_sock, 'real')
+  samples = []
+  for i in range(10):
+    send_to_server(server, client_sock, {'keyboard_event': {'keycode': 17, 'key': '+w', 'is_up': False}})
+    last_input = time.monotonic()
+    while any(pin_values):
+      server.connection_manager.run(1000)
+    samples.append(time.monotonic() - last_input - 0.1)
+    send_to_server(server, client_sock, {'keyboard_event': {'keycode': 17, 'key': '+w', 'is_up': True}})
+  client_sock.close()
+  server.connection_manager.cleanup()
+  report("deadman overshoot", latency_summary(samples))
+
+class SlicingByteQueue(object):
+  #  The old output buffer:  one bytearray, sliced after every partial send.
+  def __init__(self):
+    self.buf = bytearray(b'')
+
+  def __len__(self):
+    return len(self.buf)
+
+  def append(self, by):
+    self.buf += by
+
+  def send(self, sock, fd=None):
+    n = sock.send(self.buf)
+    self.buf = self.buf[n:]
+    return n
+
+def bench_slow_reader(make_queue, obey_backpressure, num_messages, read_size):
+  #  A fast writer queues 'num_messages' 100 byte messages on a socket whose reader only takes
+  #  'read_size' bytes per loop iteration.  Socket buffers are kept small so the backlog builds
+  #  up in the connection manager's output queue rather than in the kernel.
+  manager = RobotTankConnectionManager(write_limit=1 << 30, socket_options=RobotTankSocketOptions(sndbuf=4096))
+  listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  listen_sock.bind(('127.0.0.1', 0))
+  listen_sock.listen(1)
+  reader_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  reader_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)  #  Before connecting, so the window stays small.
+  reader_sock.connect(listen_sock.getsockname())
+  writer_sock, address = listen_sock.accept()
+  listen_sock.close()
+  reader_sock.setblocking(False)
+  manager.register_socket(writer_sock, 'slow reader', ['slow_reader'])
+  fd = writer_sock.fileno()
+  socket_details = manager.socket_map[fd]
+  if make_queue is not None:
+    socket_details['out_queue'] = make_queue()
+  events = {'pauses': 0, 'resumes': 0}
+  manager.register_class_callback('pause_writing', 'slow_reader', lambda fd, d: events.__setitem__('pauses', events['pauses'] + 1))
+  manager.register_class_callback('resume_writing', 'slow_reader', lambda fd, d: events.__setitem__('resumes', events['resumes'] + 1))
+  message = RobotTankMessage({'padding': 'x' * 80})
+  total_bytes = len(message.serialize()) * num_messages
+  queued = 0
+  received = 0
+  peak_queued = 0
+  start_cpu = time.process_time()
+  start = time.perf_counter()
+  while received < total_bytes:
+    #  The writer produces 64 messages per iteration unless it is told to back off.
+    for i in range(64):
+      if queued == num_messages or (obey_backpressure and socket_details['write_paused']):
+        break
+      manager.add_to_write_buffer(fd, message.serialize())
+      queued += 1
+    peak_queued = max(peak_queued, len(socket_details['out_queue']))
+    try:
+      received += len(reader_sock.recv(read_size))
+    except BlockingIOError:
+      pass
+    manager.run(0)
+  elapsed = time.perf_counter() - start
+  cpu = time.process_time() - start_cpu
+  manager.close_connection(fd)
+  reader_sock.close()
+  return {
+    'mb_per_sec': total_bytes / elapsed / 1e6,
+    'cpu_us_per_kb': cpu * 1e6 / (total_bytes / 1024.0),
+    'peak_queued_kb': peak_queued / 1024.0,
+    'pauses': events['pauses'],
+    'resumes': events['resumes']
+  }
+
+def bench_backpressure():
+  for name, make_queue, obey_backpressure in [
+    ("bytearray, no backpressure", SlicingByteQueue, False),
+    ("chunk queue, no backpressure", None, False),
+    ("chunk queue, backpressure", None, True)
+  ]:
+    results = bench_slow_reader(make_queue, obey_backpressure, 50000, 4096)
+    #  Second run to measure memory, tracemalloc slows everything down too much to time it.
+    tracemalloc.start()
+    bench_slow_reader(make_queue, obey_backpressure, 50000, 4096)
+    results['peak_alloc_kb'] = tracemalloc.get_traced_memory()[1] / 1024.0
+    tracemalloc.stop()
+    report("slow reader " + name, results)
+
+def fanout_updates(server, controller, spectators, updates):
+  #  Each update is a key event from the controller.  Latency is from sending it until the last
+  #  spectator has received the resulting state update, CPU is only what the server used.
+  decoders = dict((sock, RobotTankMessageDecoder()) for sock in spectators)
+  server_cpu = 0.0
+  samples = []
+  for i in range(updates):
+    expected_seq = server.state_sequence + 1
+    waiting = set(spectators)
+    start = time.perf_counter()
+    controller.send(RobotTankMessage({'keyboard_event': {'keycode': 17, 'key': '+w', 'is_up': bool(i % 2)}}).serialize())
+    while len(waiting):
+      cpu_start = time.process_time()
+      server.connection_manager.run(0)
+      server_cpu += time.process_time() - cpu_start
+      for sock in list(waiting):
+        try:
+          decoders[sock].feed(sock.recv(65536))
+        except BlockingIOError:
+          continue
+        for m in decoders[sock].messages():
+          if 'state' in m and m['state']['seq'] >= expected_seq:
+            waiting.discard(sock)
+    samples.append(time.perf_counter() - start)
+  results = {'server_cpu_us_per_update': server_cpu * 1e6 / updates}
+  results.update(latency_summary(samples))
+  return results
+
+def bench_fanout():
+  num_spectators = 200
+  with contextlib.redirect_stdout(io.StringIO()):
+    server = RobotTankServer(False, gpio_backend='fake', deadman_timeout_ms=None, idle_timeout=None)
+    sockets = []
+    for i in range(num_spectators + 1):
+      sock = socket.create_connection(('127.0.0.1', 3050))
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      server.connection_manager.run(0)  #  Accept it.
+      sock.setblocking(False)
+      sockets.append(sock)
+    controller = sockets[0]
+    spectators = sockets[1:]
+    controller.send(RobotTankMessage({'control': 'claim'}).serialize())
+    server.connection_manager.run(0)
+    shared = fanout_updates(server, controller, spectators, 200)
+
+    #  The same updates with every client's copy serialized separately.
+    def broadcast_state_per_client():
+      server.state_sequence += 1
+      for fd in list(server.clients.keys()):
+        server.connection_manager.add_to_write_buffer(fd, RobotTankMessage({
+          'state': {
+            'seq': server.state_sequence,
+            'direction': server.current_direction,
+            'pins': list(server.current_pin_values),
+            'throttle': server.throttle,
+            'controller': server.get_client_id(server.controller_fd)
+          }
+        }).serialize())
+    server.broadcast_state = broadcast_state_per_client
+    per_client = fanout_updates(server, controller, spectators, 200)
+    #  A second client trying to claim is refused, a takeover works.
+    spectators[0].send(RobotTankMessage({'control': 'claim'}).serialize())
+    server.connection_manager.run(0)
+    claim_refused = server.get_client_id(server.controller_fd) == 1  #  Client ids are given out in connection order.
+    spectators[0].send(RobotTankMessage({'control': 'takeover'}).serialize())
+    server.connection_manager.run(0)
+    took_over = server.get_client_id(server.controller_fd) == 2
+    for sock in sockets:
+      sock.close()
+    server.connection_manager.run(0)
+    server.connection_manager.cleanup()
+  report("fanout %u spectators, per client" % (num_spectators), per_client)
+  report("fanout %u spectators, shared bytes" % (num_spectators), shared)
+  report("fanout sessions", {'claim_refused': claim_refused, 'takeover': took_over, 'takeovers': server.counters['takeovers']})
+  if not (claim_refused and took_over):
+    raise Exception("Control claim or takeover didn't work.")
+
+class FakeSelector(object):
+  #  Returns the same events from every poll, no file descriptors involved.
+  def __init__(self):
+    self.events = []
+
+  def register(self, fd, event_mask, edge_triggered=False):
+    pass
+
+  def modify(self, fd, event_mask, edge_triggered=False):
+    pass
+
+  def unregister(self, fd):
+    pass
+
+  def poll(self, poll_timeout):
+    return self.events
+
+class DispatchOnlyConnectionManager(RobotTankConnectionManager):
+  #  No reading or writing, so only the cost of getting from an event to its callback is left.
+  def on_generic_read(self, fd):
+    pass
+
+  def on_generic_write(self, fd):
+    pass
+
+  def on_generic_exception(self, fd):
+    pass
+
+class DictDispatchConnectionManager(DispatchOnlyConnectionManager):
+  #  The old event loop:  dict entries, callbacks looked up by class name for every event, and
+  #  the debug flag tested for every event.
+  def do_class_callback_by_name(self, event, fd, socket_details):
+    for c in socket_details['classes']:
+      if c in self.class_callbacks[event]:
+        self.class_callbacks[event][c](fd, socket_details)
+
+  def run(self, poll_timeout):
+    if self.debug:
+      print("Before poller.poll")
+    try:
+      events = self.poller.poll(self.get_poll_timeout(poll_timeout))
+      if len(events):
+        self.counters['wakeups'] += 1
+      for fd, flag in events:
+        if fd not in self.socket_map:
+          continue
+        socket_details = self.socket_map[fd]
+        if flag & (select.POLLIN | select.POLLPRI):
+          if self.debug:
+            print("read event on fd " + str(fd))
+          self.on_generic_read(fd)
+          self.do_class_callback_by_name('read', fd, socket_details)
+        if flag & (select.POLLOUT):
+          if self.debug:
+            print("write event on fd " + str(fd))
+          self.on_generic_write(fd)
+          self.do_class_callback_by_name('write', fd, socket_details)
+        if flag & (select.POLLHUP | select.POLLERR):
+          if self.debug:
+            print("exception event on fd " + str(fd))
+          self.on_generic_exception(fd)
+          self.do_class_callback_by_name('exception', fd, socket_details)
+    except Exception as e:
+      print("Caught exception in poll or processing flags: " + str(e))
+    self.run_timers()
+    if self.debug:
+      print("After poller.poll")
+
+def bench_dispatch():
+  #  Two classes per connection, like the server's clients, with a callback on one of them.
+  total_events = 300000
+  for num_connections in [1, 10, 1000]:
+    calls = [0]
+    def on_read(fd, socket_details):
+      calls[0] += 1
+    classes = ['keyboard_client', 'bench']
+    events = [(1000 + i, select.POLLIN) for i in range(num_connections)]
+    rounds = total_events // num_connections
+    results = {}
+    for name in ['before', 'after']:
+      selector = FakeSelector()
+      if name == 'before':
+        manager = DictDispatchConnectionManager(selector=selector)
+        for fd, flag in events:
+          manager.socket_map[fd] = {'classes': classes, 'socket': None, 'is_socket': False}
+        manager.class_callbacks['read']['bench'] = on_read
+      else:
+        manager = DispatchOnlyConnectionManager(selector=selector)
+        for fd, flag in events:
+          manager.add_connection(RobotTankConnection(fd, None, None, None, classes, 0, is_socket=False))
+        manager.register_class_callback('read', 'bench', on_read)
+      selector.events = events
+      start = time.perf_counter()
+      for i in range(rounds):
+        manager.run(0)
+      results[name + '_ns_per_event'] = (time.perf_counter() - start) * 1e9 / (rounds * num_connections)
+    if calls[0] != 2 * rounds * num_connections:
+      raise Exception("Dispatch missed callbacks.")
+    report("dispatch %4u connections" % (num_connections), results)
+
+def drain_messages(sock, decoder):
+  try:
+    while True:
+      by = sock.recv(65536)
+      if not by:
+        break
+      decoder.feed(by)
+  except BlockingIOError:
+    pass
+  return list(decoder.messages())
+
+def stamped_key_events(server, client_sock, decoder, client_clock, num_events):
+  #  Alternating presses and releases of 'w' in the binary format, stamped with the client's clock.
+  start = time.perf_counter()
+  for i in range(num_events):
+    e = {'keycode': 17, 'key': None, 'is_up': bool(i % 2)}
+    client_sock.send(RobotTankBinaryMessage(e, i + 1, int(client_clock() * 1000000)).serialize())
+    server.connection_manager.run(0)
+    if i % 64 == 0:
+      drain_messages(client_sock, decoder)
+  return (time.perf_counter() - start) * 1e9 / num_events
+
+def bench_stages():
+  #  Histogram accuracy and recording cost against exact percentiles of the same samples.
+  r = random.Random(18)
+  samples = [int(r.lognormvariate(6, 1)) for i in range(200000)]
+  h = RobotTankLatencyHistogram()
+  start = time.perf_counter()
+  for v in samples:
+    h.record(v)
+  record_ns = (time.perf_counter() - start) * 1e9 / len(samples)
+  exact = sorted(samples)
+  worst_error = 0.0
+  for p in [50, 90, 99, 99.9]:
+    e = exact[min(len(exact) - 1, int(len(exact) * p / 100.0))]
+    worst_error = max(worst_error, abs(h.percentile(p) - e) / float(e))
+  report("stages histogram", {'record_ns': record_ns, 'worst_percentile_error': worst_error, 'buckets': len(h.counts)})
+  if worst_error > 1.0 / h.sub_buckets:
+    raise Exception("Histogram percentiles are off by more than a bucket.")
+
+  #  Clock offset through asymmetric, jittery delays:  the estimate is within half the best round trip.
+  true_offset = 3500000
+  clock_offset = RobotTankClockOffset()
+  t = 0
+  for i in range(50):
+    t0 = t
+    t1 = t0 + 300 + int(r.expovariate(1 / 2000.0)) + true_offset
+    t2 = t1 + 20
+    t3 = t2 - true_offset + 200 + int(r.expovariate(1 / 5000.0))
+    clock_offset.add(t0, t1, t2, t3)
+    t = t3 + 10000
+  report("stages clock offset", {'error_us': clock_offset.offset - true_offset, 'round_trip_us': clock_offset.round_trip})
+  if abs(clock_offset.offset - true_offset) > clock_offset.round_trip // 2 + 1:
+    raise Exception("Clock offset estimate is outside the round trip bound.")
+
+  #  End to end through the server with a client whose clock is 7 seconds ahead.
+  num_events = 4000
+  client_clock = lambda: time.monotonic() + 7.0
+  with contextlib.redirect_stdout(io.StringIO()):
+    server = RobotTankServer(False, gpio_backend='fake', deadman_timeout_ms=None, idle_timeout=None, ping_interval=None)
+    server_sock, client_sock = socket.socketpair()
+    client_sock.setblocking(False)
+    decoder = RobotTankMessageDecoder()
+    server.add_keyboard_client(server_sock, 'fake')
+    send_to_server(server, client_sock, {'hello': {'version': 1, 'wire_formats': ['binary1'], 'keymap': {'17': '+w'}}})
+    send_to_server(server, client_sock, {'control': 'claim'})
+    for i in range(16):
+      server.send_ping()
+      for m in drain_messages(client_sock, decoder):
+        if 'ping' in m:
+          now_us = int(client_clock() * 1000000)
+          send_to_server(server, client_sock, {'pong': {'t0': m['ping'], 't1': now_us, 't2': now_us}})
+    stamped_ns = stamped_key_events(server, client_sock, decoder, client_clock, num_events)
+    send_to_server(server, client_sock, {'get_stats': True})
+    stats = [m['stats'] for m in drain_messages(client_sock, decoder) if 'stats' in m]
+    #  The same events with stamping turned off, to see what leaving it on costs.
+    server.stamp_pending_update = lambda sent_us, received_us, decoded_us: None
+    unstamped_ns = stamped_key_events(server, client_sock, decoder, client_clock, num_events)
+    client_sock.close()
+    server.connection_manager.run(0)
+    server.connection_manager.cleanup()
+  for stage in ROBOT_TANK_LATENCY_STAGES:
+    report("stages " + stage, server.latency[stage].summary())
+  if server.latency['total'].count != num_events or not len(stats):
+    raise Exception("Latency stamps or stats didn't make it through the server.")
+  offset_error = stats[0]['clock_offset_us'] - 7000000
+  report("stages overhead", {'stamped_ns_per_event': stamped_ns, 'unstamped_ns_per_event': unstamped_ns, 'clock_offset_error_us': offset_error})
+  if abs(offset_error) > stats[0]['round_trip_us']:
+    raise Exception("The server's clock offset estimate is outside the round trip bound.")
+
+class StallingPipeReader(object):
+  #  Reads a pipe in 'chunk_size' pieces with a 'stall' in between, like a console over a slow SSH link.
+  def __init__(self, fd, chunk_size, stall):
+    self.fd = fd
+    self.chunk_size = chunk_size
+    self.stall = stall
+    self.thread = threading.Thread(target=self.read_loop)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def read_loop(self):
+    while True:
+      time.sleep(self.stall)
+      try:
+        if not os.read(self.fd, self.chunk_size):
+          return
+      except OSError:
+        return
+
+def logged_key_event_latencies(logger, num_events):
+  #  Per event time through a server that logs every direction change and pin update.
+  with contextlib.redirect_stdout(io.StringIO()):
+    server = RobotTankServer(False, gpio_backend='fake', deadman_timeout_ms=None, idle_timeout=None, ping_interval=None)
+  server.log = logger
+  server.connection_manager.log = logger
+  server_sock, client_sock = socket.socketpair()
+  server.add_keyboard_client(server_sock, 'fake')
+  samples = []
+  for i in range(num_events):
+    start = time.perf_counter()
+    send_to_server(server, client_sock, example_keyboard_event(i))
+    samples.append(time.perf_counter() - start)
+    if i % 64 == 0:
+      client_sock.setblocking(False)
+      drain_messages(client_sock, RobotTankMessageDecoder())
+      client_sock.setblocking(True)
+  client_sock.close()
+  server.connection_manager.run(0)
+  server.connection_manager.cleanup()
+  return samples
+
+def logging_summary(samples, logger):
+  #  Events held up for more than 20ms count as stalls, anything shorter is scheduling noise on one CPU.
+  results = latency_summary(samples)
+  results['stalls'] = len([t for t in samples if t > 0.02])
+  results['dropped'] = logger.counters['dropped']
+  return results
+
+def bench_logging():
+  #  Every record written, as if each were a print(), to a console that takes 64KB and then stalls for 100ms.
+  num_events = 3000
+  results = {}
+  for name, background in [('print', False), ('background', True)]:
+    read_fd, write_fd = os.pipe()
+    stream = os.fdopen(write_fd, 'w')
+    reader = StallingPipeReader(read_fd, 65536, 0.1)
+    logger = RobotTankLogger(level=ROBOT_TANK_LOG_DEBUG, stream=stream, rate_limit_burst=1 << 30, background=background)
+    results[name] = logging_summary(logged_key_event_latencies(logger, num_events), logger)
+    logger.close(timeout=5.0)
+    stream.close()
+    reader.thread.join()
+    os.close(read_fd)
+  for name in results:
+    report("logging slow console, " + name, results[name])
+
+  #  A console that never reads at all:  the loop carries on and records are dropped once the queue is full.
+  read_fd, write_fd = os.pipe()
+  stream = os.fdopen(write_fd, 'w')
+  logger = RobotTankLogger(level=ROBOT_TANK_LOG_DEBUG, stream=stream, queue_size=256, rate_limit_burst=1 << 30)
+  blocked = logging_summary(logged_key_event_latencies(logger, num_events), logger)
+  flushed = logger.flush(timeout=0.1)
+  os.close(read_fd)  #  The writer thread gets EPIPE and gives up on what it was writing.
+  logger.close(timeout=5.0)
+  try:
+    stream.close()
+  except OSError:
+    pass
+  report("logging blocked console, background", blocked)
+
+  #  Rate limiting:  an error repeated 10000 times over 2 seconds is written 'rate_limit_burst' times a second.
+  clock = FakeClock()
+  out = io.StringIO()
+  logger = RobotTankLogger(stream=out, clock=clock, background=False)
+  for i in range(10000):
+    logger.warning("fd not known", fd=-1, where='iter_messages')
+    clock.advance(0.0002)
+  lines = out.getvalue().splitlines()
+  report("logging rate limit", {'records': len(lines), 'suppressed': logger.counters['suppressed'], 'second_window': lines[5].split(' ', 1)[1]})
+
+  if not results['print']['stalls'] or results['background']['stalls'] or blocked['stalls'] or flushed or not blocked['dropped']:
+    raise Exception("Logging held up the event loop.")
+  if len(lines) != 10 or 'suppressed=' not in lines[5]:
+    raise Exception("Repeated records weren't rate limited.")
+
+def bench_simulation():
+  #  The whole path, scripted keyboard to client to loopback TCP to server to fake GPIO, in real time.
+  simulation = RobotTankSimulation(clock=time.monotonic, server_options={'deadman_timeout_ms': None})
+  writes = simulation.gpio.writes
+
+  #  Input to actuation:  from writing one key event into the keyboard pipe to the pins changing.
+  samples = []
+  cpu_start = time.process_time()
+  for i in range(2000):
+    n = len(writes)
+    start = time.perf_counter()
+    simulation.keyboard.write_keys([('+w', bool(i % 2))])
+    while len(writes) == n:
+      simulation.step()
+    samples.append(time.perf_counter() - start)
+    simulation.settle()  #  State update and anything else the event caused, which counts towards the CPU time.
+  single = latency_summary(samples)
+  single['cpu_us_per_event'] = (time.process_time() - cpu_start) * 1e6 / len(samples)
+  report("simulation one key at a time", single)
+
+  #  Throughput:  bursts of key events, the last of which turns right so the end of each burst is visible.
+  burst_size = 500
+  bursts = 20
+  cpu_start = time.process_time()
+  start = time.perf_counter()
+  for b in range(bursts):
+    keys = [('+w', bool(i % 2)) for i in range(burst_size - 2)] + [('+d', False), ('+d', True)]
+    simulation.keyboard.write_keys(keys[:-1])
+    while simulation.server.current_direction != 'right':
+      simulation.step()
+    simulation.keyboard.write_keys(keys[-1:])
+    simulation.settle()
+  elapsed = time.perf_counter() - start
+  report("simulation bursts of %u" % (burst_size), {
+    'events_per_sec': bursts * burst_size / elapsed,
+    'cpu_us_per_event': (time.process_time() - cpu_start) * 1e6 / (bursts * burst_size),
+    'gpio_writes_per_event': float(len(writes)) / (2000 + bursts * burst_size)
+  })
+  simulation.cleanup()
+
+  #  The same script twice on the simulated clock gives the same pin trace.
+  script = [(0.0, '+w', False), (0.3, '+a', False), (0.4, '+a', True), (0.9, '+w', True), (1.0, '+s', False), (1.2, '+s', True)]
+  traces = []
+  for i in range(2):
+    simulation = RobotTankSimulation()
+    traces.append(simulation.run_script(script))
+    simulation.cleanup()
+  report("simulation deterministic", {'gpio_writes': len(traces[0]), 'same_trace': traces[0] == traces[1]})
+  if traces[0] != traces[1] or len(traces[0]) != len(script):
+    raise Exception("Simulated runs gave different pin traces.")
+
+def record_random_driving(path, seconds, seed):
+  #  Random key presses and releases on the simulated clock, about 4 a second, with the
+  #  heartbeats stopping for a second every minute so the deadman has something to do.
+  r = random.Random(seed)
+  simulation = RobotTankSimulation(server_options={'journal_path': path})
+  client = simulation.client
+  keys = ['+w', '+a', '+s', '+d']
+  held = set()
+  end = simulation.clock() + seconds
+  next_quiet = simulation.clock() + 60
+  while simulation.clock() < end:
+    key = r.choice(keys)
+    simulation.keyboard.write_keys([(key, key in held)])
+    held ^= set([key])
+    simulation.settle()
+    if simulation.clock() >= next_quiet:
+      client.heartbeat_timer.cancel()
+      simulation.advance(1.0, tick=0.05)
+      held = set()  #  The deadman released everything.
+      client.heartbeat_timer = client.connection_manager.call_every(0.1, client.send_heartbeat)
+      next_quiet += 60
+    simulation.advance(r.expovariate(4.0), tick=0.05)
+  counters = dict(simulation.server.counters)
+  simulation.cleanup()
+  simulation.server.journal.close()
+  return counters
+
+def bench_journal():
+  directory = tempfile.mkdtemp()
+  try:
+    #  Cost of journaling one received frame.
+    writer = RobotTankJournalWriter(os.path.join(directory, 'cost.journal'))
+    payload = RobotTankBinaryMessage({'keycode': 17, 'is_up': False}, 1).serialize()[4:]
+    record_ns = ns_per_op(lambda i: writer.record(1234567 + i, ROBOT_TANK_JOURNAL_MESSAGE, 1, payload), 200000)
+    writer.close()
+    report("journal record", {'record_ns': record_ns, 'bytes': writer.counters['bytes'], 'flushes': writer.counters['flushes']})
+
+    path = os.path.join(directory, 'driving.journal')
+    start = time.perf_counter()
+    recorded = record_random_driving(path, 1800, 21)
+    record_seconds = time.perf_counter() - start
+    replay = RobotTankJournalReplay(path)
+    start = time.perf_counter()
+    counters = replay.run()
+    replay_seconds = time.perf_counter() - start
+    journal_seconds = replay.get_journal_seconds()
+    report("journal record 30 simulated minutes", {'seconds': record_seconds, 'bytes': os.path.getsize(path), 'deadman_stops': recorded['deadman_stops']})
+    report("journal replay as fast as possible", {
+      'seconds': replay_seconds,
+      'speedup': journal_seconds / replay_seconds,
+      'records_per_sec': counters['records'] / replay_seconds,
+      'pin_checks': counters['pin_checks'],
+      'mismatches': counters['mismatches'],
+      'deadman_stops': replay.server.counters['deadman_stops']
+    })
+    replay.cleanup()
+    if counters['mismatches'] or not counters['pin_checks'] or replay.server.counters['deadman_stops'] != recorded['deadman_stops']:
+      raise Exception("Replay didn't reproduce the recorded pin states.")
+
+    #  The first 2 seconds again in real time.
+    short_path = os.path.join(directory, 'short.journal')
+    record_random_driving(short_path, 2, 22)
+    replay = RobotTankJournalReplay(short_path)
+    start = time.perf_counter()
+    counters = replay.run(1.0)
+    report("journal replay in real time", {'journal_seconds': replay.get_journal_seconds(), 'seconds': time.perf_counter() - start, 'mismatches': counters['mismatches']})
+    replay.cleanup()
+  finally:
+    shutil.rmtree(directory)
+
+def step_until(simulation, condition, timeout):
+  #  Steps both event loops until condition() is true.  Returns False if 'timeout' seconds go by first.
+  deadline = time.monotonic() + timeout
+  while not condition():
+    if time.monotonic() > deadline:
+      return False
+    simulation.server.connection_manager.run(1)
+    simulation.client.connection_manager.run(1)
+  return True
+
+def bench_reconnect():
+  #  The server is killed and restarted on the same port over and over while the client holds a
+  #  key.  Half the time the held key changes while the server is down, so the restarted server
+  #  only ends up driving the right way if the client's key snapshot reached it.
+  get_logger().set_level(ROBOT_TANK_LOG_ERROR)  #  Every restart logs a lost connection.
+  r = random.Random(22)
+  client_options = {'backoff': RobotTankBackoff(initial_delay=0.005, max_delay=0.1, rng=random.Random(23))}
+  simulation = RobotTankSimulation(clock=time.monotonic, server_options={'deadman_timeout_ms': None}, client_options=client_options)
+  port = simulation.server.get_listen_port()
+  server_options = {'gpio_backend': 'fake', 'listen_address': '127.0.0.1', 'listen_port': port, 'deadman_timeout_ms': None}
+  held = '+w'
+  simulation.keyboard.press(held)
+  directions = {'+w': 'forward', '+s': 'reverse'}
+  if not step_until(simulation, lambda: simulation.server.current_direction == 'forward', 1.0):
+    raise Exception("The server never drove forward.")
+  restarts = 50
+  resumed = []  #  From the restart to the pins driving again.
+  failures = 0
+  for i in range(restarts):
+    simulation.server.connection_manager.cleanup()
+    simulation.server.motor_driver.cleanup()
+    down_until = time.monotonic() + r.uniform(0.0, 0.2)
+    if i % 2:
+      simulation.keyboard.write_keys([(held, True)])
+      held = '+s' if held == '+w' else '+w'
+      simulation.keyboard.write_keys([(held, False)])
+    while time.monotonic() < down_until:
+      simulation.client.connection_manager.run(1)
+    simulation.server = RobotTankServer(False, clock=time.monotonic, **server_options)
+    simulation.gpio = simulation.server.motor_driver.backend
+    simulation.gpio_writes = len(simulation.gpio.writes)
+    start = time.monotonic()
+    if step_until(simulation, lambda: simulation.server.current_direction == directions[held], 2.0):
+      resumed.append(time.monotonic() - start)
+    else:
+      failures += 1
+  client = simulation.client
+  results = latency_summary(resumed) if len(resumed) else {}
+  results['restarts'] = restarts
+  results['failures'] = failures
+  results['connect_failures'] = client.counters['connect_failures']
+  results['key_snapshots'] = client.counters['key_snapshots']
+  report("reconnect restart to driving again", results)
+  summary = client.reconnect_latency.summary()
+  report("reconnect loss to reconnected", {'count': summary['count'], 'p50_us': summary['p50_us'], 'p99_us': summary['p99_us'], 'max_us': summary['max_us']})
+  simulation.cleanup()
+  get_logger().set_level(ROBOT_TANK_LOG_WARNING)
+  if failures or client.counters['disconnects'] != restarts:
+    raise Exception("The client didn't resync after every restart.")
+
+class FleetRig(object):
+  #  'num_tanks' fake GPIO servers on loopback and one client with a scripted keyboard driving
+  #  them all, every event loop stepped in turn from this thread.  The client's CPU time is
+  #  counted on its own.
+  def __init__(self, directory, num_tanks):
+    self.servers = [RobotTankServer(False, gpio_backend='fake', listen_address='127.0.0.1', listen_port=0, deadman_timeout_ms=None, ping_interval=None) for i in range(num_tanks)]
+    config = {
+      'tanks': dict(('tank%02u' % (i), {'host': '127.0.0.1', 'port': server.get_listen_port(), 'groups': ['even' if i % 2 == 0 else 'odd']}) for i, server in enumerate(self.servers)),
+      'select_keys': {'+e': 'even', '+q': 'all'},
+      'selected': 'all'
+    }
+    path = os.path.join(directory, 'fleet.json')
+    with open(path, 'w') as f:
+      json.dump(config, f)
+    self.keyboard = RobotTankScriptedKeyboard()
+    self.client = RobotTankClient(fleet_config=path, key_listener=self.keyboard)
+    self.client_cpu = 0.0
+    self.step_until(lambda: all(server.controller_fd is not None for server in self.servers), 5.0)
+
+  def step(self):
+    for server in self.servers:
+      server.connection_manager.run(0)
+    start = time.process_time()
+    self.client.connection_manager.run(0)
+    self.client_cpu += time.process_time() - start
+
+  def step_until(self, condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+      if time.monotonic() > deadline:
+        raise Exception("The fleet didn't get there in " + str(timeout) + " seconds.")
+      self.step()
+
+  def directions(self):
+    return [server.current_direction for server in self.servers]
+
+  def cleanup(self):
+    self.client.connection_manager.cleanup()
+    self.keyboard.cleanup()
+    for server in self.servers:
+      server.connection_manager.cleanup()
+      server.motor_driver.cleanup()
+
+def fleet_key_events(rig, targets, num_events):
+  #  Presses and releases '+w' and waits each time until every targeted tank has followed.
+  #  Returns the latency samples and client CPU per event.
+  samples = []
+  cpu_start = rig.client_cpu
+  for i in range(num_events):
+    direction = 'forward' if i % 2 == 0 else None
+    start = time.perf_counter()
+    rig.keyboard.write_keys([('+w', i % 2 == 1)])
+    while any(server.current_direction != direction for server in targets):
+      rig.step()
+    samples.append(time.perf_counter() - start)
+  return samples, (rig.client_cpu - cpu_start) * 1e6 / num_events
+
+def bench_fleet():
+  directory = tempfile.mkdtemp()
+  get_logger().set_level(ROBOT_TANK_LOG_ERROR)
+  try:
+    num_tanks = 50
+    rig = FleetRig(directory, num_tanks)
+    for name, targets in [('all', rig.servers), ('tank00', rig.servers[0:1])]:
+      rig.client.select(name)
+      for i in range(10):
+        rig.step()
+      samples, cpu_us = fleet_key_events(rig, targets, 400)
+      results = latency_summary(samples)
+      results['client_cpu_us_per_event'] = cpu_us
+      results['client_cpu_us_per_tank'] = cpu_us / len(targets)
+      report("fleet of %u, to %s" % (num_tanks, name), results)
+
+    #  Groups and select keys:  holding '+w' drives the even tanks only after selecting 'even',
+    #  and switching back to all of them brings the odd ones along without pressing it again.
+    rig.keyboard.write_keys([('+e', False), ('+e', True), ('+w', False)])
+    rig.step_until(lambda: rig.directions()[0::2] == ['forward'] * (num_tanks // 2), 2.0)
+    for i in range(100):
+      rig.step()
+    even_only = rig.directions()[1::2] == [None] * (num_tanks // 2)
+    rig.keyboard.write_keys([('+q', False), ('+q', True)])
+    rig.step_until(lambda: rig.directions() == ['forward'] * num_tanks, 2.0)
+    health = rig.client.get_fleet_health()
+    report("fleet groups", {'even_only': even_only, 'all_followed': True, 'up': sum(1 for h in health.values() if h['state'] == 'up')})
+    rig.cleanup()
+    if not even_only:
+      raise Exception("Selecting a group drove tanks outside it.")
+  finally:
+    get_logger().set_level(ROBOT_TANK_LOG_WARNING)
+    shutil.rmtree(directory)
+
+def start_server_process(directory, **options):
+  #  A fake GPIO server in a child process, with loopback TCP, a Unix domain socket and a command
+  #  slot in 'directory'.  'options' are passed on to the server.  Returns its pid and TCP port.
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    try:
+      os.close(read_fd)
+      server = RobotTankServer(
+        False,
+        gpio_backend='fake',
+        listen_address='127.0.0.1',
+        listen_port=0,
+        unix_socket_path=os.path.join(directory, 'tank.sock'),
+        command_slot_path=os.path.join(directory, 'tank.slot'),
+        deadman_timeout_ms=None,
+        idle_timeout=None,
+        ping_interval=None,
+        **options
+      )
+      os.write(write_fd, struct.pack("H", server.get_listen_port()))
+      server.run()
+    finally:
+      os._exit(0)
+  os.close(write_fd)
+  port = struct.unpack("H", os.read(read_fd, 2))[0]
+  os.close(read_fd)
+  return pid, port
+
+def wait_for_message(sock, decoder, predicate, timeout=5.0):
+  #  Reads from a blocking socket until a message matches.  Returns it.
+  deadline = time.monotonic() + timeout
+  while True:
+    for m in decoder.messages():
+      if predicate(m):
+        return m
+    sock.settimeout(max(0.001, deadline - time.monotonic()))
+    by = sock.recv(65536)
+    if not by:
+      raise Exception("The server closed the connection.")
+    decoder.feed(by)
+
+class SocketCommander(object):
+  #  Drives the server with stamped key events over a socket, as JSON or in the binary format.
+  keycodes = {'+w': 17, '+d': 32}
+
+  def __init__(self, sock, binary):
+    self.sock = sock
+    self.binary = binary
+    self.sequence_number = 0
+    if binary:
+      sock.sendall(RobotTankMessage({'hello': {'version': 1, 'wire_formats': ['binary1'], 'keymap': dict((str(kc), key) for key, kc in self.keycodes.items())}}).serialize())
+      wait_for_message(sock, RobotTankMessageDecoder(), lambda m: 'hello' in m)
+
+  def send(self, key, is_up):
+    now_us = int(time.monotonic() * 1000000)
+    self.sequence_number += 1
+    if self.binary:
+      self.sock.sendall(RobotTankBinaryMessage({'keycode': self.keycodes[key], 'is_up': is_up}, self.sequence_number, now_us).serialize())
+    else:
+      self.sock.sendall(RobotTankMessage({'keyboard_event': {'key': key, 'is_up': is_up, 't': now_us}}).serialize())
+
+  def close(self):
+    self.sock.close()
+
+class SlotCommander(object):
+  #  The same key events as held direction snapshots written into the command slot.
+  directions = {'+w': 'forward', '+d': 'right'}
+
+  def __init__(self, path):
+    self.writer = RobotTankCommandSlotWriter(path)
+    self.held = []
+
+  def send(self, key, is_up):
+    d = self.directions[key]
+    if d in self.held:
+      self.held.remove(d)
+    if not is_up:
+      self.held.append(d)
+    self.writer.write(self.held, self.held[-1] if len(self.held) else None)
+
+  def close(self):
+    self.writer.close()
+
+def local_commands(commander, watch, decoder, num_commands, interval):
+  #  Alternating presses and releases of '+w', every 'interval' seconds or as fast as possible with
+  #  None, then a press of '+d'.  Returns the seconds until the watching connection sees the tank
+  #  turn right, which is after the server has handled everything before it, and the number of
+  #  commands sent.
+  sent = num_commands + 2
+  start = time.perf_counter()
+  for i in range(num_commands):
+    commander.send('+w', i % 2 == 1)
+    if interval is not None:
+      time.sleep(interval)
+  if num_commands % 2:
+    commander.send('+w', True)
+    sent += 1
+  commander.send('+d', False)
+  wait_for_message(watch, decoder, lambda m: 'state' in m and m['state'].get('direction') == 'right')
+  elapsed = time.perf_counter() - start
+  commander.send('+d', True)
+  wait_for_message(watch, decoder, lambda m: 'state' in m and m['state'].get('direction') is None)
+  return elapsed, sent
+
+def get_stats_over(watch, decoder):
+  watch.sendall(RobotTankMessage({'get_stats': True}).serialize())
+  return wait_for_message(watch, decoder, lambda m: 'stats' in m)['stats']
+
+def slot_arbitration_check(directory):
+  #  The command slot drives the tank while nobody has control.  A client claiming control stops
+  #  it, and the slot's commands are ignored until the client releases control again.
+  path = os.path.join(directory, 'arbitration.slot')
+  server = RobotTankServer(False, gpio_backend='fake', listen_address='127.0.0.1', listen_port=0, ping_interval=None, idle_timeout=None, deadman_timeout_ms=None, command_slot_path=path)
+  writer = RobotTankCommandSlotWriter(path)
+  server_sock, client_sock = socket.socketpair()
+  server.add_keyboard_client(server_sock, 'bench')
+  results = {}
+  def step(name, message=None, pressed=None):
+    if message is not None:
+      client_sock.send(RobotTankMessage(message).serialize())
+      server.connection_manager.run(0)
+    if pressed is not None:
+      writer.write(pressed, pressed[-1] if pressed else None, wake=False)
+      server.read_command_slot()
+    results[name] = any(server.current_pin_values)
+  step('slot_moved', pressed=['forward'])
+  step('moving_after_claim', message={'control': 'claim'})
+  step('slot_moved_with_controller', pressed=['reverse'])
+  step('slot_moved_after_release', message={'control': 'release'}, pressed=['reverse'])
+  results['slot_commands_ignored'] = server.counters['slot_commands_ignored']
+  writer.close()
+  client_sock.close()
+  server.connection_manager.run(0)
+  server.connection_manager.cleanup()
+  server.command_slot.close()
+  return results
+
+def bench_local():
+  #  Programs on the robot driving it through each local interface, with the server in its own
+  #  process.  Latency is the server's own, from the command's stamp to the pins being written,
+  #  for commands sent at 1kHz.  Then as many commands as possible for throughput, and the
+  #  server's CPU time per command sent.  A second connection over the Unix domain socket watches
+  #  the state updates to tell when the server has caught up.  Commands over a socket are all
+  #  applied, in batches of whatever arrived together, while commands in the slot that are
+  #  overwritten before the server reads them are 'superseded'.
+  directory = tempfile.mkdtemp()
+  try:
+    transports = [
+      ('tcp json', lambda port: SocketCommander(socket.create_connection(('127.0.0.1', port)), False)),
+      ('uds json', lambda port: SocketCommander(unix_connection(os.path.join(directory, 'tank.sock')), False)),
+      ('uds binary', lambda port: SocketCommander(unix_connection(os.path.join(directory, 'tank.sock')), True)),
+      ('shm slot', lambda port: SlotCommander(os.path.join(directory, 'tank.slot')))
+    ]
+    for name, make_commander in transports:
+      pid, port = start_server_process(directory)
+      watch = unix_connection(os.path.join(directory, 'tank.sock'))
+      decoder = RobotTankMessageDecoder()
+      commander = make_commander(port)
+      paced = 1000
+      paced_seconds, paced_sent = local_commands(commander, watch, decoder, paced, 0.001)
+      latency = get_stats_over(watch, decoder)['latency']['total']
+      fast = 20000
+      elapsed, fast_sent = local_commands(commander, watch, decoder, fast, None)
+      stats = get_stats_over(watch, decoder)
+      os.kill(pid, signal.SIGKILL)
+      rusage = os.wait4(pid, 0)[2]
+      commander.close()
+      watch.close()
+      sent = paced_sent + fast_sent
+      slot_commands = stats['server']['slot_commands']
+      report("local " + name, {
+        'p50_us': latency['p50_us'],
+        'p99_us': latency['p99_us'],
+        'commands_per_sec': fast / elapsed,
+        'superseded': sent - slot_commands if slot_commands else 0,
+        'server_cpu_us_per_command': (rusage.ru_utime + rusage.ru_stime) * 1e6 / sent
+      })
+    arbitration = slot_arbitration_check(directory)
+    report("local slot arbitration", arbitration)
+    if not arbitration['slot_moved'] or arbitration['moving_after_claim'] or arbitration['slot_moved_with_controller'] or not arbitration['slot_moved_after_release']:
+      raise Exception("The command slot drove the tank while a client had control.")
+  finally:
+    shutil.rmtree(directory)
+
+def start_cpu_hogs(count):
+  #  Child processes that spin forever.  Returns their pids.
+  pids = []
+  for i in range(count):
+    pid = os.fork()
+    if pid == 0:
+      while True:
+        pass
+    pids.append(pid)
+  return pids
+
+def bench_jitter():
+  #  How late the server's loop runs a 1ms timer, and the latency of commands sent over the Unix
+  #  domain socket at 1kHz, for 2 seconds.  Idle, then with two spinning processes per CPU, first
+  #  with the default scheduling and then with the real-time profile.  Without the privileges
+  #  for SCHED_FIFO or mlockall the profile only does what it can, see 'sched_fifo' and
+  #  'lock_memory' in the results.
+  directory = tempfile.mkdtemp()
+  realtime = RobotTankRealtimeProfile(fifo_priority=50, lock_memory=True, gc_freeze=True)
+  try:
+    for name, profile, hogs in [('default, idle', None, 0), ('default, loaded', None, 2 * os.cpu_count()), ('realtime, loaded', realtime, 2 * os.cpu_count())]:
+      pid, port = start_server_process(directory, realtime_profile=profile, jitter_interval=0.001)
+      watch = unix_connection(os.path.join(directory, 'tank.sock'))
+      decoder = RobotTankMessageDecoder()
+      commander = SocketCommander(unix_connection(os.path.join(directory, 'tank.sock')), True)
+      hog_pids = start_cpu_hogs(hogs)
+      try:
+        local_commands(commander, watch, decoder, 2000, 0.001)
+        stats = get_stats_over(watch, decoder)
+      finally:
+        for hog_pid in hog_pids:
+          os.kill(hog_pid, signal.SIGKILL)
+          os.waitpid(hog_pid, 0)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        commander.close()
+        watch.close()
+      jitter = stats['jitter']
+      applied = stats['realtime'] or {}
+      report("jitter " + name, {
+        'late_p50_us': jitter['lateness']['p50_us'],
+        'late_p99_us': jitter['lateness']['p99_us'],
+        'late_max_us': jitter['lateness']['max_us'],
+        'missed_ticks': jitter['counters']['missed_ticks'],
+        'command_p99_us': stats['latency']['total']['p99_us'],
+        'gc_max_us': jitter['gc_pauses']['max_us'],
+        'sched_fifo': applied.get('sched_fifo', False),
+        'lock_memory': applied.get('lock_memory', False)
+      })
+  finally:
+    shutil.rmtree(directory)
+
+def unix_connection(path):
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.connect(path)
+  return sock
+
+BENCHMARKS = {
+  'reads': bench_reads,
+  'decode': bench_decode,
+  'serialize': bench_serialize,
+  'idle': bench_idle,
+  'latency': bench_latency,
+  'rtt': bench_rtt,
+  'udp': bench_udp,
+  'keys': bench_keys,
+  'evdev': bench_evdev,
+  'keymap': bench_keymap,
+  'gpio': bench_gpio,
+  'directions': bench_directions,
+  'deadman': bench_deadman,
+  'backpressure': bench_backpressure,
+  'fanout': bench_fanout,
+  'dispatch': bench_dispatch,
+  'stages': bench_stages,
+  'logging': bench_logging,
+  'simulation': bench_simulation,
+  'journal': bench_journal,
+  'reconnect': bench_reconnect,
+  'fleet': bench_fleet,
+  'local': bench_local,
+  'jitter': bench_jitter
+}
+
+if __name__ == '__main__':
+  #  Only warnings and errors from the code under test, so they don't get mixed up with the results.
+  get_logger().set_level(ROBOT_TANK_LOG_WARNING)
+  names = sys.argv[1:] if len(sys.argv) > 1 else sorted(BENCHMARKS.keys())
+  for name in names:
+    if name in BENCHMARKS:
+      BENCHMARKS[name]()
+    else:
+      sys.stdout.write("Unknown benchmark " + name + ".  Choices are: " + ", ".join(sorted(BENCHMARKS.keys())) + "\n")
+      sys.exit(1)
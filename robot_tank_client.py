@@ -1,63 +1,354 @@
 import signal
 import binascii
-import socket
 import struct
 import sys
 import select
 import time
+import copy
 from RobotTankConnectionManager import RobotTankConnectionManager
 from RobotTankConnectionManager import RobotTankMessage
+from RobotTankConnectionManager import RobotTankBinaryMessage
+from RobotTankConnectionManager import ROBOT_TANK_HELLO_MESSAGE
+from RobotTankConnectionManager import ROBOT_TANK_WIRE_FORMAT_BINARY
+from RobotTankConnectionManager import ROBOT_TANK_WIRE_FORMATS
+from RobotTankConnectionManager import RobotTankControlSender
+from RobotTankDirections import load_direction_config
+from RobotTankLog import get_logger
+from RobotTankLog import ROBOT_TANK_LOG_DEBUG
+from RobotTankStats import RobotTankLatencyHistogram
+from RobotTankFleet import RobotTankServerLink
+from RobotTankFleet import RobotTankFleetTargets
+from RobotTankFleet import load_fleet_config
+from RobotTankFleet import make_single_tank_fleet_config
+from RobotTankFleet import ROBOT_TANK_FLEET_ALL
 from PyKeyUpKeyDown import PyKeyUpKeyDown
+from PyKeyUpKeyDownEvdev import PyKeyUpKeyDownEvdev
 
 class RobotTankClient(object):
-  def __init__(self, debug=False):
+  def __init__(self, debug=False, udp_port=None, control_rate_hz=20, keyboard_backend='console', heartbeat_interval=0.1, server_timeout=2.0, role='controller', host='192.168.0.151', port=3050, key_listener=None, clock=time.monotonic, backoff=None, fleet_config=None):
     signal.signal(signal.SIGINT, self.cleanup)
     self.done = False
-    self.connection_manager = RobotTankConnectionManager()
+    self.log = get_logger()
+    if debug:
+      self.log.set_level(ROBOT_TANK_LOG_DEBUG)
+    #  The server echoes heartbeats, so a connection that is silent for 'server_timeout' seconds is dead.
+    self.connection_manager = RobotTankConnectionManager(clock=clock, idle_timeout=server_timeout, write_timeout=server_timeout)
     self.debug = debug
+    #  'controller' asks for control when connecting, 'takeover' takes it even if someone else
+    #  has it, 'spectator' only watches the state updates and never sends input.
+    self.role = role
+    self.sequence_number = 0
 
-    host = '192.168.0.151'
-    port = 3050
-    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    self.sock.connect((host, port))
-    self.connection_manager.register_socket(self.sock, host, ['keyboard_send'])
+    #  With a 'fleet_config' file (see RobotTankFleet.py) there is a connection to every tank's
+    #  server, otherwise just the one to host:port.  Input goes to the selected tank or group,
+    #  which the config's select keys change.  Each event is serialized once for every wire format
+    #  in use and the same bytes are queued on every connection it goes to.
+    #
+    #  Connections are made without blocking and remade whenever they're lost, after a jittered
+    #  exponential backoff that starts over once a connect succeeds ('backoff' is copied for each
+    #  connection).  Keys held while a server was gone are sent as a snapshot after reconnecting,
+    #  so the tank picks up where it left off.  'reconnect_latency' is the time from losing a
+    #  connection to having it back, in microseconds, and 'counters' add up every connection's.
+    #  get_fleet_health() has each connection's own.
+    config = load_fleet_config(fleet_config) if fleet_config is not None else make_single_tank_fleet_config(host, port)
+    self.fleet = RobotTankFleetTargets(config)
+    self.links = {}  #  Tank name to RobotTankServerLink.
+    for name in self.fleet.tank_names:
+      tank = config['tanks'][name]
+      self.links[name] = RobotTankServerLink(name, tank['host'], tank.get('port', 3050), copy.copy(backoff) if backoff is not None else None)
+    self.fd_links = {}  #  fd to RobotTankServerLink, for connections and connects under way.
+    self.connect_timeout = server_timeout
+    self.held_keys = []  #  Held direction keys, oldest first.
+    self.counters = {'connects': 0, 'disconnects': 0, 'connect_failures': 0, 'key_snapshots': 0}
+    self.reconnect_latency = RobotTankLatencyHistogram()
+    self.selected = None
+    self.target_links = []
+    self.connection_manager.register_class_callback('connect', 'keyboard_send', self.on_server_connect)
+    self.connection_manager.register_class_callback('read', 'keyboard_send', self.on_server_read)
+    self.connection_manager.register_class_callback('close', 'keyboard_send', self.on_server_close)
+    #  Heartbeats keep the servers' deadman from stopping the tanks while keys are held.  A
+    #  connection whose heartbeats haven't been echoed for 5 intervals is marked stale.  The send
+    #  times of the last 'heartbeat_window' heartbeats are kept, so echoes still count and give a
+    #  round trip when it's longer than the heartbeat interval.
+    self.heartbeat_number = 0
+    self.heartbeat_window = 64
+    self.heartbeats_sent = {}
+    self.stale_after = heartbeat_interval * 5
+    self.heartbeat_timer = self.connection_manager.call_every(heartbeat_interval, self.send_heartbeat)
 
-    self.key_listener = PyKeyUpKeyDown(debug=False) #  Set the debug flag to true to see more info.
+    #  With a UDP port, key events are sent as redundant state snapshots over UDP instead of over
+    #  TCP.  That's only for a single tank.
+    self.control_sender = None
+    self.key_directions = load_direction_config()['keys']
+    #  Number keys set the throttle, 1 is 10% up to 0 for 100%.
+    self.throttle_keys = {'one': 10, 'two': 20, 'three': 30, 'four': 40, 'five': 50, 'six': 60, 'seven': 70, 'eight': 80, 'nine': 90, 'zero': 100}
+    if udp_port is not None and len(self.links) == 1:
+      remote_host = list(self.links.values())[0].host
+      udp_fd = self.connection_manager.register_udp_socket('0.0.0.0', 0, ['control_send'], remote=(remote_host, udp_port))
+      self.control_sender = RobotTankControlSender(self.connection_manager, udp_fd, control_rate_hz)
+    elif udp_port is not None:
+      self.log.warning("The UDP control channel only works with one tank, using TCP", tanks=len(self.links))
+    self.select(config.get('selected', ROBOT_TANK_FLEET_ALL))
+
+    #  'console' puts the VT into raw keycode mode, 'evdev' reads /dev/input/event* instead
+    #  and also works from X/Wayland or over SSH.  A 'key_listener' that is passed in, like the
+    #  simulator's scripted keyboard, is used instead of either.
+    if key_listener is not None:
+      self.key_listener = key_listener
+    elif keyboard_backend == 'evdev':
+      self.key_listener = PyKeyUpKeyDownEvdev(debug=False)
+    else:
+      self.key_listener = PyKeyUpKeyDown(debug=False) #  Set the debug flag to true to see more info.
     keysetuprtn = self.key_listener.setup_keylisten()
     if keysetuprtn:
       self.connection_manager.register_file_descriptor(self.key_listener.get_keyboard_file_descriptor(), ['keyboard_type'])
       self.connection_manager.register_class_callback('read', 'keyboard_type', self.on_keyboard_type)
-      print("Successfully set up keylistener.")
+      self.log.info("Successfully set up keylistener")
+      for link in self.links.values():
+        self.connect(link)
     else:
-      print("Was unable to set up keylistener..")
+      self.log.error("Was unable to set up keylistener")
       self.done = True
 
   def cleanup(self, signum, frame):
-    sys.stdout.write("Caught signal %s. Shutting down.\n" % (str(signum)))
+    self.log.info("Caught signal, shutting down", signal=signum)
+    self.done = True  #  Closing the connections mustn't start a reconnect.
     self.connection_manager.cleanup()
     self.key_listener.cleanup()
-    self.done = True
+    self.log.flush()
 
   def run(self):
     while not self.done:
       self.connection_manager.run(10000)
 
+  def get_fleet_health(self):
+    return dict((name, link.get_health()) for name, link in self.links.items())
+
+  def connect(self, link):
+    link.reconnect_timer = None
+    if self.done:
+      return
+    self.log.debug("Connecting to the server", tank=link.name, host=link.host, port=link.port)
+    fd = self.connection_manager.connect(link.host, link.port, ['keyboard_send'], timeout=self.connect_timeout)
+    if fd is None:
+      self.on_connect_failed(link)
+    else:
+      link.state = 'connecting'
+      self.fd_links[fd] = link
+
+  def on_connect_failed(self, link):
+    link.state = 'down'
+    link.counters['connect_failures'] += 1
+    self.counters['connect_failures'] += 1
+    self.schedule_reconnect(link)
+
+  def schedule_reconnect(self, link):
+    if not self.done and link.reconnect_timer is None:
+      link.reconnect_timer = self.connection_manager.call_later(link.backoff.next_delay(), lambda: self.connect(link))
+
+  def on_server_connect(self, fd, socket_details):
+    link = self.fd_links[fd]
+    reconnect_us = link.on_connect(fd, self.connection_manager.clock())
+    self.counters['connects'] += 1
+    if reconnect_us is not None:
+      self.reconnect_latency.record(reconnect_us)
+    self.log.info("Connected to the server", tank=link.name, host=link.host, port=link.port, connects=link.counters['connects'])
+    self.send_hello(link)
+
+  def select(self, target):
+    #  Input goes to 'target', a tank or group name, from now on.  Tanks that are no longer
+    #  selected have their directions released, and tanks that now are pick up the held keys.
+    links = [self.links[name] for name in self.fleet.resolve(target)]
+    if not len(links):
+      self.log.warning("No tank or group by that name", target=target)
+      return False
+    if self.control_sender is None:
+      self.send_key_snapshot([link for link in self.target_links if link not in links], [])
+      self.send_key_snapshot([link for link in links if link not in self.target_links], self.held_keys)
+    self.selected = target
+    self.target_links = links
+    self.log.info("Selected", target=target, tanks=len(links))
+    return True
+
+  def send_key_snapshot(self, links, keys):
+    #  The held keys in the order they were pressed, so the most recent one wins like it did before.
+    msg = None
+    for link in links:
+      if link.fd is not None and 'key_snapshot' in link.features:
+        if msg is None:
+          msg = RobotTankMessage({'key_snapshot': keys}).serialize()
+        link.counters['key_snapshots'] += 1
+        self.counters['key_snapshots'] += 1
+        self.connection_manager.add_to_write_buffer(link.fd, msg)
+
+  def send_hello(self, link):
+    #  Offer the wire formats we support.  The keymap lets the server name keys
+    #  that arrive in the binary format, which only carries keycodes.  Servers
+    #  that don't understand 'hello' ignore it and we just keep sending JSON.
+    send_fd = link.fd
+    if send_fd:
+      r = RobotTankMessage({
+        'hello': {
+          'version': ROBOT_TANK_HELLO_MESSAGE,
+          'wire_formats': ROBOT_TANK_WIRE_FORMATS,
+          'keymap': self.key_listener.keymap,
+          #  The server only applies our UDP snapshots while this connection has control.
+          'udp_session': self.control_sender.session if self.control_sender is not None else None
+        }
+      })
+      self.connection_manager.add_to_write_buffer(send_fd, r.serialize())
+
+  def on_server_read(self, fd, socket_details):
+    link = self.fd_links.get(fd)
+    if link is None:
+      return  #  The connection manager closes a connection only after its read callbacks, so this shouldn't happen.
+    for m in self.connection_manager.iter_messages(fd):
+      if 'heartbeat' in m:
+        sent_at = self.heartbeats_sent.get(m['heartbeat'])
+        if sent_at is not None:
+          link.on_heartbeat_echo(sent_at, self.connection_manager.clock())
+      elif 'hello' in m and m['hello'].get('wire_format') in ROBOT_TANK_WIRE_FORMATS:
+        link.wire_format = m['hello']['wire_format']
+        link.features = m['hello'].get('features', [])
+        self.log.info("Server selected wire format", tank=link.name, wire_format=link.wire_format)
+        if 'control' in link.features and self.role != 'spectator':
+          request = 'takeover' if self.role == 'takeover' else 'claim'
+          self.connection_manager.add_to_write_buffer(fd, RobotTankMessage({'control': request}).serialize())
+          #  With UDP the next state snapshot resyncs the server anyway.
+          if self.control_sender is None:
+            self.send_key_snapshot([link], self.held_keys if link in self.target_links else [])
+      elif 'ping' in m:
+        #  Lets the server estimate our clock offset, so it can compare our event stamps with its own clock.
+        now_us = int(self.connection_manager.clock() * 1000000)
+        self.connection_manager.add_to_write_buffer(fd, RobotTankMessage({'pong': {'t0': m['ping'], 't1': now_us, 't2': now_us}}).serialize())
+      elif 'control_result' in m:
+        self.log.info("Control request answered", tank=link.name, result=m['control_result'])
+      elif 'state' in m:
+        link.server_state = m['state']
+        self.log.debug("Server state", tank=link.name, state=link.server_state)
+
+  def on_server_close(self, fd, socket_details):
+    link = self.fd_links.pop(fd, None)
+    if link is None:
+      return
+    if fd != link.fd:
+      #  A connect that didn't go through.
+      self.on_connect_failed(link)
+      return
+    link.on_close(self.connection_manager.clock())
+    self.counters['disconnects'] += 1
+    if not self.done:
+      self.log.warning("Lost the connection to the server, reconnecting", tank=link.name, host=link.host, port=link.port)
+    self.schedule_reconnect(link)
+
+  def send_heartbeat(self):
+    now = self.connection_manager.clock()
+    self.heartbeat_number += 1
+    msg = None
+    for link in self.links.values():
+      if link.fd is not None:
+        link.check_stale(now, self.stale_after)
+        if msg is None:
+          msg = RobotTankMessage({'heartbeat': self.heartbeat_number}).serialize()
+        self.connection_manager.add_to_write_buffer(link.fd, msg)
+    self.heartbeats_sent[self.heartbeat_number] = now
+    self.heartbeats_sent.pop(self.heartbeat_number - self.heartbeat_window, None)
+
+  def send_throttle(self, throttle):
+    #  Always over TCP, it changes rarely and must not be lost.
+    links = [link for link in self.target_links if link.fd is not None]
+    if len(links):
+      msg = RobotTankMessage({'throttle': throttle}).serialize()
+      for link in links:
+        self.connection_manager.add_to_write_buffer(link.fd, msg)
+    else:
+      self.log.warning("Did not send throttle")
+
+  def encode_events(self, events, stamp_us, wire_format, stamped, batched):
+    #  Everything from this read goes out in a single write.  Returned as bytes, which the chunk
+    #  queue keeps as they are, so every connection shares the same buffer instead of a copy.
+    if wire_format == ROBOT_TANK_WIRE_FORMAT_BINARY:
+      msg = bytearray(b'')
+      for e in events:
+        msg += RobotTankBinaryMessage(e, e['seq'], stamp_us if stamped else None).serialize()
+    elif batched:
+      msg = RobotTankMessage({'keyboard_events': events}).serialize()
+    else:
+      msg = bytearray(b'')
+      for e in events:
+        msg += RobotTankMessage({'keyboard_event': e}).serialize()
+    return bytes(msg)
+
   def on_keyboard_type(self, fd, socket_details):
     bytes_read = self.connection_manager.remove_from_read_buffer(fd)
-    e = self.key_listener.key_process(bytes_read)
-    send_fd = self.connection_manager.sfno(self.sock)
-    if send_fd:
-      r = RobotTankMessage({'keyboard_event': e})
-      msg = r.serialize()
-      self.connection_manager.add_to_write_buffer(send_fd, msg)
+    events = self.key_listener.key_events(bytes_read)
+    if len(events) == 0 or self.role == 'spectator':
+      return  #  Only part of a keycode so far, or just watching.
+    for e in events:
+      if e['key'] in self.key_directions:
+        if e['key'] in self.held_keys:
+          self.held_keys.remove(e['key'])
+        if not e['is_up']:
+          self.held_keys.append(e['key'])
+      elif not e['is_up'] and e['key'] in self.throttle_keys:
+        self.send_throttle(self.throttle_keys[e['key']])
+      elif not e['is_up'] and e['key'] in self.fleet.select_keys:
+        self.select(self.fleet.select_keys[e['key']])
+    if self.control_sender is not None:
+      changed = False
+      for e in events:
+        if e['key'] in self.key_directions:
+          changed |= self.control_sender.update_direction(self.key_directions[e['key']], not e['is_up'])
+      if changed:
+        self.control_sender.send_state()
+      return
+    links = [link for link in self.target_links if link.fd is not None]
+    if len(links):
+      #  Every event is stamped with a sequence number and the time it was read (monotonic
+      #  microseconds) so the server can measure how long it takes to reach the pins.
+      stamp_us = int(self.connection_manager.clock() * 1000000)
+      for e in events:
+        self.sequence_number += 1
+        e['seq'] = self.sequence_number
+        e['t'] = stamp_us
+      #  One encoding per (wire format, stamped, batched) combination in use.  The buffers are
+      #  never changed after this, so every connection's output queue can hold the same one.
+      encoded = {}
+      for link in links:
+        binary = link.wire_format == ROBOT_TANK_WIRE_FORMAT_BINARY
+        encoding = (link.wire_format, binary and 'stamps' in link.features, not binary and len(events) > 1 and 'keyboard_events' in link.features)
+        msg = encoded.get(encoding)
+        if msg is None:
+          msg = encoded[encoding] = self.encode_events(events, stamp_us, *encoding)
+        self.connection_manager.add_to_write_buffer(link.fd, msg)
     else:
-      print("Did not send key up/down.")
+      self.log.warning("Did not send key up/down")
 
   def on_key_down(self, keycode, mappedkey):
-    print("Observed Keydown keycode=%u mappedkey=%s" % (keycode, mappedkey))
+    self.log.debug("Observed key down", keycode=keycode, key=mappedkey)
 
   def on_key_up(self, keycode, mappedkey):
-    print("Observed Keyup keycode=%u mappedkey=%s" % (keycode, mappedkey))
+    self.log.debug("Observed key up", keycode=keycode, key=mappedkey)
 
-s = RobotTankClient()
-s.run()
+if __name__ == '__main__':
+  #  python3 robot_tank_client.py [--evdev] [--udp-port N] [server host] [server port]
+  #  python3 robot_tank_client.py [--evdev] [--udp-port N] <fleet config .json>
+  #  --evdev reads the keyboard from /dev/input instead of the console, and --udp-port also sends
+  #  UDP control snapshots to that port on the server.
+  args = sys.argv[1:]
+  keyboard_backend = 'console'
+  if '--evdev' in args:
+    args.remove('--evdev')
+    keyboard_backend = 'evdev'
+  udp_port = None
+  if '--udp-port' in args:
+    i = args.index('--udp-port')
+    udp_port = int(args[i + 1])
+    del args[i:i + 2]
+  if len(args) > 0 and args[0].endswith('.json'):
+    s = RobotTankClient(udp_port=udp_port, keyboard_backend=keyboard_backend, fleet_config=args[0])
+  elif len(args) > 0:
+    s = RobotTankClient(udp_port=udp_port, keyboard_backend=keyboard_backend, host=args[0], port=int(args[1]) if len(args) > 1 else 3050)
+  else:
+    s = RobotTankClient(udp_port=udp_port, keyboard_backend=keyboard_backend)
+  s.run()
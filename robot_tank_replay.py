@@ -0,0 +1,185 @@
+import sys
+import time
+import socket
+import struct
+from RobotTankJournal import RobotTankJournalReader
+from RobotTankJournal import ROBOT_TANK_JOURNAL_CONNECT
+from RobotTankJournal import ROBOT_TANK_JOURNAL_MESSAGE
+from RobotTankJournal import ROBOT_TANK_JOURNAL_DATAGRAM
+from RobotTankJournal import ROBOT_TANK_JOURNAL_PINS
+from RobotTankJournal import ROBOT_TANK_JOURNAL_CLOSE
+from RobotTankJournal import ROBOT_TANK_JOURNAL_COMMAND
+from RobotTankCommandSlot import RobotTankCommand
+from robot_tank_server import RobotTankServer
+from robot_tank_simulator import RobotTankSimulatedClock
+
+#  Feeds a journal recorded with RobotTankServer(journal_path=...) back through the server logic
+#  and checks that every pin change comes out the same as it was recorded:
+#
+#    python3 robot_tank_replay.py <journal> [speed]
+#
+#  Without a speed the journal is replayed as fast as possible, 1 replays it in real time.
+
+class RobotTankJournalReplay(object):
+  #  The server runs on a simulated clock that follows the journal's timestamps, so timers like
+  #  the deadman fire where they did when it was recorded.  Each client in the journal gets a
+  #  socketpair, and the frames it sent are fed to the server's decoder and handled by the
+  #  server's own read callback, one batch per original read.  Nothing goes through poll().
+  #  'server_options' should match how the recorded server was set up, for example its
+  #  deadman_timeout_ms or direction_config.
+  def __init__(self, path, server_options=None):
+    self.reader = RobotTankJournalReader(path)
+    self.clock = RobotTankSimulatedClock(0.0)
+    options = {'deadman_timeout_ms': 500, 'idle_timeout': None, 'ping_interval': None}
+    options.update(server_options if server_options is not None else {})
+    self.server = RobotTankServer(
+      False,
+      gpio_backend='fake',
+      listen_address='127.0.0.1',
+      listen_port=0,
+      udp_port=0,
+      clock=self.clock,
+      **options
+    )
+    self.frame_header = struct.Struct("I")
+    self.connections = {}  #  Client id in the journal to (server fd, our end of the socketpair).
+    self.counters = {'records': 0, 'messages': 0, 'datagrams': 0, 'commands': 0, 'pin_checks': 0, 'mismatches': 0, 'unknown_clients': 0}
+    self.mismatches = []  #  (timestamp in microseconds, recorded pins, replayed pins), the first few of them.
+    self.first_timestamp_us = None
+    self.last_timestamp_us = None
+
+  def advance_to(self, timestamp_us, speed):
+    if self.first_timestamp_us is None:
+      self.first_timestamp_us = timestamp_us
+      self.wall_start = time.monotonic()
+      self.clock.now = timestamp_us / 1000000.0
+    if speed is not None:
+      delay = self.wall_start + (timestamp_us - self.first_timestamp_us) / 1000000.0 / speed - time.monotonic()
+      if delay > 0:
+        time.sleep(delay)
+    if timestamp_us / 1000000.0 > self.clock.now:
+      self.clock.now = timestamp_us / 1000000.0
+      self.server.connection_manager.run_timers()
+    self.last_timestamp_us = timestamp_us
+
+  def drain(self):
+    #  Throw away what the server sent to the clients, so its sends never back up.
+    for fd, client_sock in self.connections.values():
+      try:
+        while client_sock.recv(65536):
+          pass
+      except (BlockingIOError, InterruptedError):
+        pass
+
+  def on_connect(self, client_id):
+    server_sock, client_sock = socket.socketpair()
+    client_sock.setblocking(False)
+    self.connections[client_id] = (self.server.add_keyboard_client(server_sock, 'replay'), client_sock)
+
+  def on_close(self, client_id):
+    if client_id in self.connections:
+      fd, client_sock = self.connections.pop(client_id)
+      if fd in self.server.connection_manager.socket_map:
+        self.server.connection_manager.close_connection(fd)
+      client_sock.close()
+
+  def on_messages(self, client_id, timestamp_us, payloads):
+    if client_id not in self.connections:
+      self.counters['unknown_clients'] += 1
+      return
+    fd = self.connections[client_id][0]
+    socket_details = self.server.connection_manager.socket_map.get(fd)
+    if socket_details is None:
+      return
+    socket_details.last_read = socket_details.read_started = timestamp_us / 1000000.0
+    for payload in payloads:
+      socket_details.decoder.feed(self.frame_header.pack(len(payload)))
+      socket_details.decoder.feed(payload)
+    self.counters['messages'] += len(payloads)
+    self.server.on_keyboard_client_read(fd, socket_details)
+
+  def on_datagram(self, payload):
+    fd = self.server.control_datagram_fd
+    self.server.connection_manager.socket_map[fd].datagrams.append((bytes(payload), ('replay', 0)))
+    self.counters['datagrams'] += 1
+    self.server.on_control_datagram_read(fd, self.server.connection_manager.socket_map[fd])
+
+  def on_command(self, timestamp_us, payload):
+    c = RobotTankCommand.decode(bytes(payload))
+    if c is not None:
+      self.counters['commands'] += 1
+      self.server.on_command(c, timestamp_us, timestamp_us)
+      self.server.apply_pending_pin_update()
+
+  def on_pins(self, timestamp_us, payload):
+    recorded = bytes(payload[0:len(self.server.motor_driver.shadow)])
+    replayed = bytes(self.server.motor_driver.shadow)
+    self.counters['pin_checks'] += 1
+    if recorded != replayed:
+      self.counters['mismatches'] += 1
+      if len(self.mismatches) < 10:
+        self.mismatches.append((timestamp_us, tuple(recorded), tuple(replayed)))
+
+  def run(self, speed=None):
+    #  Messages from the same client with the same timestamp came in with one read, so they are handled together.
+    batch_client_id = None
+    batch_timestamp_us = None
+    batch = []
+    for timestamp_us, record_type, client_id, payload in self.reader.records():
+      self.counters['records'] += 1
+      if record_type == ROBOT_TANK_JOURNAL_MESSAGE and client_id == batch_client_id and timestamp_us == batch_timestamp_us:
+        batch.append(payload)
+        continue
+      if len(batch):
+        self.on_messages(batch_client_id, batch_timestamp_us, batch)
+        batch = []
+        batch_client_id = None
+      if self.counters['records'] % 256 == 0:
+        self.drain()
+      self.advance_to(timestamp_us, speed)
+      if record_type == ROBOT_TANK_JOURNAL_MESSAGE:
+        batch_client_id = client_id
+        batch_timestamp_us = timestamp_us
+        batch.append(payload)
+      elif record_type == ROBOT_TANK_JOURNAL_CONNECT:
+        self.on_connect(client_id)
+      elif record_type == ROBOT_TANK_JOURNAL_CLOSE:
+        self.on_close(client_id)
+      elif record_type == ROBOT_TANK_JOURNAL_DATAGRAM:
+        self.on_datagram(payload)
+      elif record_type == ROBOT_TANK_JOURNAL_COMMAND:
+        self.on_command(timestamp_us, payload)
+      elif record_type == ROBOT_TANK_JOURNAL_PINS:
+        self.on_pins(timestamp_us, payload)
+    if len(batch):
+      self.on_messages(batch_client_id, batch_timestamp_us, batch)
+    batch = None
+    payload = None
+    return self.counters
+
+  def get_journal_seconds(self):
+    if self.first_timestamp_us is None:
+      return 0.0
+    return (self.last_timestamp_us - self.first_timestamp_us) / 1000000.0
+
+  def cleanup(self):
+    for client_id in list(self.connections.keys()):
+      self.on_close(client_id)
+    self.server.connection_manager.cleanup()
+    self.server.motor_driver.cleanup()
+    self.reader.close()
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2:
+    print("Usage: python3 robot_tank_replay.py <journal> [speed]")
+    sys.exit(1)
+  replay = RobotTankJournalReplay(sys.argv[1])
+  start = time.monotonic()
+  counters = replay.run(float(sys.argv[2]) if len(sys.argv) > 2 else None)
+  elapsed = time.monotonic() - start
+  print("Replayed " + str(replay.get_journal_seconds()) + " seconds of journal in " + str(elapsed) + " seconds.")
+  print("Counters: " + str(counters))
+  for timestamp_us, recorded, replayed in replay.mismatches:
+    print("Pins differ at " + str(timestamp_us) + " us:  recorded " + str(recorded) + ", replayed " + str(replayed))
+  replay.cleanup()
+  sys.exit(1 if counters['mismatches'] else 0)
@@ -1,13 +1,40 @@
-import RPi.GPIO as gpio
+import os
 import time
 import sys
 import socket
 import select
 from RobotTankConnectionManager import RobotTankConnectionManager
+from RobotTankConnectionManager import RobotTankMessage
+from RobotTankConnectionManager import ROBOT_TANK_HELLO_MESSAGE
+from RobotTankConnectionManager import ROBOT_TANK_WIRE_FORMAT_JSON
+from RobotTankConnectionManager import ROBOT_TANK_WIRE_FORMATS
+from RobotTankConnectionManager import RobotTankControlDatagram
+from RobotTankConnectionManager import RobotTankSequenceFilter
+from RobotTankMotorDriver import RobotTankMotorDriver
+from RobotTankMotorDriver import make_gpio_backend
+from RobotTankMotorDriver import RobotTankSpeedRamp
+from RobotTankDirections import RobotTankDirectionResolver
+from RobotTankDirections import load_direction_config
+from RobotTankConnectionManager import ROBOT_TANK_DIRECTIONS
+from RobotTankStats import RobotTankLatencyHistogram
+from RobotTankStats import RobotTankClockOffset
+from RobotTankStats import ROBOT_TANK_LATENCY_STAGES
+from RobotTankLog import get_logger
+from RobotTankLog import ROBOT_TANK_LOG_DEBUG
+from RobotTankJournal import RobotTankJournalWriter
+from RobotTankJournal import ROBOT_TANK_JOURNAL_CONNECT
+from RobotTankJournal import ROBOT_TANK_JOURNAL_MESSAGE
+from RobotTankJournal import ROBOT_TANK_JOURNAL_DATAGRAM
+from RobotTankJournal import ROBOT_TANK_JOURNAL_PINS
+from RobotTankJournal import ROBOT_TANK_JOURNAL_CLOSE
+from RobotTankJournal import ROBOT_TANK_JOURNAL_COMMAND
+from RobotTankCommandSlot import RobotTankCommandSlot
+from RobotTankRealtime import RobotTankJitterMonitor
+from RobotTankRealtime import RobotTankRealtimeProfile
 import signal
 
 class RobotTankServer(object):
-  def __init__(self, debug):
+  def __init__(self, debug, udp_port=None, gpio_backend='rpi', pwm_frequency=None, direction_config=None, deadman_timeout_ms=500, idle_timeout=5.0, clock=time.monotonic, ping_interval=1.0, stats_interval=None, listen_address='0.0.0.0', listen_port=3050, journal_path=None, unix_socket_path=None, command_slot_path=None, command_slot_poll_interval=None, realtime_profile=None, jitter_interval=None):
 
     signal.signal(signal.SIGINT, self.cleanup)
 
@@ -15,163 +42,543 @@ class RobotTankServer(object):
     self.GPIO_PIN_RIGHT_SW_2 = 13
     self.GPIO_PIN_LEFT_SW_1 = 18
     self.GPIO_PIN_LEFT_SW_2 = 16
+    self.GPIO_PIN_EN_1 = 11
+    self.GPIO_PIN_EN_2 = 22
+    pin_numbers = {
+      'right_sw_1': self.GPIO_PIN_RIGHT_SW_1,
+      'right_sw_2': self.GPIO_PIN_RIGHT_SW_2,
+      'left_sw_1': self.GPIO_PIN_LEFT_SW_1,
+      'left_sw_2': self.GPIO_PIN_LEFT_SW_2
+    }
 
-    self.gpioinit()
-
-    gpio.setwarnings(False) # Clear gpio pins
+    #  Key to direction and direction to pin state mappings, see robot_tank_directions.json.
+    self.direction_resolver = RobotTankDirectionResolver(load_direction_config(direction_config))
+    #  'gpio_backend' is 'rpi' (RPi.GPIO), 'gpiod' (GPIO character device) or 'fake' (no hardware).
+    #  The driver's pins are in the same order as the resolver's pin state tuples.
+    self.motor_driver = RobotTankMotorDriver(
+      make_gpio_backend(gpio_backend),
+      dict((name, pin_numbers[name]) for name in self.direction_resolver.pin_names),
+      [self.GPIO_PIN_EN_1, self.GPIO_PIN_EN_2],
+      pwm_frequency
+    )
 
     self.done = False
-    self.connection_manager = RobotTankConnectionManager()
+    self.log = get_logger()
+    if debug:
+      self.log.set_level(ROBOT_TANK_LOG_DEBUG)
+    #  Clients that send nothing at all (not even heartbeats) for 'idle_timeout' seconds are disconnected.
+    self.connection_manager = RobotTankConnectionManager(clock=clock, idle_timeout=idle_timeout, write_timeout=idle_timeout)
     self.debug = debug
-    self.connection_manager.register_listen_socket('0.0.0.0', 3050, ['keyboard_client_listen_socket'])
+    #  A 'listen_port' of 0 picks a free port, see get_listen_port().
+    self.listen_fd = self.connection_manager.register_listen_socket(listen_address, listen_port, ['keyboard_client_listen_socket'])
     self.connection_manager.register_class_callback('read', 'keyboard_client_listen_socket', self.on_keyboard_client_listen_socket_connect)
-    self.directions = {
-      'forward' : {'pressed': False, 'priority': 0},
-      'reverse' : {'pressed': False, 'priority': 0},
-      'right' : {'pressed': False, 'priority': 0},
-      'left' : {'pressed': False, 'priority': 0}
-    }
-
-  def gpioinit(self):
-    print("gpio.BOARD " + str(gpio.BOARD))
-    print("gpio.OUT " + str(gpio.OUT))
-    gpio.setmode(gpio.BOARD)
-    gpio.setup(11,gpio.OUT)    #EN1
-    gpio.setup(22,gpio.OUT)    #EN2
-    gpio.output(11, 1)
-    gpio.output(22, 1)
-    gpio.setup(self.GPIO_PIN_RIGHT_SW_1, gpio.OUT)
-    gpio.setup(self.GPIO_PIN_RIGHT_SW_2, gpio.OUT)
-    gpio.setup(self.GPIO_PIN_LEFT_SW_1, gpio.OUT)
-    gpio.setup(self.GPIO_PIN_LEFT_SW_2, gpio.OUT)
+    #  Programs on the robot itself can connect to a Unix domain socket instead, with the same messages.
+    if unix_socket_path is not None:
+      self.connection_manager.register_unix_listen_socket(unix_socket_path, ['keyboard_client_listen_socket'])
+    #  With PWM enabled, speed ramps up towards the throttle (percent) instead of switching straight to full power.
+    self.throttle = 100
+    self.current_direction = None
+    self.speed_ramp = RobotTankSpeedRamp(self.connection_manager, self.motor_driver) if pwm_frequency is not None else None
+    self.current_pin_values = self.direction_resolver.resolve()[1]
+    self.pin_update_pending = False
+    #  Deadman:  the motors stop if nothing (heartbeat or input) arrives from the controlling
+    #  client for 'deadman_timeout_ms' milliseconds.  None turns it off.
+    self.deadman_timeout = deadman_timeout_ms / 1000.0 if deadman_timeout_ms is not None else None
+    self.deadman_timer = None
+    self.last_input = None
+    self.counters = {'deadman_stops': 0, 'disconnect_stops': 0, 'takeovers': 0, 'state_updates': 0, 'state_updates_skipped': 0, 'key_snapshots': 0, 'slot_commands': 0, 'slot_commands_ignored': 0, 'udp_rejected': 0}
+    #  Sessions:  every connected client is in 'clients' (fd to socket_map entry).  At most one of
+    #  them is the controller, the rest are spectators that only receive state updates.  A client
+    #  claims control with {'control': 'claim'}, which only works while nobody else has it,
+    #  {'control': 'takeover'} takes it regardless, and {'control': 'release'} gives it up.
+    #  Clients that don't know about sessions get control the first time they send input while
+    #  nobody has it.
+    self.clients = {}
+    self.controller_fd = None
+    self.next_client_id = 1
+    self.state_sequence = 0
+    self.latest_state = None
+    #  Optional UDP control channel, see RobotTankControlDatagram.  A client announces its UDP
+    #  session id in its hello, and snapshots are only applied for sessions whose client may
+    #  drive, so they go through the same control arbitration as everything else.
+    self.control_filter = RobotTankSequenceFilter()
+    self.udp_sessions = {}  #  Session id to the fd of the client that announced it.
+    self.control_datagram_fd = None
+    if udp_port is not None:
+      self.control_datagram_fd = self.connection_manager.register_udp_socket('0.0.0.0', udp_port, ['control_datagram'])
+      self.connection_manager.register_class_callback('read', 'control_datagram', self.on_control_datagram_read)
+    #  Latency of key presses per stage, see ROBOT_TANK_LATENCY_STAGES.  Only the first event that
+    #  changes the pins in a batch is stamped, and the stamps are recorded once the pins are written.
+    #  The controller is pinged every 'ping_interval' seconds to estimate its clock offset, and
+    #  with a 'stats_interval' the stats are printed that often.  Clients can also ask for them
+    #  with {'get_stats': true}.
+    self.latency = dict((stage, RobotTankLatencyHistogram()) for stage in ROBOT_TANK_LATENCY_STAGES)
+    self.pending_stamps = None
+    if ping_interval is not None:
+      self.connection_manager.call_every(ping_interval, self.send_ping)
+    if stats_interval is not None:
+      self.connection_manager.call_every(stats_interval, self.print_stats)
+    #  With a 'journal_path' everything clients send and every pin change is appended to a journal,
+    #  see RobotTankJournal.py and robot_tank_replay.py.  Buffered records go to disk every second.
+    self.journal = None
+    if journal_path is not None:
+      self.journal = RobotTankJournalWriter(journal_path)
+      self.connection_manager.call_every(1.0, self.journal.flush)
+    #  Optional shared memory command slot for programs on the robot, see RobotTankCommandSlot.py.
+    #  The slot is read whenever its writer wakes us, and every 'command_slot_poll_interval'
+    #  seconds if that is set.  The slot drives the tank only while no client has control, and
+    #  its commands are ignored (counted as 'slot_commands_ignored') while one does.
+    #  Commands and events from clients on this machine are stamped with the same monotonic clock
+    #  as ours, so their latency is recorded without waiting for a clock offset estimate.
+    self.local_stamps = clock is time.monotonic
+    self.command_slot = None
+    if command_slot_path is not None:
+      self.command_slot = RobotTankCommandSlot(command_slot_path)
+      self.connection_manager.register_file_descriptor(self.command_slot.wake_fd, ['command_slot'])
+      self.connection_manager.register_class_callback('read', 'command_slot', self.on_command_slot_wake)
+      if command_slot_poll_interval is not None:
+        self.connection_manager.call_every(command_slot_poll_interval, self.read_command_slot)
+    #  An optional RobotTankRealtimeProfile is applied when run() starts, and with a 'jitter_interval'
+    #  a timer measures how late the loop runs it from then on, see RobotTankRealtime.py.  Both are
+    #  in the stats.
+    self.realtime_profile = realtime_profile
+    self.jitter_interval = jitter_interval
+    self.jitter_monitor = None
 
   def cleanup(self, signum, frame):
-    sys.stdout.write("Caught signal %s. Shutting down.\n" % (str(signum)))
+    self.log.info("Caught signal, shutting down", signal=signum)
     self.connection_manager.cleanup()
-    gpio.output(11, 0)
-    gpio.output(22, 0)
-    gpio.output(self.GPIO_PIN_RIGHT_SW_1, 0)
-    gpio.output(self.GPIO_PIN_RIGHT_SW_2, 0)
-    gpio.output(self.GPIO_PIN_LEFT_SW_1, 0)
-    gpio.output(self.GPIO_PIN_LEFT_SW_2, 0)
-    gpio.cleanup()
+    self.motor_driver.cleanup()
+    if self.journal is not None:
+      self.journal.close()
+    if self.command_slot is not None:
+      self.command_slot.close()
+    if self.jitter_monitor is not None:
+      self.jitter_monitor.stop()
+    self.log.flush()
     self.done = True
 
+  def get_listen_port(self):
+    return self.connection_manager.socket_map[self.listen_fd]['socket'].getsockname()[1]
+
   def on_keyboard_client_listen_socket_connect(self, fd, socket_details):
     conn, addr = socket_details['socket'].accept()
+    self.add_keyboard_client(conn, addr)
+
+  def add_keyboard_client(self, conn, addr):
+    #  Also used to attach an already connected socket, such as one end of a socketpair.
     self.connection_manager.register_socket(conn, addr, ['keyboard_client'])
     self.connection_manager.register_class_callback('read', 'keyboard_client', self.on_keyboard_client_read)
+    self.connection_manager.register_class_callback('close', 'keyboard_client', self.on_keyboard_client_close)
+    self.connection_manager.register_class_callback('resume_writing', 'keyboard_client', self.on_keyboard_client_resume_writing)
+    fd = self.connection_manager.sfno(conn)
+    socket_details = self.connection_manager.socket_map[fd]
+    socket_details['client_id'] = self.next_client_id
+    socket_details['state_pending'] = False
+    socket_details['clock_offset'] = RobotTankClockOffset()
+    socket_details['same_clock'] = self.local_stamps and (conn.family == socket.AF_UNIX or (isinstance(addr, tuple) and addr[0] in ('127.0.0.1', '::1')))
+    self.next_client_id += 1
+    self.clients[fd] = socket_details
+    if self.journal is not None:
+      client_id = socket_details['client_id']
+      self.journal_record(ROBOT_TANK_JOURNAL_CONNECT, client_id)
+      #  Frames are journaled as they were received, stamped with the time of the read they came in.
+      socket_details.decoder.payload_hook = lambda payload: self.journal.record(self.received_us(socket_details), ROBOT_TANK_JOURNAL_MESSAGE, client_id, payload)
+    return fd
 
-  def get_highest_priority_direction(self):
-    #  Return the highest priority (lowest number value) direction that is enabled.
-    lowest_number = 999
-    the_direction = None
-    for d in self.directions:
-      if self.directions[d]['pressed'] and self.directions[d]['priority'] < lowest_number:
-        lowest_number = self.directions[d]['priority']
-        the_direction = d
+  def journal_record(self, record_type, client_id, payload=b''):
+    if self.journal is not None:
+      self.journal.record(self.now_us(), record_type, client_id, payload)
 
-    return the_direction
+  def on_keyboard_client_close(self, fd, socket_details):
+    self.log.info("Client disconnected", fd=fd, client_id=socket_details.get('client_id'))
+    self.clients.pop(fd, None)
+    self.journal_record(ROBOT_TANK_JOURNAL_CLOSE, socket_details.get('client_id', 0))
+    if self.udp_sessions.get(socket_details.get('udp_session')) == fd:
+      del self.udp_sessions[socket_details['udp_session']]
+    if fd == self.controller_fd:
+      self.controller_fd = None
+      #  Stopping already broadcasts the new state.
+      if self.stop_motors():
+        self.counters['disconnect_stops'] += 1
+      else:
+        self.broadcast_state()
 
-  def update_gpio_pin_states(self):
-    highest_priority_direction = self.get_highest_priority_direction()
-    pin_states = None
-    if highest_priority_direction is None:
-      pin_states = {
-        'right_sw_1' : 0,
-        'right_sw_2' : 0,
-        'left_sw_1' : 0,
-        'left_sw_2' : 0
-      }
-    elif highest_priority_direction == 'forward':
-      pin_states = {
-        'right_sw_1' : 1,
-        'right_sw_2' : 0,
-        'left_sw_1' : 1,
-        'left_sw_2' : 0
-      }
-    elif highest_priority_direction == 'reverse':
-      pin_states = {
-        'right_sw_1' : 0,
-        'right_sw_2' : 1,
-        'left_sw_1' : 0,
-        'left_sw_2' : 1 
-      }
-    elif highest_priority_direction == 'right':
-      pin_states = {
-        'right_sw_1' : 1,
-        'right_sw_2' : 0,
-        'left_sw_1' : 0,
-        'left_sw_2' : 0
-      }
-    elif highest_priority_direction == 'left':
-      pin_states = {
-        'right_sw_1' : 0,
-        'right_sw_2' : 0,
-        'left_sw_1' : 1,
-        'left_sw_2' : 0
-      }
+  def get_client_id(self, fd):
+    return self.clients[fd]['client_id'] if fd in self.clients else None
 
-    print("Highest priority direction is " + str(highest_priority_direction) + ". Setting pin states " + str(pin_states))
-    self.gpioinit()
-    gpio.output(self.GPIO_PIN_RIGHT_SW_1, pin_states['right_sw_1'])
-    print("self.GPIO_PIN_RIGHT_SW_1 " + str(self.GPIO_PIN_RIGHT_SW_1) + " set to " + str(pin_states['right_sw_1']))
-    gpio.output(self.GPIO_PIN_RIGHT_SW_2, pin_states['right_sw_2'])
-    print("self.GPIO_PIN_RIGHT_SW_2 " + str(self.GPIO_PIN_RIGHT_SW_2) + " set to " + str(pin_states['right_sw_2']))
-    gpio.output(self.GPIO_PIN_LEFT_SW_1, pin_states['left_sw_1'])
-    print("self.GPIO_PIN_LEFT_SW_1 " + str(self.GPIO_PIN_LEFT_SW_1) + " set to " + str(pin_states['left_sw_1']))
-    gpio.output(self.GPIO_PIN_LEFT_SW_2, pin_states['left_sw_2'])
-    print("self.GPIO_PIN_LEFT_SW_2 " + str(self.GPIO_PIN_LEFT_SW_2) + " set to " + str(pin_states['left_sw_2']))
-
-  def augment_direction_priority(self, direction):
-    for d in self.directions:
-      self.directions[d]['priority'] += 1
-
-    self.directions[direction]['priority'] = 0  #  New highest priority direction.
-    
-  def direction_update(self, direction, new_state):
-    if new_state:
-      self.augment_direction_priority(direction)
+  def set_controller(self, fd):
+    #  Held directions belong to whoever held them, so they're released when control changes hands,
+    #  including directions from the command slot when a client takes control.
+    previous_fd = self.controller_fd
+    if previous_fd is not None and previous_fd != fd:
+      self.log.info("Control taken over", client_id=self.get_client_id(fd), previous_client_id=self.get_client_id(previous_fd))
+      self.counters['takeovers'] += 1
+    else:
+      self.log.info("Client has control", client_id=self.get_client_id(fd))
+    self.controller_fd = fd
+    #  Stopping already broadcasts the new state.
+    if previous_fd == fd or not self.stop_motors():
+      self.broadcast_state()
 
-    if self.directions[direction]['pressed'] == new_state:
-      pass
+  def on_control_request(self, fd, request):
+    if request == 'claim' and self.controller_fd in (None, fd):
+      self.set_controller(fd)
+      result = 'granted'
+    elif request == 'takeover':
+      self.set_controller(fd)
+      result = 'granted'
+    elif request == 'release' and self.controller_fd == fd:
+      self.log.info("Client released control", client_id=self.get_client_id(fd))
+      self.controller_fd = None
+      if not self.stop_motors():
+        self.broadcast_state()
+      result = 'released'
     else:
-      print("State of direction " + str(direction) + " changed to " + str(new_state))
-      self.directions[direction]['pressed'] = new_state
-      self.update_gpio_pin_states()
+      result = 'denied'
+    self.connection_manager.add_to_write_buffer(fd, RobotTankMessage({'control_result': result}).serialize())
+
+  def may_drive(self, fd):
+    if self.controller_fd is None and fd in self.clients:
+      self.set_controller(fd)
+    return fd == self.controller_fd
+
+  def broadcast_state(self):
+    #  The update is serialized once and the same bytes object is queued for every client.
+    #  Clients that are behind (write paused) skip updates and get the newest one when they
+    #  catch up, since each update replaces the previous one anyway.
+    self.state_sequence += 1
+    self.latest_state = RobotTankMessage({
+      'state': {
+        'seq': self.state_sequence,
+        'direction': self.current_direction,
+        'pins': list(self.current_pin_values),
+        'throttle': self.throttle,
+        'controller': self.get_client_id(self.controller_fd)
+      }
+    }).serialize()
+    self.counters['state_updates'] += 1
+    for fd, socket_details in list(self.clients.items()):
+      if socket_details.write_paused:
+        socket_details['state_pending'] = True
+        self.counters['state_updates_skipped'] += 1
+      else:
+        self.connection_manager.add_to_write_buffer(fd, self.latest_state)
+
+  def on_keyboard_client_resume_writing(self, fd, socket_details):
+    if socket_details.get('state_pending'):
+      socket_details['state_pending'] = False
+      self.connection_manager.add_to_write_buffer(fd, self.latest_state)
+
+  def now_us(self):
+    return int(self.connection_manager.clock() * 1000000)
+
+  def client_time_to_local(self, socket_details, client_time_us):
+    #  None until there is a clock offset estimate for the client.
+    if client_time_us is None or socket_details is None:
+      return None
+    clock_offset = socket_details.get('clock_offset')
+    if clock_offset is None or clock_offset.offset is None:
+      return client_time_us if socket_details.get('same_clock') else None
+    return clock_offset.to_local(client_time_us)
+
+  def stamp_pending_update(self, sent_us, received_us, decoded_us):
+    #  Called after applying an event.  Keeps the stamps of the first event in the batch that changed the pins.
+    if self.pin_update_pending and self.pending_stamps is None:
+      self.pending_stamps = (sent_us, received_us, decoded_us)
+
+  def received_us(self, socket_details):
+    #  When the data being handled was read, or now if this connection hasn't read anything.
+    return int(socket_details.read_started * 1000000) if socket_details.read_started is not None else self.now_us()
 
+  def record_latency(self, stamps, resolved_us, written_us):
+    sent_us, received_us, decoded_us = stamps
+    self.latency['decode'].record(decoded_us - received_us)
+    self.latency['resolve'].record(resolved_us - decoded_us)
+    self.latency['gpio'].record(written_us - resolved_us)
+    self.latency['server'].record(written_us - received_us)
+    if sent_us is not None:
+      self.latency['network'].record(received_us - sent_us)
+      self.latency['total'].record(written_us - sent_us)
+
+  def send_ping(self):
+    #  The controller answers with {'pong': {'t0': ..., 't1': ..., 't2': ...}}, see on_pong.
+    if self.controller_fd is not None:
+      self.connection_manager.add_to_write_buffer(self.controller_fd, RobotTankMessage({'ping': self.now_us()}).serialize())
+
+  def on_pong(self, socket_details, pong):
+    socket_details['clock_offset'].add(pong['t0'], pong['t1'], pong['t2'], self.now_us())
+
+  def get_stats(self):
+    controller = self.clients.get(self.controller_fd)
+    return {
+      'latency': dict((stage, self.latency[stage].summary()) for stage in ROBOT_TANK_LATENCY_STAGES),
+      'clock_offset_us': controller['clock_offset'].offset if controller is not None else None,
+      'round_trip_us': controller['clock_offset'].round_trip if controller is not None else None,
+      'server': dict(self.counters),
+      'motor_driver': dict(self.motor_driver.counters),
+      'connection_manager': dict(self.connection_manager.counters),
+      'realtime': dict(self.realtime_profile.applied) if self.realtime_profile is not None else None,
+      'jitter': self.jitter_monitor.summary() if self.jitter_monitor is not None else None
+    }
+
+  def print_stats(self):
+    for stage in ROBOT_TANK_LATENCY_STAGES:
+      self.log.info("Latency", stage=stage, **self.latency[stage].summary())
+    if self.jitter_monitor is not None:
+      self.log.info("Loop lateness", **self.jitter_monitor.lateness.summary())
+      self.log.info("GC pauses", **self.jitter_monitor.gc_pauses.summary())
+
+  def stop_motors(self):
+    #  Release every direction.  Returns True if the tank was moving, which includes pins still on
+    #  from a pin update that never got applied.
+    if self.direction_resolver.release_all() or any(self.current_pin_values):
+      self.pin_update_pending = True
+      self.apply_pending_pin_update()
+      return True
+    return False
+
+  def on_input(self):
+    #  Called for every heartbeat or control input.  Rather than moving the deadman timer on every
+    #  message, the timer checks when it fires whether there was input since, and if so waits out the rest.
+    self.last_input = self.connection_manager.clock()
+    if self.deadman_timeout is not None and self.deadman_timer is None:
+      self.deadman_timer = self.connection_manager.call_later(self.deadman_timeout, self.check_deadman)
+
+  def check_deadman(self):
+    self.deadman_timer = None
+    remaining = self.last_input + self.deadman_timeout - self.connection_manager.clock()
+    if remaining > 0:
+      self.deadman_timer = self.connection_manager.call_later(remaining, self.check_deadman)
+    elif self.direction_resolver.pressed or any(self.current_pin_values):
+      self.log.warning("Nothing heard from the controller, stopping", deadman_timeout_ms=int(self.deadman_timeout * 1000))
+      self.stop_motors()
+      self.counters['deadman_stops'] += 1
+
+  def update_gpio_pin_states(self):
+    direction, pin_values = self.direction_resolver.resolve()
+    stamps = self.pending_stamps
+    if stamps is not None:
+      self.pending_stamps = None
+      resolved_us = self.now_us()
+    self.log.debug("Setting pin states", direction=direction, pins=pin_values)
+    previous_pin_values = self.current_pin_values
+    self.current_direction = direction
+    self.current_pin_values = pin_values
+    if self.speed_ramp is not None:
+      #  Stopping and reversing drop the speed straight to zero, the ramp then brings it back up.
+      #  A change is treated as reversing when none of the pins that were on stay on.
+      reversing = any(previous_pin_values) and not any(a and b for a, b in zip(previous_pin_values, pin_values))
+      if direction is None or reversing:
+        self.speed_ramp.jump_to(0)
+    self.motor_driver.set_pin_values(pin_values)
+    if self.journal is not None:
+      self.journal_record(ROBOT_TANK_JOURNAL_PINS, self.get_client_id(self.controller_fd) or 0, bytes(pin_values) + (direction or '').encode())
+    if stamps is not None:
+      self.record_latency(stamps, resolved_us, self.now_us())
+    if self.speed_ramp is not None and direction is not None:
+      self.speed_ramp.set_target(self.throttle)
+    self.broadcast_state()
+
+  def set_throttle(self, throttle):
+    #  'throttle' is a percent from clients, anything else is logged and ignored.
+    if isinstance(throttle, bool) or not isinstance(throttle, (int, float)) or not 0 <= throttle <= 100:
+      self.log.warning("Ignoring invalid throttle", throttle=throttle)
+      return
+    self.throttle = throttle
+    self.log.info("Throttle set", throttle=self.throttle)
+    if self.speed_ramp is not None and self.current_direction is not None:
+      self.speed_ramp.set_target(self.throttle)
+    self.broadcast_state()
+
+  def direction_update(self, index, new_state):
+    if self.direction_resolver.set_direction(index, new_state):
+      self.log.debug("Direction changed", direction=ROBOT_TANK_DIRECTIONS[index], pressed=new_state)
+      self.pin_update_pending = True
 
   def on_keyboard_event(self, e):
     if e is not None:
-      if e['key'] == '+w' and e['is_up']:
-        self.direction_update('forward', False)
-      elif e['key'] == '+w' and not e['is_up']:
-        self.direction_update('forward', True)
-      if e['key'] == '+s' and e['is_up']:
-        self.direction_update('reverse', False)
-      elif e['key'] == '+s' and not e['is_up']:
-        self.direction_update('reverse', True)
-      if e['key'] == '+a' and e['is_up']:
-        self.direction_update('left', False)
-      elif e['key'] == '+a' and not e['is_up']:
-        self.direction_update('left', True)
-      if e['key'] == '+d' and e['is_up']:
-        self.direction_update('right', False)
-      elif e['key'] == '+d' and not e['is_up']:
-        self.direction_update('right', True)
+      index = self.direction_resolver.key_directions.get(e['key'])
+      if index is not None:
+        self.direction_update(index, not e['is_up'])
+
+  def on_key_snapshot(self, keys):
+    #  Sent by a client after it (re)connects, with every key it holds in the order they were
+    #  pressed.  Directions that aren't held are released, then the held ones are pressed oldest
+    #  first so the most recent one keeps priority.
+    indexes = [self.direction_resolver.key_directions.get(key) for key in keys]
+    indexes = [index for index in indexes if index is not None]
+    self.counters['key_snapshots'] += 1
+    for index in range(len(ROBOT_TANK_DIRECTIONS)):
+      if index not in indexes:
+        self.direction_update(index, False)
+    for index in indexes:
+      self.direction_update(index, True)
+
+  def on_hello(self, fd, socket_details, hello):
+    #  Pick the first wire format we support from the ones the client offered.
+    wire_format = ROBOT_TANK_WIRE_FORMAT_JSON
+    for f in ROBOT_TANK_WIRE_FORMATS:
+      if f in hello.get('wire_formats', []):
+        wire_format = f
+        break
+    #  JSON object keys are always strings, so convert the keycodes back.
+    socket_details['keymap'] = {int(k): v for k, v in hello.get('keymap', {}).items()}
+    socket_details['direction_table'] = self.direction_resolver.make_keycode_table(socket_details['keymap'])
+    if isinstance(hello.get('udp_session'), int):
+      if self.udp_sessions.get(socket_details.get('udp_session')) == fd:
+        del self.udp_sessions[socket_details['udp_session']]
+      socket_details['udp_session'] = hello['udp_session']
+      self.udp_sessions[hello['udp_session']] = fd
+    self.log.info("Client wire format", fd=fd, wire_format=wire_format)
+    r = RobotTankMessage({'hello': {
+      'version': ROBOT_TANK_HELLO_MESSAGE,
+      'wire_format': wire_format,
+      'features': ['keyboard_events', 'control', 'state', 'stamps', 'key_snapshot', 'udp_session'],
+      'client_id': socket_details.get('client_id')
+    }})
+    self.connection_manager.add_to_write_buffer(fd, r.serialize())
+
+  def on_client_keyboard_event(self, socket_details, e, received_us=None, decoded_us=None):
+    if e['key'] is None and 'direction_table' in socket_details:
+      #  Binary events only carry the keycode, look the direction up directly.
+      table = socket_details['direction_table']
+      index = table[e['keycode']] if e['keycode'] < len(table) else None
+      if index is not None:
+        self.direction_update(index, not e['is_up'])
+    else:
+      self.on_keyboard_event(e)
+    if received_us is not None:
+      self.stamp_pending_update(self.client_time_to_local(socket_details, e.get('t')), received_us, decoded_us)
 
   def on_keyboard_client_read(self, fd, socket_details):
     fd = self.connection_manager.sfno(socket_details['socket'])
     if fd:
-      m = self.connection_manager.try_remove_message(fd)
-      if m is not None:
-        if 'keyboard_event' in m:
-          self.on_keyboard_event(m['keyboard_event'])
+      #  Apply every event that arrived in this wakeup, then update the pins once for the whole batch.
+      #  Input from spectators is ignored.
+      received_us = self.received_us(socket_details)
+      #  The pins are updated even if a message raises, so events applied before it take effect.
+      try:
+        for m in self.connection_manager.iter_messages(fd):
+          #  Messages are decoded as they're iterated over, so this is taken before anything is applied.
+          decoded_us = self.now_us() if self.pending_stamps is None else None
+          if 'throttle' in m and self.may_drive(fd):
+            self.set_throttle(m['throttle'])
+          if 'keyboard_event' in m:
+            if self.may_drive(fd):
+              self.on_client_keyboard_event(socket_details, m['keyboard_event'], received_us, decoded_us)
+          elif 'keyboard_events' in m:
+            if self.may_drive(fd):
+              for e in m['keyboard_events']:
+                self.on_client_keyboard_event(socket_details, e, received_us, decoded_us)
+          elif 'key_snapshot' in m:
+            if self.may_drive(fd):
+              self.on_key_snapshot(m['key_snapshot'])
+          elif 'control' in m:
+            self.on_control_request(fd, m['control'])
+          elif 'hello' in m:
+            self.on_hello(fd, socket_details, m['hello'])
+          elif 'heartbeat' in m:
+            #  Echo it so the client can tell the connection is still alive.
+            self.connection_manager.add_to_write_buffer(fd, RobotTankMessage({'heartbeat': m['heartbeat']}).serialize())
+          elif 'pong' in m:
+            self.on_pong(socket_details, m['pong'])
+          elif 'get_stats' in m:
+            self.connection_manager.add_to_write_buffer(fd, RobotTankMessage({'stats': self.get_stats()}).serialize())
+        #  Only the controller keeps the deadman from firing.
+        if fd == self.controller_fd:
+          self.on_input()
+      finally:
+        self.apply_pending_pin_update()
+
+  def apply_pending_pin_update(self):
+    if self.pin_update_pending:
+      self.pin_update_pending = False
+      self.update_gpio_pin_states()
+
+  def on_control_state(self, d):
+    #  Apply a full snapshot.  The most recently pressed direction goes last so it ends up with the highest priority.
+    for index, direction in enumerate(ROBOT_TANK_DIRECTIONS):
+      if direction != d.most_recent:
+        self.direction_update(index, direction in d.pressed)
+    if d.most_recent is not None:
+      self.direction_update(ROBOT_TANK_DIRECTIONS.index(d.most_recent), d.most_recent in d.pressed)
+
+  def on_control_datagram_read(self, fd, socket_details):
+    #  Snapshots are stamped with the clock of the client whose session they're for.
+    received_us = self.received_us(socket_details)
+    for data, address in self.connection_manager.remove_datagrams(fd):
+      self.journal_record(ROBOT_TANK_JOURNAL_DATAGRAM, 0, data)
+      d = RobotTankControlDatagram.decode(data)
+      if d is None:
+        continue
+      decoded_us = self.now_us() if self.pending_stamps is None else None
+      client_fd = self.udp_sessions.get(d.session)
+      if client_fd is None or not self.may_drive(client_fd):
+        self.counters['udp_rejected'] += 1
+        continue
+      #  Stale or reordered snapshots are dropped, only the newest state matters.
+      if self.control_filter.accept(address, d.session, d.sequence_number):
+        self.on_input()
+        self.on_control_state(d)
+        self.stamp_pending_update(self.client_time_to_local(self.clients[client_fd], d.timestamp_us), received_us, decoded_us)
+    self.apply_pending_pin_update()
     
+  def on_command_slot_wake(self, fd, socket_details):
+    self.connection_manager.remove_from_read_buffer(fd)  #  The wakeup bytes carry nothing.
+    self.read_command_slot()
+
+  def read_command_slot(self):
+    received_us = self.now_us()
+    c = self.command_slot.read()
+    if c is not None:
+      decoded_us = self.now_us()
+      if self.journal is not None:
+        self.journal_record(ROBOT_TANK_JOURNAL_COMMAND, 0, c.serialize())
+      self.on_command(c, received_us, decoded_us)
+      self.apply_pending_pin_update()
+
+  def on_command(self, c, received_us, decoded_us):
+    if self.controller_fd is not None:
+      self.counters['slot_commands_ignored'] += 1
+      return
+    self.counters['slot_commands'] += 1
+    self.on_input()
+    self.on_control_state(c)
+    if c.throttle is not None and c.throttle != self.throttle:
+      self.set_throttle(c.throttle)
+    self.stamp_pending_update(c.timestamp_us if self.local_stamps else None, received_us, decoded_us)
+
   def run(self):
+    if self.realtime_profile is not None:
+      self.realtime_profile.apply()
+    if self.jitter_interval is not None and self.jitter_monitor is None:
+      self.jitter_monitor = RobotTankJitterMonitor(self.connection_manager, self.jitter_interval)
     while not self.done:
       self.connection_manager.run(10000)
 
 
-s = RobotTankServer(debug=False)
-s.run()
+if __name__ == '__main__':
+  #  python3 robot_tank_server.py [--realtime] [--udp-port N] [listen port] [gpio backend] [unix socket path] [command slot path]
+  #  --realtime runs the main thread at SCHED_FIFO priority 50 on the last CPU with its memory
+  #  locked and the GC frozen after startup, as far as it's allowed to, and prints loop jitter every 10 seconds.
+  #  --udp-port also listens for UDP control snapshots on that port.
+  realtime = '--realtime' in sys.argv
+  args = [a for a in sys.argv[1:] if a != '--realtime']
+  udp_port = None
+  if '--udp-port' in args:
+    i = args.index('--udp-port')
+    udp_port = int(args[i + 1])
+    del args[i:i + 2]
+  s = RobotTankServer(
+    debug=False,
+    udp_port=udp_port,
+    listen_port=int(args[0]) if len(args) > 0 else 3050,
+    gpio_backend=args[1] if len(args) > 1 else 'rpi',
+    unix_socket_path=args[2] if len(args) > 2 else None,
+    command_slot_path=args[3] if len(args) > 3 else None,
+    realtime_profile=RobotTankRealtimeProfile(fifo_priority=50, cpus=[max(os.sched_getaffinity(0))], lock_memory=True, gc_freeze=True) if realtime else None,
+    jitter_interval=0.001 if realtime else None,
+    stats_interval=10.0 if realtime else None
+  )
+  s.run()
@@ -0,0 +1,159 @@
+import os
+import time
+from PyKeyUpKeyDownEvdev import PyKeyUpKeyDownEvdev
+from robot_tank_server import RobotTankServer
+from robot_tank_client import RobotTankClient
+
+#  Runs the whole control path in one process without a Pi or a keyboard:  a scripted keyboard
+#  feeds the real client, which talks to the real server over loopback TCP, and the server
+#  drives the fake GPIO backend, which records every write.  Both event loops are stepped in
+#  turn from one thread, and with the simulated clock the timers (heartbeats, deadman, pings)
+#  fire at exactly the same points on every run, so a script always gives the same pin trace.
+#
+#    python3 robot_tank_simulator.py
+
+class RobotTankSimulatedClock(object):
+  #  Stands in for time.monotonic, it only moves when advanced.
+  def __init__(self, now=1000.0):
+    self.now = now
+
+  def __call__(self):
+    return self.now
+
+  def advance(self, seconds):
+    self.now += seconds
+
+class RobotTankScriptedKeyboard(PyKeyUpKeyDownEvdev):
+  #  Key events are written into a pipe as 'struct input_event' records and the client reads
+  #  the other end exactly like an evdev device, stamped with 'clock'.
+  def __init__(self, clock=time.monotonic):
+    PyKeyUpKeyDownEvdev.__init__(self)
+    self.clock = clock
+    self.write_fd = None
+    self.keycodes = {}  #  Key name to keycode.
+
+  def setup_keylisten(self):
+    read_fd, self.write_fd = os.pipe()
+    self.use_file_descriptor(read_fd)
+    self.keycodes = dict((name, keycode) for keycode, name in self.keymap.items())
+    return True
+
+  def encode_key(self, key, is_up):
+    #  'key' is a key name like '+w' or a keycode.
+    keycode = self.keycodes[key] if key in self.keycodes else key
+    now = self.clock()
+    return self.input_event_struct.pack(int(now), int((now % 1) * 1000000), self.EV_KEY, keycode, self.KEY_VALUE_UP if is_up else self.KEY_VALUE_DOWN)
+
+  def write_keys(self, keys):
+    #  'keys' is a list of (key, is_up), written in one go so the client can read them all at once.
+    os.write(self.write_fd, b''.join(self.encode_key(key, is_up) for key, is_up in keys))
+
+  def press(self, key):
+    self.write_keys([(key, False)])
+
+  def release(self, key):
+    self.write_keys([(key, True)])
+
+  def cleanup(self):
+    PyKeyUpKeyDownEvdev.cleanup(self)
+    if self.write_fd is not None:
+      os.close(self.write_fd)
+      self.write_fd = None
+
+class RobotTankSimulation(object):
+  #  A server with fake GPIO listening on a free loopback port, and a client with a scripted
+  #  keyboard connected to it.  Pass clock=time.monotonic to run in real time instead.
+  def __init__(self, clock=None, server_options=None, client_options=None):
+    self.clock = clock if clock is not None else RobotTankSimulatedClock()
+    self.server = RobotTankServer(
+      False,
+      gpio_backend='fake',
+      listen_address='127.0.0.1',
+      listen_port=0,
+      clock=self.clock,
+      **(server_options if server_options is not None else {})
+    )
+    self.gpio = self.server.motor_driver.backend
+    self.keyboard = RobotTankScriptedKeyboard(self.clock)
+    self.client = RobotTankClient(
+      host='127.0.0.1',
+      port=self.server.get_listen_port(),
+      key_listener=self.keyboard,
+      clock=self.clock,
+      **(client_options if client_options is not None else {})
+    )
+    self.trace = []  #  (time, pin values) after every GPIO write, in 'pin_names' order.
+    self.gpio_writes = len(self.gpio.writes)
+    self.settle()  #  Accept, hello and control claim.
+
+  def get_pin_values(self):
+    return dict(zip(self.server.motor_driver.pin_names, self.server.motor_driver.shadow))
+
+  def step(self):
+    #  One pass of each event loop.  Returns True if either of them had anything to do.
+    server_wakeups = self.server.connection_manager.counters['wakeups']
+    client_wakeups = self.client.connection_manager.counters['wakeups']
+    self.server.connection_manager.run(0)
+    self.client.connection_manager.run(0)
+    if len(self.gpio.writes) != self.gpio_writes:
+      self.gpio_writes = len(self.gpio.writes)
+      self.trace.append((self.clock(), tuple(self.server.motor_driver.shadow)))
+    return server_wakeups != self.server.connection_manager.counters['wakeups'] or client_wakeups != self.client.connection_manager.counters['wakeups']
+
+  def settle(self, max_steps=1000):
+    #  Steps until a pass goes by with nothing to do.  Returns the number of steps.
+    for i in range(max_steps):
+      if not self.step():
+        return i + 1
+    raise Exception("Simulation didn't settle in " + str(max_steps) + " steps.")
+
+  def advance(self, seconds, tick=0.01):
+    #  Moves the simulated clock forward in 'tick' steps and settles after each, so timers run on time.
+    end = self.clock() + seconds
+    while self.clock() < end:
+      self.clock.advance(min(tick, end - self.clock()))
+      self.settle()
+
+  def press(self, key):
+    self.keyboard.press(key)
+    self.settle()
+
+  def release(self, key):
+    self.keyboard.release(key)
+    self.settle()
+
+  def run_script(self, script):
+    #  'script' is a list of (seconds from now, key, is_up).  Returns the pin trace from the start of the script.
+    start = self.clock()
+    first = len(self.trace)
+    for at, key, is_up in script:
+      if start + at > self.clock():
+        self.advance(start + at - self.clock())
+      self.keyboard.write_keys([(key, is_up)])
+      self.settle()
+    return [(t - start, pins) for t, pins in self.trace[first:]]
+
+  def cleanup(self):
+    self.client.connection_manager.cleanup()
+    self.keyboard.cleanup()
+    self.server.connection_manager.cleanup()
+    self.server.motor_driver.cleanup()
+
+if __name__ == '__main__':
+  simulation = RobotTankSimulation()
+  start = simulation.clock()
+  #  Forward, veer left, straighten out, stop, then reverse and go quiet so the deadman stops the tank.
+  simulation.run_script([
+    (0.0, '+w', False),
+    (0.5, '+a', False),
+    (0.8, '+a', True),
+    (1.2, '+w', True),
+    (1.5, '+s', False)
+  ])
+  simulation.client.heartbeat_timer.cancel()
+  simulation.advance(1.0)
+  print("    time  " + " ".join(simulation.server.motor_driver.pin_names))
+  for t, pins in simulation.trace:
+    print("%8.3f  %s" % (t - start, " ".join(str(v) for v in pins)))
+  print("Server counters: " + str(simulation.server.counters))
+  simulation.cleanup()
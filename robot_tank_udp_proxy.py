@@ -0,0 +1,71 @@
+import sys
+import random
+import signal
+from RobotTankConnectionManager import RobotTankConnectionManager
+
+#  UDP proxy that drops, delays and reorders datagrams to simulate a bad WiFi link
+#  between the client and server.  Point the client's UDP port at the proxy:
+#
+#    python3 robot_tank_udp_proxy.py <listen port> <server host> <server port> <loss> <reorder>
+#
+#  where loss and reorder are probabilities between 0 and 1.
+
+class RobotTankLossyUdpProxy(object):
+  def __init__(self, connection_manager, listen_address, listen_port, target, loss=0.0, reorder=0.0, delay=0.0, reorder_delay=0.005, seed=None):
+    self.connection_manager = connection_manager
+    self.loss = loss
+    self.reorder = reorder
+    self.delay = delay  #  Added to every datagram, in seconds.
+    self.reorder_delay = reorder_delay  #  Extra delay for reordered datagrams so later ones overtake them.
+    self.random = random.Random(seed)
+    self.client_address = None
+    self.counters = {'forwarded': 0, 'dropped': 0, 'reordered': 0}
+    self.listen_fd = connection_manager.register_udp_socket(listen_address, listen_port, ['udp_proxy_listen'])
+    self.upstream_fd = connection_manager.register_udp_socket(None, None, ['udp_proxy_upstream'], remote=target)
+    connection_manager.register_class_callback('read', 'udp_proxy_listen', self.on_listen_read)
+    connection_manager.register_class_callback('read', 'udp_proxy_upstream', self.on_upstream_read)
+
+  def get_listen_port(self):
+    return self.connection_manager.socket_map[self.listen_fd]['socket'].getsockname()[1]
+
+  def forward(self, fd, data, address):
+    if self.random.random() < self.loss:
+      self.counters['dropped'] += 1
+      return
+    delay = self.delay
+    if self.random.random() < self.reorder:
+      self.counters['reordered'] += 1
+      delay += self.reorder_delay
+    self.counters['forwarded'] += 1
+    if delay > 0:
+      self.connection_manager.call_later(delay, lambda: self.connection_manager.send_datagram(fd, data, address))
+    else:
+      self.connection_manager.send_datagram(fd, data, address)
+
+  def on_listen_read(self, fd, socket_details):
+    for data, address in self.connection_manager.remove_datagrams(fd):
+      self.client_address = address  #  Replies go back to whoever sent to us last.
+      self.forward(self.upstream_fd, data, None)
+
+  def on_upstream_read(self, fd, socket_details):
+    for data, address in self.connection_manager.remove_datagrams(fd):
+      if self.client_address is not None:
+        self.forward(self.listen_fd, data, self.client_address)
+
+if __name__ == '__main__':
+  if len(sys.argv) != 6:
+    print("Usage: python3 robot_tank_udp_proxy.py <listen port> <server host> <server port> <loss> <reorder>")
+    sys.exit(1)
+  done = False
+
+  def cleanup(signum, frame):
+    global done
+    print("Caught signal %s. Shutting down." % (str(signum)))
+    done = True
+
+  signal.signal(signal.SIGINT, cleanup)
+  connection_manager = RobotTankConnectionManager()
+  proxy = RobotTankLossyUdpProxy(connection_manager, '0.0.0.0', int(sys.argv[1]), (sys.argv[2], int(sys.argv[3])), float(sys.argv[4]), float(sys.argv[5]))
+  while not done:
+    connection_manager.run(1000)
+  print("Proxy counters: " + str(proxy.counters))